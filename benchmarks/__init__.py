@@ -0,0 +1,4 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Benchmarks of the bot. Run them with `python -m benchmarks.<name>`.
+'''
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Measures latency of the bot's hot queries on a large database, with and
+without the indexes created by the migrations.
+'''
+
+import argparse
+import contextlib
+import datetime
+import os
+import sys
+import tempfile
+import timeit
+
+import sqlalchemy
+
+from netherappbot.database import create_engine, migrate
+from netherappbot.models import AppointmentEvent, User
+from netherappbot.scraper import DEFAULT_TARGET
+
+BATCH_SIZE = 50000
+
+
+def populate(engine, events, users):
+    start = datetime.datetime(2019, 1, 1)
+    with engine.begin() as connection:
+        for offset in range(0, events, BATCH_SIZE):
+            connection.execute(AppointmentEvent.__table__.insert(), [
+                {
+                    'target': DEFAULT_TARGET.key,
+                    'timestamp': start + datetime.timedelta(seconds=5 * i),
+                    'have_appointments': i % 2 == 1,
+                    'notification_sent': True,
+                }
+                for i in range(offset, min(events, offset + BATCH_SIZE))
+            ])
+        for offset in range(0, users, BATCH_SIZE):
+            connection.execute(User.__table__.insert(), [
+                {'chat_id': i, 'subscribed': i % 3 == 0}
+                for i in range(offset, min(users, offset + BATCH_SIZE))
+            ])
+
+
+QUERIES = [
+    ('pending notification', lambda session: session.query(
+        AppointmentEvent).filter(
+            AppointmentEvent.notification_sent == False  # noqa: E712
+        ).first()),
+    ('last event of target', lambda session: session.query(
+        AppointmentEvent).filter(
+            AppointmentEvent.target == DEFAULT_TARGET.key).order_by(
+                AppointmentEvent.timestamp.desc()).limit(1).first()),
+    ('subscribed count', lambda session: session.query(User).filter(
+        User.subscribed == True).count()),  # noqa: E712
+    ('user by chat_id', lambda session: session.query(User).filter(
+        User.chat_id == 4242).first()),
+]
+
+
+def measure(Session, number):
+    results = {}
+    with contextlib.closing(Session()) as session:
+        for name, query in QUERIES:
+            results[name] = min(timeit.repeat(
+                lambda: query(session), number=number, repeat=3)) / number
+    return results
+
+
+def drop_indexes(engine):
+    inspector = sqlalchemy.inspect(engine)
+    for table in ('users', 'events'):
+        for index in inspector.get_indexes(table):
+            if index['name'].startswith('ix_'):
+                engine.execute('DROP INDEX {}'.format(index['name']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--number', type=int, default=20,
+                        help='Runs of every query per measurement.')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(
+            'sqlite:///' + os.path.join(directory, 'bench.db'))
+        migrate(engine)
+        Session = sqlalchemy.orm.sessionmaker(bind=engine)
+        print('Populating {} events and {} users...'.format(
+            args.events, args.users))
+        populate(engine, args.events, args.users)
+
+        indexed = measure(Session, args.number)
+        drop_indexes(engine)
+        plain = measure(Session, args.number)
+        engine.dispose()
+
+    print('{:<24} {:>14} {:>14}'.format('query', 'no index, ms', 'indexed, ms'))
+    for name, _ in QUERIES:
+        print('{:<24} {:>14.3f} {:>14.3f}'.format(
+            name, plain[name] * 1000, indexed[name] * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
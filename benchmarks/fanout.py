@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Measures peak memory of enumerating subscribers for a notification fan-out:
+loading every User with the ORM versus streaming chat ids in keyset chunks
+from the database and from the subscriber index.
+'''
+
+import argparse
+import contextlib
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sqlalchemy
+
+from netherappbot.database import create_engine, migrate
+from netherappbot.delivery import Broadcaster
+from netherappbot.models import User
+from netherappbot.subscribers import SubscriberIndex, iter_subscriber_chunks
+
+BATCH_SIZE = 50000
+
+
+class NullTelegram(object):
+    def send_message(self, chat_id, text, parse_mode=None):
+        pass
+
+
+def populate(engine, users):
+    with engine.begin() as connection:
+        for offset in range(0, users, BATCH_SIZE):
+            connection.execute(User.__table__.insert(), [
+                {'chat_id': i, 'subscribed': True}
+                for i in range(offset, min(users, offset + BATCH_SIZE))
+            ])
+
+
+def orm_all(session, index):
+    return [
+        user.chat_id for user in session.query(User).filter(
+            User.subscribed == True).all()  # noqa: E712
+    ]
+
+
+def database_chunks(session, index):
+    for chunk in iter_subscriber_chunks(session):
+        for chat_id in chunk:
+            yield chat_id
+
+
+def index_chunks(session, index):
+    for chunk in index.iter_chunks():
+        for chat_id in chunk:
+            yield chat_id
+
+
+STRATEGIES = [
+    ('ORM .all()', orm_all),
+    ('database chunks', database_chunks),
+    ('index chunks', index_chunks),
+]
+
+
+def measure(Session, index, strategy, send):
+    gc.collect()
+    with contextlib.closing(Session()) as session:
+        tracemalloc.start()
+        started = time.monotonic()
+        if send:
+            broadcaster = Broadcaster(NullTelegram(), rate=float('inf'))
+            try:
+                total = broadcaster.broadcast(
+                    strategy(session, index), 'Hi').total
+            finally:
+                broadcaster.close()
+        else:
+            total = sum(1 for _ in strategy(session, index))
+        elapsed = time.monotonic() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return total, peak, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, action='append',
+                        help='Number of subscribers, repeatable. '
+                        'Defaults to 100000 and 1000000.')
+    parser.add_argument('--send', action='store_true',
+                        help='Pass the chats through the Broadcaster with a '
+                        'no-op Telegram client.')
+    args = parser.parse_args(argv)
+
+    print('{:>10} {:<18} {:>12} {:>10}'.format(
+        'users', 'strategy', 'peak, MiB', 'time, s'))
+    for users in args.users or [100000, 1000000]:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(
+                'sqlite:///' + os.path.join(directory, 'bench.db'))
+            migrate(engine)
+            populate(engine, users)
+            Session = sqlalchemy.orm.sessionmaker(bind=engine)
+            index = SubscriberIndex()
+            with contextlib.closing(Session()) as session:
+                index.load(session)
+
+            for name, strategy in STRATEGIES:
+                total, peak, elapsed = measure(
+                    Session, index, strategy, args.send)
+                assert total == users
+                print('{:>10} {:<18} {:>12.1f} {:>10.2f}'.format(
+                    users, name, peak / 2 ** 20, elapsed))
+            engine.dispose()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+End-to-end load test of the bot.
+
+Runs the real Bot threads against a local stand-in of the VFS booking system
+which flips availability on a schedule and a fake Telegram API with many
+subscribers, latency and flood control errors. Reports detection latency,
+time to the last notification, delivery throughput and database queries.
+'''
+
+import argparse
+import collections
+import contextlib
+import datetime
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs
+
+import sqlalchemy
+import telegram
+
+from netherappbot.bot import Bot
+from netherappbot.models import AppointmentEvent, User
+from netherappbot.schedule import AdaptiveScheduler
+from netherappbot.scraper import NO_APPOINTMENTS, Target
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'netherappbot', 'tests', 'fixtures')
+AVAILABLE = 'Please select a date for your appointment.'
+AVAILABLE_TEXT = 'available'
+GONE_TEXT = 'gone'
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'), encoding='utf-8') as f:
+        return f.read()
+
+
+class _VfsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond(self.server.vfs.pages['welcome'])
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if data.get('__EVENTTARGET', [''])[0]:
+            self.respond(self.server.vfs.pages['appointment_type'])
+        else:
+            self.respond(self.server.vfs.application_page())
+
+    def respond(self, text):
+        vfs = self.server.vfs
+        if vfs.latency:
+            time.sleep(vfs.latency)
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with vfs.lock:
+            vfs.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeVfs(object):
+    '''Serves the recorded pages and flips availability every `flip_every`.
+
+    Availability is a pure function of time, flips are recorded in UTC to
+    compare them with event timestamps.
+    '''
+
+    def __init__(self, flip_every, latency=0.0):
+        super(FakeVfs, self).__init__()
+        self.flip_every = flip_every
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.pages = {
+            name: load_fixture(name)
+            for name in ('welcome', 'appointment_type', 'application')
+        }
+        self.available_page = self.pages['application'].replace(
+            NO_APPOINTMENTS, AVAILABLE)
+        self.httpd = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _VfsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.vfs = self
+        self.started = None
+
+    @property
+    def welcome_page(self):
+        return 'http://{}:{}/AppWelcome.aspx?P=loadtest'.format(
+            *self.httpd.server_address)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.started_at = datetime.datetime.utcnow()
+        threading.Thread(
+            target=self.httpd.serve_forever, name='FakeVfs',
+            daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def available(self):
+        elapsed = time.monotonic() - self.started
+        return int(elapsed // self.flip_every) % 2 == 1
+
+    def application_page(self):
+        return (self.available_page if self.available()
+                else self.pages['application'])
+
+    def flips(self, until):
+        '''UTC times when availability changed, with the new state.'''
+        result = []
+        number = 1
+        while True:
+            at = self.started_at + datetime.timedelta(
+                seconds=number * self.flip_every)
+            if at > until:
+                return result
+            result.append((at, number % 2 == 1))
+            number += 1
+
+
+class FakeTelegram(object):
+    '''Telegram API stand-in: records sends, adds latency and 429s.'''
+
+    def __init__(self, latency=0.0, flood_rate=0.0, retry_after=1):
+        super(FakeTelegram, self).__init__()
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.sent = []
+        self.floods = 0
+        self.random = random.Random(2019)
+
+    def get_updates(self, offset=None, timeout=None):
+        time.sleep(min(timeout or 0, 0.5))
+        return []
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.random.random() < self.flood_rate:
+                self.floods += 1
+                raise telegram.error.RetryAfter(self.retry_after)
+            self.sent.append((datetime.datetime.utcnow(), chat_id, text))
+
+    def set_webhook(self, url=None):
+        pass
+
+    def delete_webhook(self):
+        pass
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.0
+        sqlalchemy.event.listen(
+            engine, 'before_cursor_execute', self.before_execute)
+        sqlalchemy.event.listen(
+            engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('query_started', []).append(time.monotonic())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        elapsed = time.monotonic() - conn.info['query_started'].pop()
+        with self.lock:
+            self.count += 1
+            self.seconds += elapsed
+
+
+def add_subscribers(bot, count):
+    with contextlib.closing(bot.Session()) as session:
+        session.execute(User.__table__.insert(), [
+            {'chat_id': chat_id, 'subscribed': True}
+            for chat_id in range(1, count + 1)
+        ])
+        session.commit()
+        bot.subscribers.load(session)
+
+
+def analyze(vfs, client, events, subscribers, finished):
+    '''Matches availability flips with events and deliveries.'''
+    results = []
+    sends = collections.defaultdict(list)
+    with client.lock:
+        for at, chat_id, text in client.sent:
+            sends[AVAILABLE_TEXT if 'GO GET THEM' in text else
+                  GONE_TEXT].append(at)
+
+    for at, available in vfs.flips(finished):
+        event = next((
+            event for event in events
+            if event[0] >= at and event[1] == available), None)
+        if event is None:
+            continue
+        kind = AVAILABLE_TEXT if available else GONE_TEXT
+        delivered = [
+            sent for sent in sends[kind] if sent >= event[0]][:subscribers]
+        results.append({
+            'available': available,
+            'detection': (event[0] - at).total_seconds(),
+            'first_notification': (
+                (delivered[0] - at).total_seconds() if delivered else None),
+            'last_notification': (
+                (delivered[-1] - at).total_seconds()
+                if len(delivered) == subscribers else None),
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subscribers', type=int, default=300)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to run.')
+    parser.add_argument('--flip-every', type=float, default=10,
+                        help='Seconds between availability changes.')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='Polling interval of the bot.')
+    parser.add_argument('--vfs-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--flood-rate', type=float, default=0.001,
+                        help='Probability of a 429 on every send.')
+    parser.add_argument('--delivery-workers', type=int, default=8)
+    parser.add_argument('--delivery-rate', type=float, default=1000)
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON.')
+    args = parser.parse_args(argv)
+
+    vfs = FakeVfs(args.flip_every, latency=args.vfs_latency)
+    client = FakeTelegram(
+        latency=args.telegram_latency, flood_rate=args.flood_rate)
+    vfs.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        bot = Bot(
+            client, 'sqlite:///' + os.path.join(directory, 'bot.db'),
+            targets=[Target(898, 1, vfs.welcome_page)],
+            delivery_workers=args.delivery_workers,
+            delivery_rate=args.delivery_rate,
+            # Every flip of the fake site must become an event.
+            debounce=datetime.timedelta(0),
+            scheduler=AdaptiveScheduler(
+                args.interval, adaptive=False, jitter=0))
+        add_subscribers(bot, args.subscribers)
+        queries = QueryCounter(bot.engine)
+
+        threads = [
+            threading.Thread(target=loop, name=loop.__name__)
+            for loop in (
+                bot.interactive_loop, bot.notification_loop,
+                bot.watching_loop)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        bot.shutdown = True
+        bot.new_events.set()
+        for thread in threads:
+            thread.join()
+        finished = datetime.datetime.utcnow()
+        bot.scrapers.close()
+        bot.broadcaster.close()
+        vfs.stop()
+
+        with contextlib.closing(bot.Session()) as session:
+            events = session.query(
+                AppointmentEvent.timestamp,
+                AppointmentEvent.have_appointments).order_by(
+                    AppointmentEvent.timestamp).all()
+        bot.engine.dispose()
+
+    flips = analyze(vfs, client, events, args.subscribers, finished)
+    report = {
+        'flips': flips,
+        'vfs_requests': vfs.requests,
+        'messages': len(client.sent),
+        'messages_per_second': len(client.sent) / args.duration,
+        'flood_errors': client.floods,
+        'db_queries': queries.count,
+        'db_seconds': queries.seconds,
+    }
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0
+
+    def seconds(value):
+        return '-' if value is None else '{:.3f}'.format(value)
+
+    print('{:<10} {:>10} {:>15} {:>15}'.format(
+        'flip', 'detect, s', 'first msg, s', 'last msg, s'))
+    for flip in flips:
+        print('{:<10} {:>10} {:>15} {:>15}'.format(
+            'available' if flip['available'] else 'gone',
+            seconds(flip['detection']),
+            seconds(flip['first_notification']),
+            seconds(flip['last_notification'])))
+    print()
+    print('VFS requests:       {}'.format(report['vfs_requests']))
+    print('Messages sent:      {} ({:.1f}/s, {} flood errors)'.format(
+        report['messages'], report['messages_per_second'],
+        report['flood_errors']))
+    print('DB queries:         {} ({:.3f} s total)'.format(
+        report['db_queries'], report['db_seconds']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Compares HTML extraction backends on the recorded VFS pages.
+'''
+
+import argparse
+import os
+import sys
+import timeit
+
+from netherappbot.extract import BACKENDS
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'netherappbot', 'tests', 'fixtures')
+PAGES = ('welcome', 'appointment_type', 'application')
+
+
+def load_pages():
+    pages = {}
+    for name in PAGES:
+        path = os.path.join(FIXTURES, name + '.html')
+        with open(path, encoding='utf-8') as f:
+            pages[name] = f.read()
+    return pages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=50,
+                        help='Parses of every page per measurement.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of measurements, the best one wins.')
+    args = parser.parse_args(argv)
+
+    pages = load_pages()
+    extractors = {name: backend() for name, backend in BACKENDS.items()}
+    reference = {
+        page: extractors['soup'].extract(html)
+        for page, html in pages.items()
+    }
+
+    failed = False
+    print('{:<10} {:<18} {:>10} {:>8}'.format(
+        'backend', 'page', 'ms/parse', 'speedup'))
+    baseline = {}
+    for name, extractor in extractors.items():
+        for page, html in pages.items():
+            if extractor.extract(html) != reference[page]:
+                print('{}: {} differs from the reference'.format(name, page))
+                failed = True
+                continue
+            best = min(timeit.repeat(
+                lambda: extractor.extract(html),
+                number=args.number, repeat=args.repeat)) / args.number
+            baseline.setdefault(page, best)
+            print('{:<10} {:<18} {:>10.3f} {:>7.1f}x'.format(
+                name, page, best * 1000, baseline[page] / best))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
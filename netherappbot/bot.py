@@ -6,27 +6,48 @@ The implementaiton of the bot.
 
 import logging
 import argparse
+import concurrent.futures
 import datetime
 import contextlib
 import textwrap
 import functools
+import itertools
 import threading
 import time
 import re
-from urllib.parse import urljoin
 
 import inflect
 import telegram
 import sqlalchemy
-import requests
-from bs4 import BeautifulSoup
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, DateTime, Boolean
 import sentry_sdk
 from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 from sentry_sdk.integrations.threading import ThreadingIntegration
 
-Base = declarative_base()
+from .scraper import (
+    WELCOME_PAGE, TRANSIENT_ERRORS, CYCLE_DEADLINE,
+    DEFAULT_TARGET, Target, ScrapingPool)
+from .extract import BACKENDS as PARSERS
+from .delivery import TELEGRAM_RATE, Broadcaster
+from .dispatch import ChatDispatcher
+from .logs import RATE as LOG_RATE, SAMPLING, LogPipeline, parse_sampling
+from .database import create_engine, migrate
+from .models import (
+    LastUpdate, User, Subscription, AppointmentEvent, Statistics,
+    DeliveryMarker)
+from .shards import CHANNEL_SHARD, ShardPool
+from .outbox import BACKOFF, CHANNEL_CHAT_ID, MAX_ATTEMPTS, Outbox
+from .lease import LeaderLease
+from .subscribers import (
+    CHANNEL, FilterIndex, SubscriberIndex, merge_unique)
+from .rollups import RETENTION, compact
+from .hedging import ResultMerger
+from .slots import DEBOUNCE, SlotTracker, decode_dates, encode_dates
+from .schedule import AdaptiveScheduler
+from .webhook import WebhookServer, secret_path
+from .metrics import (
+    FANOUT_SECONDS, LOOP_SECONDS, POLLING_INTERVAL, QUEUE_DEPTH, MetricsServer,
+    instrument_engine)
+
 p = inflect.engine()
 
 BOT_TOKEN_RE = re.compile(r'[0-9]+:[A-Za-z0-9+/=]+')
@@ -56,35 +77,19 @@ sentry_sdk.init(
 )
 
 
-class LastUpdate(Base):
-    __tablename__ = 'last_update'
-    id = Column(Integer, primary_key=True)
-    update_id = Column(Integer)
-
-
-class User(Base):
-    __tablename__ = 'users'
-
-    id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, unique=True)
-    subscribed = Column(Boolean)
-
-
-class AppointmentEvent(Base):
-    __tablename__ = 'events'
-
-    id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime)
-    have_appointments = Column(Boolean)
-    notification_sent = Column(Boolean)
-
-
-BASE_URL = ('https://www.vfsvisaonline.com/'
-            'Netherlands-Global-Online-Appointment_Zone2/AppScheduling/')
-WELCOME_PAGE = (
-    BASE_URL +
-    'AppWelcome.aspx?P=yLSZQO8Ad673EXhKOPALC%2Fa6TdN5o6wQfJGZex2bh88%3D')
 INTERVAL = 5
+# Safety net for events written before a crash. New events wake the notifier
+# up immediately.
+NOTIFICATION_POLL_INTERVAL = 30
+# How often the coordinator checks delivery shards for completion.
+SHARD_COORDINATION_INTERVAL = 1
+COMPACTION_INTERVAL = 60 * 60
+# How often a standby refreshes the sessions of its scrapers.
+WARM_UP_INTERVAL = 5 * 60
+# How long loops of a standby wait for a takeover before checking again.
+STANDBY_POLL_INTERVAL = 1
+# Keeps the number of bound parameters below SQLite's limit.
+SQL_CHUNK_SIZE = 500
 
 LICENSE = '''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
 
@@ -123,13 +128,13 @@ POSSIBILITY OF SUCH DAMAGE.
 class TEXTS(object):
     GREETINGS = textwrap.dedent('''\
         Hi! I look for appointments to the Netherlands embassy in Dublin.
-        I check [this page]({}) each *{}* seconds.
+        I check [this page]({}) each *{}* seconds on average.
 
         You can subscribe to notifications with /subscribe command.
         Feel free to check /help and /terms.''').format(WELCOME_PAGE, INTERVAL)
     HELP = textwrap.dedent('''\
         I look for appointments to the Netherlands embassy in Dublin.
-        I check [this page]({}) each *{}* seconds.
+        I check [this page]({}) each *{}* seconds on average.
 
         *Available commands*
 
@@ -138,6 +143,12 @@ class TEXTS(object):
         /terms - Information about terms of use and collected data.
         /subscribe - Subscribe for notifications. I will send you a message \
 when I see an appointment.
+        /subscribe direct - Get notifications here even if they are posted \
+to a channel.
+        /watch CATEGORY APPLICANTS [FROM [TO]] - Only notify about this visa \
+category and number of applicants, optionally between YYYY-MM-DD dates.
+        /unwatch [CATEGORY APPLICANTS] - Remove one or all of the filters.
+        /filters - Show your filters.
         /stats - Show some statstics data.
         /unsubscribe - Unsubscribe for notifications.''').format(
             WELCOME_PAGE, INTERVAL)
@@ -170,6 +181,11 @@ Dublin.*
 mobile devices on the side of the embassy's booking system. Use a PC/laptop \
 when possible.
         You can disable notifications with /unsubscribe command.''')
+    SUBSCRIBED_CHANNEL = textwrap.dedent('''\
+        *Notifications about appointments are posted to {channel}, join it \
+to get them as soon as possible.*
+        If you'd rather get them here, use /subscribe direct command.
+        You can disable notifications with /unsubscribe command.''')
     UNSUBSCRIBED = textwrap.dedent('''\
         Ok, I will not send you notifications anymore.
         Feel free to subscribe again with /subscribe command.''')
@@ -180,18 +196,45 @@ when possible.
         Sorry, I don't understand your message.
         Use /help for the list of available commands.''')
     APPOINTMENTS_AVAILABLE = (
-        '*Psst! Looks like there are some appointments available:* '
-        '[GO GET THEM]({})').format(WELCOME_PAGE)
+        '*Psst! Looks like there are some appointments available* '
+        '(visa category {visa_category}, {applicants_plural}): '
+        '[GO GET THEM]({welcome_page})')
+    NEW_DATES = '\nNew dates: {dates}.'
     NO_MORE_APPOINTMENTS = textwrap.dedent('''\
-        *I don\'t see appointments anymore.*
+        *I don\'t see appointments anymore* \
+(visa category {visa_category}, {applicants_plural}).
         Will notify when see them again.''')
+    WATCH_USAGE = textwrap.dedent('''\
+        Usage: /watch CATEGORY APPLICANTS [FROM [TO]]
+        For example: /watch 898 2 2019-11-01 2019-12-15''')
+    UNWATCH_USAGE = 'Usage: /unwatch [CATEGORY APPLICANTS]'
+    UNKNOWN_TARGET = textwrap.dedent('''\
+        Sorry, I don't watch visa category {visa_category} for \
+{applicants_plural}.
+        I watch: {targets}.''')
+    WATCHING = textwrap.dedent('''\
+        *I will notify you about visa category {visa_category} for \
+{applicants_plural}{dates}.*
+        See your filters with /filters.''')
+    UNWATCHED = 'Ok, I removed {count_plural}.'
+    NO_FILTERS = textwrap.dedent('''\
+        You have no filters.
+        Add one with /watch command.''')
+    FILTERS = '*Your filters*\n\n{filters}'
+    FILTER = ' - visa category {visa_category}, {applicants_plural}{dates}'
     STATISTICS = textwrap.dedent('''\
         I've been watching for *{watching_for}*.
         I've seen appointments for *{seen_appointments}*.
         There {users_plural} watching for notifications.''')
 
 
-def loop(interval, ignore=()):
+def loop(interval, ignore=(), wakeup=None):
+    '''Runs the method until shutdown.
+
+    `interval` is either a number of seconds or a callable which receives
+    `self` and returns it. `wakeup` names a `threading.Event` attribute of
+    `self` which ends the sleep early when set.
+    '''
     def decorator(f):
         @functools.wraps(f)
         def wrapper(self):
@@ -200,8 +243,9 @@ def loop(interval, ignore=()):
                     if ignore:
                         with contextlib.closing(self.Session()) as session:
                             try:
-                                f(self, session)
-                                session.commit()
+                                with LOOP_SECONDS.labels(f.__name__).time():
+                                    f(self, session)
+                                    session.commit()
                             except ignore:
                                 self.logger.warning(
                                     'Transient exception caught',
@@ -209,9 +253,17 @@ def loop(interval, ignore=()):
                                 continue
                     else:
                         with contextlib.closing(self.Session()) as session:
-                            f(self, session)
-                            session.commit()
-                    time.sleep(interval)
+                            with LOOP_SECONDS.labels(f.__name__).time():
+                                f(self, session)
+                                session.commit()
+                    seconds = (
+                        interval(self) if callable(interval) else interval)
+                    if wakeup is None:
+                        time.sleep(seconds)
+                    else:
+                        event = getattr(self, wakeup)
+                        event.wait(seconds)
+                        event.clear()
             except KeyboardInterrupt:
                 pass
             finally:
@@ -223,133 +275,550 @@ def loop(interval, ignore=()):
 
 
 class Context(object):
-    def __init__(self, session, user):
+    def __init__(self, session, chat_id):
         self.session = session
-        self.user = user
+        self.chat_id = chat_id
 
 
 class Bot(object):
-    def __init__(self, bot, database):
+    def __init__(self, bot, database, targets=(DEFAULT_TARGET,),
+                 scrape_workers=None, delivery_workers=8,
+                 delivery_rate=TELEGRAM_RATE, parser=None,
+                 session_reuse=True, scheduler=None, webhook=None,
+                 shard_pool=None, retention=RETENTION, hedge=1,
+                 scrape_deadline=CYCLE_DEADLINE, debounce=DEBOUNCE,
+                 outbox=None, command_workers=1, lease=None, channel=None,
+                 channel_link=None):
         super(Bot, self).__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.bot = bot
-        self.engine = sqlalchemy.create_engine(database)
-        Base.metadata.create_all(self.engine)
+        self.engine = create_engine(database)
+        instrument_engine(self.engine)
+        migrate(self.engine)
         self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = requests.Session()
+        self.subscribers = SubscriberIndex()
+        self.subscribers.attach(self.Session)
+        self.filters = FilterIndex()
+        self.filters.attach(self.Session)
+        with contextlib.closing(self.Session()) as session:
+            if Statistics.get(session) is None:
+                Statistics.rebuild(session)
+                session.commit()
+            self.subscribers.load(session)
+            self.filters.load(session)
+            self.load_offset(session)
+        self.targets = {target.key: target for target in targets}
+        # Every lane has its own sessions and cookies.
+        self.lanes = [
+            ScrapingPool(
+                targets, workers=scrape_workers, parser=parser,
+                reuse=session_reuse, deadline=scrape_deadline)
+            for _ in range(hedge)
+        ]
+        self.scrapers = self.lanes[0]
+        self.lane_locks = [threading.Lock() for _ in self.lanes]
+        self.next_lane = 0
+        self.hedge_executor = None
+        if hedge > 1:
+            self.hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=hedge, thread_name_prefix='HedgedScraper')
+        self.merger = ResultMerger()
+        self.slots = SlotTracker(debounce)
+        self.scheduler = scheduler or AdaptiveScheduler(INTERVAL)
+        self.broadcaster = Broadcaster(
+            bot, workers=delivery_workers, rate=delivery_rate)
+        self.outbox = outbox or Outbox()
+        # Notifications go to the channel once and directly only to the
+        # rest of the audience.
+        self.channel = channel
+        self.channel_link = channel_link or channel
+        self.lease = lease
+        # Set while this replica is the leader. Without a lease it always is.
+        self.leading = threading.Event()
+        self.warmed_at = None
+        if lease is None:
+            if shard_pool is None:
+                with contextlib.closing(self.Session()) as session:
+                    self.outbox.release_claims(session)
+                    session.commit()
+            self.leading.set()
+        self.notification_delay = NOTIFICATION_POLL_INTERVAL
+        self.dispatcher = None
+        if command_workers > 1:
+            self.dispatcher = ChatDispatcher(command_workers)
+        self.webhook = webhook
+        # Update ID -> webhook update waiting to be processed.
+        self.webhook_updates = {}
+        self.shard_pool = shard_pool
+        POLLING_INTERVAL.set_function(
+            lambda: self.scheduler.current_interval)
+        if webhook is not None:
+            QUEUE_DEPTH.labels('webhook').set_function(webhook.queue.qsize)
+        self.retention = retention
+        self.new_events = threading.Event()
+        # Only ends the long sleep of the compaction loop on shutdown.
+        self.stopping = threading.Event()
         self.shutdown = False
 
-    @loop(0, ignore=(ConnectionError, telegram.error.NetworkError))
-    def interactive_loop(self, session):
+    def load_offset(self, session):
         last_update = session.query(LastUpdate).first()
-        if last_update is not None:
-            offset = last_update.update_id + 1
+        self.offset = (
+            last_update.update_id + 1 if last_update is not None else None)
+
+    def leader(self):
+        '''Returns whether this replica is the leader.'''
+        if self.lease is not None and not self.lease.held():
+            self.leading.clear()
+        return self.leading.is_set()
+
+    @loop(lambda self: self.lease.renew_interval,
+          ignore=(sqlalchemy.exc.OperationalError,))
+    def lease_loop(self, session):
+        if self.lease.acquire(session):
+            if not self.leading.is_set():
+                self.take_over(session)
         else:
-            offset = None
+            self.stand_by()
+
+    def take_over(self, session):
+        '''Reloads what the previous leader changed and starts leading.'''
+        self.logger.info('Acquired the lease as %s', self.lease.holder)
+        self.subscribers.load(session)
+        self.filters.load(session)
+        self.slots.reset()
+        self.load_offset(session)
+        if self.shard_pool is None:
+            # Claims of a crashed leader would otherwise wait for a
+            # timeout. A deposed one may still be sending its last batch.
+            self.outbox.release_claims(
+                session, holder=self.lease.holder,
+                before=self.lease.clock() - self.lease.ttl)
+        else:
+            self.shard_pool.start()
+        session.commit()
+        self.leading.set()
+        self.new_events.set()
+
+    def stand_by(self):
+        '''Stops the work which only the leader does.'''
+        if self.leading.is_set() or (
+                self.shard_pool is not None and self.shard_pool.running):
+            self.logger.warning('Lost the lease, standing by')
+        self.leading.clear()
+        if self.shard_pool is not None and self.shard_pool.running:
+            # Shards of the new leader take over the undelivered markers.
+            self.shard_pool.stop()
+
+    def warm_up(self):
+        '''Keeps scraper sessions of a standby alive.'''
+        now = time.monotonic()
+        if self.warmed_at is not None and \
+                now - self.warmed_at < WARM_UP_INTERVAL:
+            return
+        self.warmed_at = now
+        for lane in self.lanes:
+            lane.warm_up_all()
 
+    @loop(0, ignore=(ConnectionError, telegram.error.NetworkError))
+    def interactive_loop(self, session):
+        if not self.leader():
+            self.leading.wait(STANDBY_POLL_INTERVAL)
+            return
         try:
-            updates = self.bot.get_updates(offset, timeout=4)
+            updates = list(self.bot.get_updates(self.offset, timeout=4))
         except telegram.error.TimedOut:
             return
+        self.process_updates(session, updates)
 
-        for update in updates:
-            if not last_update:
-                last_update = LastUpdate(
-                    update_id=update.update_id)
-                session.add(last_update)
-                session.commit()
-            else:
-                last_update.update_id = update.update_id
-
-            if update.message is None:
+    @loop(0, ignore=(ConnectionError, telegram.error.NetworkError))
+    def webhook_loop(self, session):
+        if not self.leader():
+            self.leading.wait(STANDBY_POLL_INTERVAL)
+            return
+        # Telegram has been answered already, so updates are kept until
+        # they are processed.
+        updates = self.webhook_updates
+        for data in self.webhook.get_batch():
+            try:
+                update = telegram.Update.de_json(data, self.bot)
+            except Exception:
+                self.logger.warning('Malformed update: %r', data,
+                                    exc_info=True)
                 continue
+            if update is None:
+                continue
+            # Telegram may deliver an update more than once.
+            if self.offset is None or update.update_id >= self.offset:
+                updates.setdefault(update.update_id, update)
+        self.process_updates(session, [
+            updates[update_id] for update_id in sorted(updates)])
+        updates.clear()
+
+    def process_updates(self, session, updates):
+        if not updates:
+            return
 
-            self.on_message(session, update.message)
-
-    @loop(1)
+        messages = [
+            update.message for update in updates
+            if update.message is not None
+        ]
+        self.register_users(
+            session, {message.chat.id for message in messages})
+        if self.dispatcher is None:
+            for message in messages:
+                self.on_message(session, message)
+        else:
+            # Handlers run in sessions of their own and must see the users.
+            session.commit()
+            self.dispatcher.dispatch(messages, self.handle_message)
+
+        update_id = max(update.update_id for update in updates)
+        if not session.query(LastUpdate).update(
+                {LastUpdate.update_id: update_id},
+                synchronize_session=False):
+            session.add(LastUpdate(update_id=update_id))
+        session.commit()
+        self.offset = update_id + 1
+
+    def register_users(self, session, chat_ids):
+        '''Creates users for unknown chats with a single bulk insert.'''
+        missing = [
+            chat_id for chat_id in chat_ids
+            if self.subscribers.get(session, chat_id) is None
+        ]
+        if not missing:
+            return
+        session.execute(User.__table__.insert(), [
+            {'chat_id': chat_id, 'subscribed': False}
+            for chat_id in missing
+        ])
+        for chat_id in missing:
+            self.subscribers.set(session, chat_id, False)
+
+    @loop(lambda self: self.notification_delay, wakeup='new_events')
     def notification_loop(self, session):
-        event = session.query(AppointmentEvent).filter(
-            AppointmentEvent.notification_sent == False).first()  # noqa: E712
-        if event is None:
+        '''Queues pending events in the outbox and sends a batch of it.'''
+        if not self.leader():
+            self.notification_delay = NOTIFICATION_POLL_INTERVAL
             return
-
+        now = datetime.datetime.utcnow()
+        for event in session.query(AppointmentEvent).filter(
+                AppointmentEvent.notification_sent == False  # noqa: E712
+        ).order_by(AppointmentEvent.id).all():
+            if self.outbox.enqueued(session, event.id):
+                continue
+            recipients = self.recipients(event)
+            if self.channel is not None:
+                # The post is retried on its own, direct recipients don't
+                # wait for it.
+                recipients = itertools.chain([CHANNEL_CHAT_ID], recipients)
+            count = self.outbox.enqueue(session, event.id, recipients)
+            if not count:
+                event.notification_sent = True
+            self.logger.info(
+                'Notification %d queued for %d users, delay before fan-out: '
+                '%.3f s', event.id, count,
+                (now - event.timestamp).total_seconds())
+            session.commit()
+
+        messages = self.outbox.claim(
+            session, now,
+            holder=self.lease.holder if self.lease is not None else None)
+        session.commit()
+        texts = {}
+        for event_id, group in itertools.groupby(
+                messages, key=lambda message: message.event_id):
+            group = list(group)
+            if event_id not in texts:
+                texts[event_id] = self.notification_text(
+                    session.query(AppointmentEvent).get(event_id))
+            posts = [
+                message for message in group
+                if message.chat_id == CHANNEL_CHAT_ID]
+            if posts:
+                self.outbox.finish(
+                    session, posts,
+                    self.post_to_channel(event_id, texts[event_id]),
+                    datetime.datetime.utcnow())
+                session.commit()
+                group = [
+                    message for message in group
+                    if message.chat_id != CHANNEL_CHAT_ID]
+                if not group:
+                    continue
+            report = self.broadcaster.broadcast(
+                [message.chat_id for message in group], texts[event_id])
+            self.outbox.finish(
+                session, group, report, datetime.datetime.utcnow())
+            self.delete_users(session, report.unauthorized)
+            session.commit()
+
+        for completion in self.outbox.complete(session):
+            self.logger.info(
+                'Notification %d delivered to %d users, %d failed, '
+                'last delivery after %.3f s',
+                completion.event.id, completion.sent, completion.failed,
+                completion.elapsed or 0)
+        if messages:
+            # There may be more due messages, check again right away.
+            self.notification_delay = 0
+            return
+        next_attempt = self.outbox.next_attempt(session)
+        self.notification_delay = NOTIFICATION_POLL_INTERVAL
+        if next_attempt is not None:
+            self.notification_delay = max(0, min(
+                self.notification_delay,
+                (next_attempt - datetime.datetime.utcnow()).total_seconds()))
+
+    def event_target(self, event):
+        return self.targets.get(event.target) or Target.parse(event.target)
+
+    def recipients(self, event):
+        '''Yields chats to notify about the event, in order.
+
+        Subscribers get every notification, other chats only those matching
+        one of their filters. Date filters apply to new dates.
+        '''
+        target = self.event_target(event)
+        direct = self.channel is not None
+        return merge_unique(
+            itertools.chain.from_iterable(
+                self.subscribers.iter_chunks(direct=direct)),
+            [
+                chat_id for chat_id in self.filters.match(
+                    (target.visa_category, target.applicants),
+                    decode_dates(event.slots) or None)
+                if not direct or not self.subscribers.in_channel(chat_id)
+            ])
+
+    def post_to_channel(self, event_id, text):
+        '''Posts a notification to the channel.
+
+        Returns the `DeliveryReport` with the channel as CHANNEL_CHAT_ID.
+        '''
+        report = self.broadcaster.broadcast([self.channel], text)
+        if report.sent:
+            self.logger.info(
+                'Notification %d posted to %s in %.3f s', event_id,
+                self.channel, report.elapsed)
+        else:
+            self.logger.warning(
+                'Failed to post notification %d to %s', event_id,
+                self.channel)
+        return report._replace(
+            unauthorized=[CHANNEL_CHAT_ID] * len(report.unauthorized),
+            undelivered=[CHANNEL_CHAT_ID] * len(report.undelivered))
+
+    def post_channel_marker(self, marker, now):
+        '''Posts to the channel for the coordinator, with backoff.'''
+        if marker.claimed_at is not None and \
+                now < marker.claimed_at + BACKOFF * 2 ** (marker.failed - 1):
+            return
+        report = self.post_to_channel(marker.event_id, marker.text)
+        marker.claimed_at = now
+        if report.sent:
+            marker.sent = 1
+        else:
+            marker.failed += 1
+            if not report.unauthorized and marker.failed < MAX_ATTEMPTS:
+                return
+        marker.status = DeliveryMarker.DONE
+        marker.finished_at = datetime.datetime.utcnow()
+
+    def notification_text(self, event):
+        target = self.event_target(event)
         text = (TEXTS.APPOINTMENTS_AVAILABLE
                 if event.have_appointments else TEXTS.NO_MORE_APPOINTMENTS)
-
-        for user in session.query(User).filter(
-                User.subscribed == True).all():  # noqa: E712
-            context = Context(session, user)
-            self.reply(context, text)
-
-        event.notification_sent = True
-
-    def load_page(self, stage, url, method='GET', data=None):
-        logging.info('%s: %s %s -> %r', stage, method, url, data)
-        response = self.session.request(method, url, data=data)
-
-        if response.status_code >= 200 and response.status_code < 300:
-            return BeautifulSoup(response.text, 'html.parser')
-
-        return None
-
-    def extract_form_data(self, soup):
-        frm_web = soup.find(id='frmWeb')
-        args = {
-            input_tag.get('name'): input_tag.get('value')
-            for input_tag in frm_web.find_all('input')
-            if input_tag.get('name') not in {
-                'ctl00$plhMain$btnCancel', 'ctl00$plhMain$btnBack'}
-        }
-        return urljoin(BASE_URL, frm_web.get('action')), args
-
-    @loop(INTERVAL, ignore=(requests.exceptions.ConnectionError, TimeoutError))
-    def watching_loop(self, session):
-        soup = self.load_page('welcome', WELCOME_PAGE)
-        if soup is None:
+        text = text.format(
+            visa_category=target.visa_category,
+            applicants_plural=p.no('applicant', target.applicants),
+            welcome_page=target.welcome_page)
+        dates = decode_dates(event.slots)
+        if dates:
+            text += TEXTS.NEW_DATES.format(dates=', '.join(
+                date.strftime('%d %b %Y') for date in dates))
+        return text
+
+    @loop(SHARD_COORDINATION_INTERVAL, wakeup='new_events')
+    def shard_coordinator_loop(self, session):
+        '''Hands pending events to delivery shards and tracks them.'''
+        if not self.leader():
             return
-
-        action, args = self.extract_form_data(soup)
-        args['__EVENTTARGET'] = 'ctl00$plhMain$lnkSchApp'
-        args['__EVENTARGUMENT'] = ''
-
-        soup = self.load_page(
-            'appointment_type', action, method='POST', data=args)
-        if soup is None:
+        self.shard_pool.ensure_alive()
+        now = datetime.datetime.utcnow()
+        created = False
+        completed = False
+        for event in session.query(AppointmentEvent).filter(
+                AppointmentEvent.notification_sent == False  # noqa: E712
+        ).order_by(AppointmentEvent.id).all():
+            markers = session.query(DeliveryMarker).filter(
+                DeliveryMarker.event_id == event.id).all()
+            if not markers:
+                text = self.notification_text(event)
+                markers = [
+                    DeliveryMarker(event_id=event.id, shard=shard, text=text)
+                    for shard in range(self.shard_pool.shards)
+                ]
+                if self.channel is not None:
+                    # Workers never claim it, so shards don't wait for it.
+                    markers.insert(0, DeliveryMarker(
+                        event_id=event.id, shard=CHANNEL_SHARD, text=text,
+                        sent=0, failed=0))
+                session.add_all(markers)
+                created = True
+            for marker in markers:
+                if marker.shard == CHANNEL_SHARD and \
+                        marker.status != DeliveryMarker.DONE:
+                    self.post_channel_marker(marker, now)
+            if all(marker.status == DeliveryMarker.DONE
+                   for marker in markers):
+                elapsed = (max(
+                    marker.finished_at for marker in markers
+                ) - event.timestamp).total_seconds()
+                FANOUT_SECONDS.observe(elapsed)
+                self.logger.info(
+                    'Notification %d delivered by all shards to %d users, '
+                    'last delivery after %.3f s',
+                    event.id, sum(marker.sent for marker in markers), elapsed)
+                event.notification_sent = True
+                completed = True
+
+        session.commit()
+        if created:
+            self.shard_pool.wake()
+        if completed:
+            # Shards delete users who blocked the bot.
+            self.subscribers.load(session)
+            self.filters.load(session)
+
+    @loop(lambda self: self.scheduler.next_interval() / len(self.lanes),
+          ignore=TRANSIENT_ERRORS)
+    def watching_loop(self, session):
+        '''Checks the targets, or hands the check to the next hedged lane.
+
+        With several lanes the loop ticks `len(self.lanes)` times per
+        interval and lanes take turns, so every session still polls once
+        per interval while the targets are sampled more often.
+        '''
+        self.scheduler.learn(session)
+        if not self.leader():
+            self.warm_up()
             return
-        action, args = self.extract_form_data(soup)
-        # Number of applicants: 1
-        args['ctl00$plhMain$tbxNumOfApplicants'] = 1
-        # Visa category: Touristic Schengen
-        args['ctl00$plhMain$cboVisaCategory'] = 898
-
-        soup = self.load_page('application', action, method='POST', data=args)
-
-        response_element = (
-            soup.find(id='plhMain_lblMsg') or
-            soup.find(id='plhMain_lblFillAppDetails'))
-        if response_element is None:
+        if self.hedge_executor is None:
+            self.watch(session, self.scrapers)
             return
 
-        response = response_element.string
-        logging.info('Response: %s', response)
+        lane = self.next_lane
+        self.next_lane = (lane + 1) % len(self.lanes)
+        if not self.lane_locks[lane].acquire(blocking=False):
+            self.logger.warning('Hedged lane %d is still busy, skipping', lane)
+            return
+        self.hedge_executor.submit(self.run_lane, lane)
 
-        last_event = session.query(AppointmentEvent).order_by(
-            AppointmentEvent.timestamp.desc()).limit(1).first()
-        if last_event is None:
-            previous_result = False
+    def run_lane(self, lane):
+        try:
+            with contextlib.closing(self.Session()) as session:
+                with LOOP_SECONDS.labels('hedged_lane').time():
+                    self.watch(session, self.lanes[lane])
+                    session.commit()
+        except TRANSIENT_ERRORS:
+            self.logger.warning(
+                'Transient exception caught in lane %d', lane, exc_info=True)
+        except Exception:
+            self.logger.exception('Hedged lane %d failed', lane)
+        finally:
+            self.lane_locks[lane].release()
+
+    def watch(self, session, scrapers):
+        started = time.monotonic()
+        succeeded = False
+        for target, result in scrapers.check_all():
+            if result is not None:
+                succeeded = True
+                self.merger.merge(target.key, started, functools.partial(
+                    self.record_result, session, target, result))
+
+        if succeeded:
+            self.scheduler.record_success()
         else:
-            previous_result = last_event.have_appointments
-
-        have_appointments = (
-            response != 'No date(s) available for appointment.')
-        if last_event is None or have_appointments != previous_result:
-            event = AppointmentEvent(
-                have_appointments=have_appointments,
-                # Don't sent notification if it's first check and
-                # we have no appointments.
-                notification_sent=have_appointments == previous_result,
-                timestamp=datetime.datetime.utcnow())
-            session.add(event)
+            self.scheduler.record_failure()
+
+    def record_result(self, session, target, result):
+        '''Records an event if the result has new slots or none are left.
+
+        Returns whether an event was recorded.
+        '''
+        if not self.leader():
+            # The lease lapsed during the check, the new leader records the
+            # change instead.
+            self.logger.warning(
+                'Lost the lease while checking %s, dropping the result',
+                target.key)
+            return False
+        now = datetime.datetime.utcnow()
+        if not self.slots.known(target.key):
+            last_event = session.query(AppointmentEvent).filter(
+                AppointmentEvent.target == target.key).order_by(
+                    AppointmentEvent.timestamp.desc()).limit(1).first()
+            if last_event is None and not result.available:
+                # Nothing to notify about, but the watch has started.
+                self.record_event(session, target, False, False, now,
+                                  notification_sent=True)
+                session.commit()
+                self.slots.commit(target.key, {})
+                return True
+            self.slots.seed(
+                target.key,
+                last_event is not None and last_event.have_appointments, now)
+
+        previous_result = bool(self.slots.states[target.key])
+        change, state = self.slots.diff(
+            target.key, result.available, result.dates, now)
+        if change is not None:
+            have_appointments, dates = change
+            self.record_event(
+                session, target, have_appointments, previous_result, now,
+                dates)
+            # The notifier must see the event when it wakes up.
+            session.commit()
+            self.new_events.set()
+        self.slots.commit(target.key, state)
+        return change is not None
+
+    def record_event(self, session, target, have_appointments,
+                     previous_result, timestamp, dates=(),
+                     notification_sent=False):
+        event = AppointmentEvent(
+            target=target.key,
+            have_appointments=have_appointments,
+            slots=encode_dates(dates),
+            notification_sent=notification_sent,
+            timestamp=timestamp)
+        session.add(event)
+        Statistics.get(session).record_event(
+            timestamp, have_appointments, previous_result)
+        return event
+
+    def close_scrapers(self):
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=True)
+        for scrapers in self.lanes:
+            scrapers.close()
+
+    @loop(COMPACTION_INTERVAL, wakeup='stopping')
+    def compaction_loop(self, session):
+        if not self.leader():
+            return
+        deleted = compact(session, retention=self.retention)
+        if deleted:
+            self.logger.info(
+                'Rolled up and deleted %d events older than %s', deleted,
+                self.retention)
+
+    def handle_message(self, message):
+        with contextlib.closing(self.Session()) as session:
+            self.on_message(session, message)
+            session.commit()
 
     def on_message(self, session, message):
         text = message.text
@@ -361,12 +830,8 @@ class Bot(object):
 
             self.logger.info('<== %d: %s', chat_id, text)
 
-            user = session.query(User).filter(User.chat_id == chat_id).first()
-            if user is None:
-                user = User(chat_id=chat_id, subscribed=False)
-                session.add(user)
-
-            context = Context(session, user)
+            self.register_users(session, [chat_id])
+            context = Context(session, chat_id)
 
             if text.startswith('/'):
                 self.on_command(context, text)
@@ -385,6 +850,12 @@ class Bot(object):
             self.on_subscribe(context, message)
         elif '/unsubscribe' == command:
             self.on_unsubscribe(context, message)
+        elif '/watch' == command:
+            self.on_watch(context, message)
+        elif '/unwatch' == command:
+            self.on_unwatch(context, message)
+        elif '/filters' == command:
+            self.on_filters(context, message)
         elif '/stats' == command:
             self.on_stats(context, message)
         else:
@@ -400,42 +871,148 @@ class Bot(object):
         self.reply(context, TEXTS.TERMS)
 
     def on_subscribe(self, context, message):
-        context.user.subscribed = True
+        if self.channel is not None and message.split()[1:] != ['direct']:
+            self.set_subscribed(context, CHANNEL)
+            self.logger.info(
+                'Subscribing user with chat_id %d to the channel',
+                context.chat_id)
+            self.reply(context, TEXTS.SUBSCRIBED_CHANNEL.format(
+                channel=self.channel_link))
+            return
+        self.set_subscribed(context, True)
         self.logger.info(
-            'Subscribing user with chat_id: %d', context.user.chat_id)
+            'Subscribing user with chat_id: %d', context.chat_id)
         self.reply(context, TEXTS.SUBSCRIBED)
 
     def on_unsubscribe(self, context, message):
-        context.user.subscribed = False
+        self.set_subscribed(context, False)
+        self.remove_filters(context)
         self.logger.info(
-            'Unsubscribing user with chat_id: %d', context.user.chat_id)
+            'Unsubscribing user with chat_id: %d', context.chat_id)
         self.reply(context, TEXTS.UNSUBSCRIBED)
 
+    def set_subscribed(self, context, subscribed):
+        '''Sets True, False or `CHANNEL` subscription status.'''
+        was = self.subscribers.get(context.session, context.chat_id) or False
+        if was == subscribed:
+            return
+        if bool(was) != bool(subscribed):
+            Statistics.add_subscribers(
+                context.session, 1 if subscribed else -1)
+        context.session.query(User).filter(
+            User.chat_id == context.chat_id).update({
+                User.subscribed: bool(subscribed),
+                User.channel: subscribed == CHANNEL,
+            }, synchronize_session=False)
+        self.subscribers.set(context.session, context.chat_id, subscribed)
+
+    def watched_keys(self):
+        return sorted({
+            (target.visa_category, target.applicants)
+            for target in self.targets.values()
+        })
+
+    def on_watch(self, context, message):
+        args = message.split()[1:]
+        try:
+            if not 2 <= len(args) <= 4:
+                raise ValueError('Wrong number of arguments')
+            key = (int(args[0]), int(args[1]))
+            dates = tuple(
+                datetime.datetime.strptime(arg, '%Y-%m-%d').date()
+                for arg in args[2:]) + (None,) * (4 - len(args))
+            if None not in dates and dates[0] > dates[1]:
+                raise ValueError('Empty date range')
+        except ValueError:
+            self.reply(context, TEXTS.WATCH_USAGE)
+            return
+
+        if key not in self.watched_keys():
+            self.reply(context, TEXTS.UNKNOWN_TARGET.format(
+                visa_category=key[0],
+                applicants_plural=p.no('applicant', key[1]),
+                targets=', '.join(
+                    '{} for {}'.format(
+                        visa_category, p.no('applicant', applicants))
+                    for visa_category, applicants in self.watched_keys())))
+            return
+
+        subscription = context.session.query(Subscription).filter(
+            Subscription.chat_id == context.chat_id,
+            Subscription.visa_category == key[0],
+            Subscription.applicants == key[1]).first()
+        if subscription is None:
+            subscription = Subscription(
+                chat_id=context.chat_id, visa_category=key[0],
+                applicants=key[1])
+            context.session.add(subscription)
+        subscription.date_from, subscription.date_to = dates
+        self.filters.set(context.session, context.chat_id, key, dates)
+        self.logger.info(
+            'User with chat_id %d watches %s', context.chat_id, key)
+        self.reply(context, TEXTS.WATCHING.format(
+            **self.filter_arguments(key, dates)))
+
+    def on_unwatch(self, context, message):
+        args = message.split()[1:]
+        if not args:
+            count = self.remove_filters(context)
+        else:
+            try:
+                if len(args) != 2:
+                    raise ValueError('Wrong number of arguments')
+                key = (int(args[0]), int(args[1]))
+            except ValueError:
+                self.reply(context, TEXTS.UNWATCH_USAGE)
+                return
+            count = context.session.query(Subscription).filter(
+                Subscription.chat_id == context.chat_id,
+                Subscription.visa_category == key[0],
+                Subscription.applicants == key[1]).delete(
+                    synchronize_session=False)
+            self.filters.set(context.session, context.chat_id, key, None)
+        self.reply(context, TEXTS.UNWATCHED.format(
+            count_plural=p.no('filter', count)))
+
+    def on_filters(self, context, message):
+        filters = self.filters.get(context.session, context.chat_id)
+        if not filters:
+            self.reply(context, TEXTS.NO_FILTERS)
+            return
+        self.reply(context, TEXTS.FILTERS.format(filters='\n'.join(
+            TEXTS.FILTER.format(**self.filter_arguments(key, dates))
+            for key, dates in sorted(filters.items()))))
+
+    def filter_arguments(self, key, dates):
+        date_from, date_to = dates
+        if date_from is None and date_to is None:
+            date_range = ''
+        elif date_to is None:
+            date_range = ' from {}'.format(date_from)
+        else:
+            date_range = ' from {} to {}'.format(
+                date_from or 'now', date_to)
+        return dict(
+            visa_category=key[0],
+            applicants_plural=p.no('applicant', key[1]),
+            dates=date_range)
+
+    def remove_filters(self, context):
+        self.filters.remove(context.session, context.chat_id)
+        return context.session.query(Subscription).filter(
+            Subscription.chat_id == context.chat_id).delete(
+                synchronize_session=False)
+
     def on_stats(self, context, message):
-        subscribed_users = context.session.query(User).filter(
-            User.subscribed == True).count()  # noqa: E721
-        first_event = None
-        last_event = None
-        seen_appointments = datetime.timedelta(seconds=0)
-        for event in context.session.query(AppointmentEvent).order_by(
-                AppointmentEvent.timestamp).all():
-            if first_event is None:
-                first_event = event
-            if last_event is not None:
-                if last_event.have_appointments:
-                    delta = event.timestamp - last_event.timestamp
-                    seen_appointments += delta
-            last_event = event
+        stats = Statistics.get(context.session)
+        subscribed_users = stats.subscribers
 
         now = datetime.datetime.utcnow()
-        if first_event is None:
-            first_event = AppointmentEvent(timestamp=now)
-
-        watching_for = now - first_event.timestamp
+        watching_for = now - (stats.first_seen or now)
         watching_for = datetime.timedelta(
             seconds=watching_for // datetime.timedelta(seconds=1))
         seen_appointments = datetime.timedelta(
-            seconds=seen_appointments // datetime.timedelta(seconds=1))
+            seconds=int(stats.availability_seconds))
 
         self.reply(context, TEXTS.STATISTICS.format(
             users_plural=(
@@ -452,31 +1029,247 @@ class Bot(object):
 
     def reply(self, context, text):
         try:
-            self.logger.info('==> %d: %s', context.user.chat_id, text)
+            self.logger.info('==> %d: %s', context.chat_id, text)
             self.bot.send_message(
-                context.user.chat_id, text, telegram.ParseMode.MARKDOWN)
+                context.chat_id, text, telegram.ParseMode.MARKDOWN)
         except telegram.error.Unauthorized:
-            context.session.delete(context.user)
+            self.delete_users(context.session, [context.chat_id])
+
+    def delete_users(self, session, chat_ids):
+        unsubscribed = 0
+        for chat_id in chat_ids:
+            if self.subscribers.get(session, chat_id):
+                unsubscribed += 1
+            self.subscribers.set(session, chat_id, None)
+        if unsubscribed:
+            Statistics.add_subscribers(session, -unsubscribed)
+
+        chat_ids = list(chat_ids)
+        for chat_id in chat_ids:
+            self.filters.remove(session, chat_id)
+        for start in range(0, len(chat_ids), SQL_CHUNK_SIZE):
+            chunk = chat_ids[start:start + SQL_CHUNK_SIZE]
+            session.query(User).filter(User.chat_id.in_(chunk)).delete(
+                synchronize_session=False)
+            session.query(Subscription).filter(
+                Subscription.chat_id.in_(chunk)).delete(
+                    synchronize_session=False)
 
 
 def run(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('token', help='Telegram bot token')
     parser.add_argument('database', help='SQLite3 database')
+    parser.add_argument(
+        '--target', dest='targets', action='append', type=Target.parse,
+        metavar='CATEGORY:APPLICANTS[:WELCOME_PAGE]',
+        help='Visa category and number of applicants to watch for. '
+             'May be repeated. Default: {}:{}'.format(
+                 DEFAULT_TARGET.visa_category, DEFAULT_TARGET.applicants))
+    parser.add_argument(
+        '--scrape-workers', type=int, default=None,
+        help='Number of targets checked at once. Default: all of them.')
+    parser.add_argument(
+        '--delivery-workers', type=int, default=8,
+        help='Number of notifications sent at once.')
+    parser.add_argument(
+        '--delivery-rate', type=float, default=TELEGRAM_RATE,
+        help='Maximum number of messages sent per second.')
+    parser.add_argument(
+        '--command-workers', type=int, default=8,
+        help='Number of chats whose commands are handled at once. '
+             'Default: %(default)s')
+    parser.add_argument(
+        '--parser', choices=list(PARSERS), default=None,
+        help='HTML extraction backend. Default: the fastest available.')
+    parser.add_argument(
+        '--no-session-reuse', dest='session_reuse', action='store_false',
+        help='Always replay the whole welcome -> application chain.')
+    parser.add_argument(
+        '--scrape-deadline', type=float, default=CYCLE_DEADLINE,
+        help='Seconds a check of a target may take, retries included. '
+             'Default: %(default)s')
+    parser.add_argument(
+        '--min-interval', type=float, default=None,
+        help='Shortest polling interval in seconds. Default: {}'.format(
+            INTERVAL / 5))
+    parser.add_argument(
+        '--max-interval', type=float, default=None,
+        help='Longest polling interval in seconds. Default: {}'.format(
+            INTERVAL * 5))
+    parser.add_argument(
+        '--fixed-interval', dest='adaptive', action='store_false',
+        help='Poll every {} seconds regardless of the history.'.format(
+            INTERVAL))
+    parser.add_argument(
+        '--webhook-url', default=None,
+        help='Receive updates via webhook at this public URL instead of '
+             'long polling. Telegram requires HTTPS, so put the bot behind '
+             'a TLS-terminating proxy.')
+    parser.add_argument(
+        '--webhook-listen', default='0.0.0.0:8080', metavar='HOST:PORT',
+        help='Address of the embedded webhook server. Default: %(default)s')
+    parser.add_argument(
+        '--webhook-path', default=None,
+        help='Path which accepts updates. It is appended to --webhook-url. '
+             'Default: a secret path derived from the bot token.')
+    parser.add_argument(
+        '--metrics-listen', default=None, metavar='HOST:PORT',
+        help='Serve Prometheus metrics at http://HOST:PORT/metrics.')
+    parser.add_argument(
+        '--delivery-shards', type=int, default=0,
+        help='Deliver notifications from this many worker processes, each '
+             'owning a shard of subscribers. Default: deliver in-process.')
+    parser.add_argument(
+        '--retention-days', type=float, default=RETENTION.days,
+        help='Roll up events older than this many days into hourly and '
+             'daily summaries. 0 keeps all events. Default: %(default)s')
+    parser.add_argument(
+        '--debounce', type=float, default=DEBOUNCE.total_seconds(),
+        help='Seconds a date must be gone before it counts as new again '
+             'and before "no more appointments" is sent. '
+             'Default: %(default)s')
+    parser.add_argument(
+        '--hedge', type=int, default=1, metavar='K',
+        help='Poll every target with K independent sessions, phase-shifted '
+             'by 1/K of the interval. Every session still polls once per '
+             'interval. Default: %(default)s')
+    parser.add_argument(
+        '--channel', default=None, metavar='CHAT',
+        help='Post notifications once to this channel, e.g. @channelname, '
+             'and send them directly only to users who opted out of it with '
+             '/subscribe direct. The bot must be an admin of the channel.')
+    parser.add_argument(
+        '--channel-link', default=None, metavar='URL',
+        help='Invite link of the channel shown to users. Default: --channel')
+    parser.add_argument(
+        '--lease-ttl', type=float, default=0,
+        help='Run as one of several replicas sharing the database. The '
+             'replica holding a lease of this many seconds is active, the '
+             'rest stand by and take over when it expires. Default: run '
+             'alone.')
+    parser.add_argument(
+        '--log-level', default='DEBUG',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='Default: %(default)s')
+    parser.add_argument(
+        '--log-sample', dest='log_sampling', action='append',
+        type=parse_sampling, default=[], metavar='LOGGER=FRACTION',
+        help='Keep this fraction of debug and info records of every call '
+             'site of the logger. May be repeated. Default: {}'.format(
+                 ' '.join('{}={}'.format(name, fraction)
+                          for name, fraction in sorted(SAMPLING.items()))))
+    parser.add_argument(
+        '--log-rate', type=float, default=LOG_RATE,
+        help='Maximum number of debug and info records per second of one '
+             'call site, 0 for no limit. Default: %(default)s')
     args = parser.parse_args(argv)
-    logging.basicConfig(level='DEBUG',
-                        format='%(asctime)s\t%(levelname)s\t%(message)s')
-
-    bot = Bot(telegram.Bot(args.token), args.database)
-    interactive_loop = threading.Thread(
-        target=bot.interactive_loop, name='ChatInteraction')
-    notification_loop = threading.Thread(
-        target=bot.notification_loop, name='ChatNotification')
+    sampling = dict(SAMPLING)
+    sampling.update(args.log_sampling)
+    logs = LogPipeline(
+        level=args.log_level, sampling=sampling, rate=args.log_rate)
+    logs.start()
+
+    client = telegram.Bot(args.token)
+    metrics = None
+    if args.metrics_listen:
+        host, port = args.metrics_listen.rsplit(':', 1)
+        metrics = MetricsServer((host, int(port)))
+        metrics.start()
+    webhook = None
+    if args.webhook_url:
+        host, port = args.webhook_listen.rsplit(':', 1)
+        webhook = WebhookServer(
+            (host, int(port)),
+            path=args.webhook_path or secret_path(args.token))
+
+    lease = None
+    if args.lease_ttl:
+        lease = LeaderLease(ttl=datetime.timedelta(seconds=args.lease_ttl))
+
+    shard_pool = None
+    if args.delivery_shards:
+        shard_pool = ShardPool(
+            args.database, args.token, args.delivery_shards,
+            delivery_workers=args.delivery_workers,
+            delivery_rate=args.delivery_rate,
+            channel=args.channel is not None,
+            holder=lease.holder if lease is not None else None,
+            stale_after=lease.ttl if lease is not None else None)
+
+    bot = Bot(client, args.database,
+              targets=args.targets or (DEFAULT_TARGET,),
+              scrape_workers=args.scrape_workers,
+              delivery_workers=args.delivery_workers,
+              delivery_rate=args.delivery_rate,
+              parser=args.parser,
+              session_reuse=args.session_reuse,
+              scheduler=AdaptiveScheduler(
+                  INTERVAL, min_interval=args.min_interval,
+                  max_interval=args.max_interval, adaptive=args.adaptive),
+              webhook=webhook,
+              shard_pool=shard_pool,
+              retention=datetime.timedelta(days=args.retention_days),
+              hedge=args.hedge,
+              scrape_deadline=args.scrape_deadline,
+              debounce=datetime.timedelta(seconds=args.debounce),
+              command_workers=args.command_workers,
+              lease=lease,
+              channel=args.channel,
+              channel_link=args.channel_link)
+    if webhook is not None:
+        webhook.start()
+        client.set_webhook(url=args.webhook_url.rstrip('/') + webhook.path)
+        interactive_loop = threading.Thread(
+            target=bot.webhook_loop, name='ChatInteraction')
+    else:
+        client.delete_webhook()
+        interactive_loop = threading.Thread(
+            target=bot.interactive_loop, name='ChatInteraction')
+    if shard_pool is not None:
+        notification_loop = threading.Thread(
+            target=bot.shard_coordinator_loop, name='ChatNotification')
+    else:
+        notification_loop = threading.Thread(
+            target=bot.notification_loop, name='ChatNotification')
+    lease_loop = None
+    if bot.lease is not None:
+        lease_loop = threading.Thread(
+            target=bot.lease_loop, name='LeaderLease')
+    compaction_loop = None
+    if args.retention_days:
+        compaction_loop = threading.Thread(
+            target=bot.compaction_loop, name='EventCompaction')
     try:
+        if lease_loop is not None:
+            lease_loop.start()
+        elif shard_pool is not None:
+            shard_pool.start()
         interactive_loop.start()
         notification_loop.start()
+        if compaction_loop is not None:
+            compaction_loop.start()
         bot.watching_loop()
     finally:
         bot.shutdown = True
+        bot.new_events.set()
+        bot.stopping.set()
         interactive_loop.join()
         notification_loop.join()
+        if compaction_loop is not None:
+            compaction_loop.join()
+        if lease_loop is not None:
+            lease_loop.join()
+            with contextlib.closing(bot.Session()) as session:
+                bot.lease.release(session)
+        bot.close_scrapers()
+        bot.broadcaster.close()
+        if bot.dispatcher is not None:
+            bot.dispatcher.close()
+        if webhook is not None:
+            webhook.stop()
+        if metrics is not None:
+            metrics.stop()
+        if shard_pool is not None:
+            shard_pool.stop()
+        logs.stop()
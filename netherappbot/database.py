@@ -0,0 +1,140 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Database engine setup and schema migrations.
+'''
+
+import logging
+
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+
+from .models import Base, SchemaVersion, AppointmentEvent, User
+from .scraper import DEFAULT_TARGET
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds a connection waits for a lock held by another thread.
+BUSY_TIMEOUT = 5000
+
+
+def create_engine(database, busy_timeout=BUSY_TIMEOUT, pool_size=5):
+    '''Creates an engine tuned for several threads sharing one database.
+
+    File-backed SQLite gets WAL journaling, so readers don't block the
+    writer, a busy timeout instead of immediate "database is locked" errors
+    and a real connection pool shared across threads.
+    '''
+    url = make_url(database)
+    if url.get_backend_name() != 'sqlite':
+        return sqlalchemy.create_engine(database, pool_pre_ping=True)
+
+    if url.database in (None, '', ':memory:'):
+        # In-memory database exists only within its single connection.
+        return sqlalchemy.create_engine(database)
+
+    engine = sqlalchemy.create_engine(
+        database,
+        poolclass=sqlalchemy.pool.QueuePool,
+        pool_size=pool_size,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': busy_timeout / 1000,
+        })
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(busy_timeout))
+        cursor.close()
+
+    return engine
+
+
+def add_event_target(connection):
+    columns = {
+        column['name']
+        for column in sqlalchemy.inspect(connection).get_columns('events')
+    }
+    if 'target' not in columns:
+        connection.execute('ALTER TABLE events ADD COLUMN target VARCHAR')
+    connection.execute(
+        AppointmentEvent.__table__.update().where(
+            AppointmentEvent.target == None  # noqa: E711
+        ).values(target=DEFAULT_TARGET.key))
+
+
+def add_event_slots(connection):
+    columns = {
+        column['name']
+        for column in sqlalchemy.inspect(connection).get_columns('events')
+    }
+    if 'slots' not in columns:
+        connection.execute('ALTER TABLE events ADD COLUMN slots VARCHAR')
+
+
+def add_user_channel(connection):
+    columns = {
+        column['name']
+        for column in sqlalchemy.inspect(connection).get_columns('users')
+    }
+    if 'channel' not in columns:
+        connection.execute('ALTER TABLE users ADD COLUMN channel BOOLEAN')
+
+
+def add_claimed_by(connection):
+    inspector = sqlalchemy.inspect(connection)
+    for table in ('outbox', 'delivery_markers'):
+        columns = {
+            column['name'] for column in inspector.get_columns(table)}
+        if 'claimed_by' not in columns:
+            connection.execute(
+                'ALTER TABLE {} ADD COLUMN claimed_by VARCHAR'.format(table))
+
+
+def create_indexes(tables):
+    def migration(connection):
+        inspector = sqlalchemy.inspect(connection)
+        for table in tables:
+            existing = {
+                index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+
+    return migration
+
+
+# Append only. Version N is reached by running the first N migrations.
+MIGRATIONS = [
+    add_event_target,
+    create_indexes([User.__table__, AppointmentEvent.__table__]),
+    create_indexes([User.__table__]),
+    add_event_slots,
+    add_user_channel,
+    add_claimed_by,
+]
+
+
+def migrate(engine):
+    '''Creates missing tables and runs pending migrations.'''
+    with engine.begin() as connection:
+        fresh = 'events' not in sqlalchemy.inspect(
+            connection).get_table_names()
+        Base.metadata.create_all(connection)
+        row = connection.execute(SchemaVersion.__table__.select()).first()
+        if row is None:
+            # create_all has already built the latest schema.
+            version = len(MIGRATIONS) if fresh else 0
+            connection.execute(
+                SchemaVersion.__table__.insert().values(id=1, version=version))
+        else:
+            version = row.version
+
+        for number in range(version, len(MIGRATIONS)):
+            logger.info('Migrating database to version %d', number + 1)
+            MIGRATIONS[number](connection)
+        if version < len(MIGRATIONS):
+            connection.execute(SchemaVersion.__table__.update().values(
+                version=len(MIGRATIONS)))
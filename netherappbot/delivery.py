@@ -0,0 +1,149 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Concurrent, rate-limited delivery of notifications.
+'''
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import telegram
+
+from .metrics import MESSAGES, QUEUE_DEPTH
+
+# Telegram allows about 30 messages per second to different chats.
+TELEGRAM_RATE = 30
+
+SENT = 'sent'
+FAILED = 'failed'
+UNAUTHORIZED = 'unauthorized'
+
+# `unauthorized` and `undelivered` list the chats which blocked the bot and
+# the chats whose send failed.
+DeliveryReport = collections.namedtuple('DeliveryReport', (
+    'total', 'sent', 'failed', 'unauthorized', 'undelivered', 'elapsed'))
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket shared by all delivery workers.'''
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.blocked_until = self.updated
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    # Tolerate float rounding of the refill.
+                    if self.tokens >= 1 - 1e-9:
+                        self.tokens = max(0, self.tokens - 1)
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def pause(self, seconds):
+        '''Stops handing out tokens for the given time, e.g. on RetryAfter.'''
+        with self.lock:
+            now = self.clock()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0
+            self.updated = self.blocked_until
+
+
+class Broadcaster(object):
+    '''Sends the same text to many chats on a pool of worker threads.'''
+
+    def __init__(self, bot, workers=8, rate=TELEGRAM_RATE, max_retries=3):
+        super(Broadcaster, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        # Bounds the number of queued sends, so memory stays flat no matter
+        # how many chats there are.
+        self.window = workers * 4
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='Delivery')
+
+    def send(self, chat_id, text):
+        QUEUE_DEPTH.labels('delivery').dec()
+        status = self._send(chat_id, text)
+        MESSAGES.labels(status).inc()
+        return status
+
+    def _send(self, chat_id, text):
+        for _ in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                self.logger.info('==> %s: %s', chat_id, text)
+                self.bot.send_message(
+                    chat_id, text, telegram.ParseMode.MARKDOWN)
+                return SENT
+            except telegram.error.RetryAfter as e:
+                self.logger.warning(
+                    'Flood control exceeded, retry in %s s', e.retry_after)
+                self.bucket.pause(e.retry_after)
+            except telegram.error.Unauthorized:
+                return UNAUTHORIZED
+            except telegram.error.TelegramError:
+                self.logger.warning(
+                    'Failed to send message to %s', chat_id, exc_info=True)
+                return FAILED
+        return FAILED
+
+    def broadcast(self, chat_ids, text):
+        '''Sends `text` to every chat of the `chat_ids` iterable.
+
+        The iterable is consumed lazily, so it may stream chats from the
+        database or the subscriber index.
+        '''
+        started = time.monotonic()
+        depth = QUEUE_DEPTH.labels('delivery')
+        pending = {}
+        counts = collections.Counter()
+        unauthorized = []
+        undelivered = []
+
+        def collect(done):
+            for future in done:
+                status = future.result()
+                counts[status] += 1
+                if status == UNAUTHORIZED:
+                    unauthorized.append(pending[future])
+                elif status == FAILED:
+                    undelivered.append(pending[future])
+                del pending[future]
+
+        for chat_id in chat_ids:
+            if len(pending) >= self.window:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            depth.inc()
+            pending[self.executor.submit(self.send, chat_id, text)] = chat_id
+        collect(concurrent.futures.wait(pending)[0])
+
+        return DeliveryReport(
+            sum(counts.values()), counts[SENT], counts[FAILED], unauthorized,
+            undelivered, time.monotonic() - started)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
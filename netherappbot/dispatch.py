@@ -0,0 +1,52 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Concurrent handling of incoming messages, ordered within every chat.
+'''
+
+import collections
+import concurrent.futures
+import time
+
+from .metrics import COMMAND_SECONDS
+
+
+class ChatDispatcher(object):
+    '''Handles a batch of messages on a pool of worker threads.
+
+    Messages of one chat are handled one after another in the order of the
+    batch, different chats are handled in parallel, so a slow reply delays
+    only its own chat. `dispatch` returns once the whole batch is handled,
+    which lets the caller acknowledge the batch.
+    '''
+
+    def __init__(self, workers=8):
+        super(ChatDispatcher, self).__init__()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='ChatCommand')
+
+    def dispatch(self, messages, handle):
+        '''Calls `handle(message)` for every message.
+
+        A failed message stops the rest of its chat. The first failure is
+        raised after all chats are done.
+        '''
+        chats = collections.OrderedDict()
+        for message in messages:
+            chats.setdefault(message.chat.id, []).append(message)
+        started = time.monotonic()
+        futures = [
+            self.executor.submit(self._handle_chat, chat, handle, started)
+            for chat in chats.values()
+        ]
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def _handle_chat(self, messages, handle, started):
+        for message in messages:
+            handle(message)
+            # Includes the wait behind earlier messages of the chat.
+            COMMAND_SECONDS.observe(time.monotonic() - started)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
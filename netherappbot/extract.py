@@ -0,0 +1,202 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Extraction of the form, the response message and available dates from VFS
+pages.
+
+Scraper only needs inputs of the `frmWeb` form, one label and the calendar
+links, so building a full tree of a page with a huge `__VIEWSTATE` is a
+waste. Every backend returns the same `Page` for the same HTML.
+'''
+
+import collections
+import datetime
+import re
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:  # pragma: no cover
+    lxml = None
+
+FORM_ID = 'frmWeb'
+MESSAGE_IDS = ('plhMain_lblMsg', 'plhMain_lblFillAppDetails')
+EXCLUDED_INPUTS = frozenset({
+    'ctl00$plhMain$btnCancel', 'ctl00$plhMain$btnBack'})
+
+# Available days of the ASP.NET Calendar are links which post back the
+# number of days since 2000-01-01. "V" arguments switch months.
+CALENDAR_TARGET = 'ctl00$plhMain$cldAppointment'
+DAY_LINK_RE = re.compile(
+    r"__doPostBack\('{}','(\d+)'\)".format(re.escape(CALENDAR_TARGET)))
+CALENDAR_EPOCH = datetime.date(2000, 1, 1)
+# lxml refuses str input which declares its encoding.
+XML_DECLARATION_RE = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+Page = collections.namedtuple(
+    'Page', ('action', 'form_data', 'message', 'dates'))
+
+
+def parse_dates(hrefs):
+    '''Returns the sorted tuple of dates linked from the calendar.'''
+    days = set()
+    for href in hrefs:
+        match = DAY_LINK_RE.search(href or '')
+        if match is not None:
+            days.add(int(match.group(1)))
+    return tuple(
+        CALENDAR_EPOCH + datetime.timedelta(days=day) for day in sorted(days))
+
+
+def select_message(texts):
+    '''Picks the first non-empty message in MESSAGE_IDS order.
+
+    `texts` maps element id to its text for the elements present on the
+    page. Returns None if there are none of them.
+    '''
+    for element_id in MESSAGE_IDS:
+        if texts.get(element_id):
+            return texts[element_id]
+    for element_id in MESSAGE_IDS:
+        if element_id in texts:
+            return texts[element_id]
+    return None
+
+
+class SoupExtractor(object):
+    '''Reference backend: the full html.parser tree.'''
+
+    name = 'soup'
+
+    def extract(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        frm_web = soup.find(id=FORM_ID)
+        if frm_web is None:
+            action = None
+            form_data = {}
+        else:
+            action = frm_web.get('action')
+            form_data = {
+                input_tag.get('name'): input_tag.get('value')
+                for input_tag in frm_web.find_all('input')
+                if input_tag.get('name') not in EXCLUDED_INPUTS
+            }
+
+        texts = {}
+        for element_id in MESSAGE_IDS:
+            element = soup.find(id=element_id)
+            if element is not None:
+                texts[element_id] = element.get_text()
+        dates = parse_dates(
+            link.get('href') for link in soup.find_all('a', href=True))
+        return Page(action, form_data, select_message(texts), dates)
+
+
+class _StreamParser(HTMLParser):
+    def __init__(self):
+        super(_StreamParser, self).__init__(convert_charrefs=True)
+        self.action = None
+        self.form_data = {}
+        self.texts = {}
+        self.hrefs = []
+        self.in_form = False
+        self.capture = None
+        self.capture_tag = None
+        self.capture_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.capture is not None and tag == self.capture_tag:
+            self.capture_depth += 1
+        element_id = attrs.get('id')
+        if tag == 'form' and element_id == FORM_ID:
+            self.in_form = True
+            self.action = attrs.get('action')
+        elif tag == 'input' and self.in_form:
+            name = attrs.get('name')
+            if name not in EXCLUDED_INPUTS:
+                self.form_data[name] = attrs.get('value')
+        elif tag == 'a' and attrs.get('href'):
+            self.hrefs.append(attrs['href'])
+        elif (element_id in MESSAGE_IDS and self.capture is None and
+                element_id not in self.texts):
+            self.capture = element_id
+            self.capture_tag = tag
+            self.capture_depth = 1
+            self.texts[element_id] = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.in_form = False
+        if self.capture is not None and tag == self.capture_tag:
+            self.capture_depth -= 1
+            if self.capture_depth == 0:
+                self.capture = None
+
+    def handle_data(self, data):
+        if self.capture is not None:
+            self.texts[self.capture] += data
+
+
+class StreamExtractor(object):
+    '''Streaming backend on top of the stdlib parser. Builds no tree.'''
+
+    name = 'stream'
+
+    def extract(self, html):
+        parser = _StreamParser()
+        parser.feed(html)
+        parser.close()
+        return Page(
+            parser.action, parser.form_data, select_message(parser.texts),
+            parse_dates(parser.hrefs))
+
+
+class LxmlExtractor(object):
+    '''lxml backend. Available only when lxml is installed.'''
+
+    name = 'lxml'
+
+    def extract(self, html):
+        try:
+            root = lxml.html.fromstring(XML_DECLARATION_RE.sub('', html, 1))
+        except lxml.etree.ParserError:
+            # Empty document, the other backends find nothing in it either.
+            return Page(None, {}, None, ())
+        frm_web = root.get_element_by_id(FORM_ID, None)
+        if frm_web is None:
+            action = None
+            form_data = {}
+        else:
+            action = frm_web.get('action')
+            form_data = {
+                input_tag.get('name'): input_tag.get('value')
+                for input_tag in frm_web.iter('input')
+                if input_tag.get('name') not in EXCLUDED_INPUTS
+            }
+
+        texts = {}
+        for element_id in MESSAGE_IDS:
+            element = root.get_element_by_id(element_id, None)
+            if element is not None:
+                texts[element_id] = element.text_content()
+        dates = parse_dates(link.get('href') for link in root.iter('a'))
+        return Page(action, form_data, select_message(texts), dates)
+
+
+BACKENDS = collections.OrderedDict(
+    (extractor.name, extractor) for extractor in (
+        SoupExtractor, StreamExtractor, LxmlExtractor)
+    if extractor is not LxmlExtractor or lxml is not None)
+
+
+def get_extractor(name=None):
+    '''Returns an extractor by name or the fastest available one.'''
+    if name is None:
+        name = 'lxml' if 'lxml' in BACKENDS else 'stream'
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError('Unknown or unavailable parser: {}'.format(name))
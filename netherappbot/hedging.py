@@ -0,0 +1,47 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Merging of results from scraper sessions which poll the same targets.
+
+In hedged mode several independent sessions poll every target, shifted in
+phase, so availability is noticed sooner. Their results race each other and
+must not turn into duplicate or flapping events.
+'''
+
+import threading
+
+from .metrics import SCRAPE_RESULTS
+
+STALE = 'stale'
+SAME = 'same'
+CHANGED = 'changed'
+
+
+class ResultMerger(object):
+    '''Orders results of concurrent checks of the same targets.
+
+    Results are ordered by the time their check started. An older result
+    arriving after a newer one is stale and dropped, so a slow session
+    can't flip the state back. The rest are recorded one at a time.
+    '''
+
+    def __init__(self):
+        super(ResultMerger, self).__init__()
+        self.lock = threading.Lock()
+        self.started = {}
+
+    def merge(self, key, started, record):
+        '''Calls `record()` unless the result is stale.
+
+        `record` returns whether the result changed anything. It runs under
+        the lock, so results are recorded in order. If it raises, the
+        result isn't taken into account.
+        '''
+        with self.lock:
+            last = self.started.get(key)
+            if last is not None and started <= last:
+                outcome = STALE
+            else:
+                outcome = CHANGED if record() else SAME
+                self.started[key] = started
+        SCRAPE_RESULTS.labels(outcome).inc()
+        return outcome
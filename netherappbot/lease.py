@@ -0,0 +1,99 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Leader election of bot replicas through a lease in the database.
+
+Every replica tries to take or renew the lease every `ttl / 3`. The holder
+is the active replica, the others stand by and take the lease over once it
+expires. Expiry is compared against wall clocks of the replicas, so they
+must be kept in sync, e.g. by NTP.
+'''
+
+import datetime
+import logging
+import os
+import socket
+import time
+import uuid
+
+import sqlalchemy
+
+from .models import Lease
+
+WATCHER = 'watcher'
+TTL = datetime.timedelta(seconds=15)
+
+
+def default_holder():
+    return '{}:{}:{}'.format(
+        socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaderLease(object):
+    '''Lease of one replica.
+
+    The holder stops considering itself the leader a renewal interval
+    before the lease expires in the database, so two replicas never act as
+    leaders at once while the clocks agree.
+    '''
+
+    def __init__(self, name=WATCHER, holder=None, ttl=TTL,
+                 clock=datetime.datetime.utcnow, monotonic=time.monotonic):
+        super(LeaderLease, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.name = name
+        self.holder = holder or default_holder()
+        self.ttl = ttl
+        self.clock = clock
+        self.monotonic = monotonic
+        self.valid_until = None
+
+    @property
+    def renew_interval(self):
+        return self.ttl.total_seconds() / 3
+
+    def held(self):
+        return (self.valid_until is not None and
+                self.monotonic() < self.valid_until)
+
+    def acquire(self, session):
+        '''Takes or renews the lease. Returns whether it's held.
+
+        Commits the session.
+        '''
+        started = self.monotonic()
+        now = self.clock()
+        # Compare-and-set, so only one replica wins an expired lease.
+        acquired = session.query(Lease).filter(
+            Lease.name == self.name,
+            sqlalchemy.or_(
+                Lease.holder == self.holder, Lease.expires_at <= now),
+        ).update({
+            Lease.holder: self.holder,
+            Lease.expires_at: now + self.ttl,
+        }, synchronize_session=False)
+        if not acquired and session.query(Lease).get(self.name) is None:
+            session.add(Lease(
+                name=self.name, holder=self.holder, expires_at=now + self.ttl))
+            acquired = True
+        try:
+            session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Another replica created the lease first.
+            session.rollback()
+            acquired = False
+        if acquired:
+            self.valid_until = (
+                started + self.ttl.total_seconds() - self.renew_interval)
+        else:
+            self.valid_until = None
+        return bool(acquired)
+
+    def release(self, session):
+        '''Lets a standby take over without waiting for the expiry.'''
+        if self.valid_until is None:
+            return
+        self.valid_until = None
+        session.query(Lease).filter(
+            Lease.name == self.name, Lease.holder == self.holder,
+        ).update({Lease.expires_at: self.clock()}, synchronize_session=False)
+        session.commit()
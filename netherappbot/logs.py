@@ -0,0 +1,172 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Logging which stays off the hot paths.
+
+Records are put on a bounded queue as they are and a writer thread formats
+and writes them. Chatty call sites, like the line per sent message, are
+sampled and rate limited before they reach the queue.
+'''
+
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from .metrics import LOG_DROPPED, QUEUE_DEPTH
+
+QUEUE_SIZE = 10000
+# Records per second of one call site below WARNING, 0 for no limit.
+RATE = 10
+# Logger name -> fraction of records below WARNING which are kept.
+SAMPLING = {'Broadcaster': 0.01}
+LEVELS = {
+    logging.DEBUG: 'D',
+    logging.INFO: 'I',
+    logging.WARNING: 'W',
+    logging.ERROR: 'E',
+    logging.CRITICAL: 'C',
+}
+
+
+def parse_sampling(value):
+    '''Parses LOGGER=FRACTION of the --log-sample option.'''
+    name, fraction = value.rsplit('=', 1)
+    fraction = float(fraction)
+    if not 0 < fraction <= 1:
+        raise ValueError('Fraction must be in (0, 1]')
+    return name, fraction
+
+
+class _Site(object):
+    __slots__ = ('count', 'tokens', 'updated', 'suppressed')
+
+    def __init__(self, tokens, now):
+        self.count = 0
+        self.tokens = tokens
+        self.updated = now
+        self.suppressed = 0
+
+
+class SiteFilter(logging.Filter):
+    '''Samples and rate limits records below WARNING per call site.
+
+    A call site is the file and line of the logging call. `sampling` maps
+    logger names to the fraction of records kept, every n-th record of a
+    site passes. `rate` limits records per second of a site. A record which
+    passes carries the number of records of its site suppressed before it in
+    `suppressed`.
+    '''
+
+    def __init__(self, sampling=None, rate=RATE, clock=time.monotonic):
+        super(SiteFilter, self).__init__()
+        self.every = {
+            name: max(1, int(round(1 / fraction)))
+            for name, fraction in (sampling or {}).items()
+        }
+        self.rate = rate
+        self.clock = clock
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        every = self.every.get(record.name, 1)
+        if every == 1 and not self.rate:
+            return True
+        key = (record.pathname, record.lineno)
+        now = self.clock()
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = _Site(self.rate, now)
+            keep = site.count % every == 0
+            site.count += 1
+            if keep and self.rate:
+                site.tokens = min(
+                    self.rate, site.tokens + (now - site.updated) * self.rate)
+                site.updated = now
+                keep = site.tokens >= 1
+                if keep:
+                    site.tokens -= 1
+            if not keep:
+                site.suppressed += 1
+                return False
+            record.suppressed = site.suppressed
+            site.suppressed = 0
+        return True
+
+
+class CompactFormatter(logging.Formatter):
+    '''Tab separated time, level, logger, thread and message.
+
+    Newlines are escaped, so every record, traceback included, is one
+    line. Suppressed records of the call site are appended as a field.
+    '''
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += '\n' + self.formatException(record.exc_info)
+        if record.stack_info:
+            message += '\n' + self.formatStack(record.stack_info)
+        fields = [
+            '{}.{:03d}Z'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(
+                    record.created)), int(record.msecs)),
+            LEVELS.get(record.levelno, record.levelname),
+            record.name,
+            record.threadName,
+            message.replace('\\', '\\\\').replace('\n', '\\n').replace(
+                '\t', '\\t'),
+        ]
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            fields.append('suppressed={}'.format(suppressed))
+        return '\t'.join(fields)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''Enqueues records without formatting them.
+
+    Formatting happens on the writer thread, so arguments are rendered a
+    moment later than the call. A full queue drops the record instead of
+    blocking the caller.
+    '''
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class LogPipeline(object):
+    '''Routes the root logger through the queue to a writer thread.'''
+
+    def __init__(self, level=logging.INFO, stream=None, sampling=SAMPLING,
+                 rate=RATE, queue_size=QUEUE_SIZE):
+        super(LogPipeline, self).__init__()
+        self.level = level
+        self.queue = queue.Queue(queue_size)
+        self.handler = QueueHandler(self.queue)
+        self.handler.addFilter(SiteFilter(sampling, rate))
+        writer = logging.StreamHandler(stream)
+        writer.setFormatter(CompactFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, writer)
+
+    def start(self):
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        QUEUE_DEPTH.labels('log').set_function(self.queue.qsize)
+        self.listener.start()
+
+    def stop(self):
+        '''Detaches from the root logger and writes out queued records.'''
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
@@ -0,0 +1,327 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Metrics in the Prometheus text format, without extra dependencies.
+'''
+
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(_Metric, self).__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self._make_child()
+            return child
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def set_function(self, function):
+        '''Reads the value from `function` at scrape time.'''
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        with self.lock:
+            return self.value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _make_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, values, child):
+        yield '{}{} {}'.format(
+            self.name, _format_labels(self.labelnames, values),
+            _format_value(child.get()))
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.buckets):
+                self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _make_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            count = child.count
+            total = child.sum
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield '{}_bucket{} {}'.format(
+                self.name, _format_labels(
+                    self.labelnames, values, [('le', _format_value(bound))]),
+                cumulative)
+        yield '{}_bucket{} {}'.format(
+            self.name, _format_labels(
+                self.labelnames, values, [('le', '+Inf')]), count)
+        labels = _format_labels(self.labelnames, values)
+        yield '{}_sum{} {}'.format(self.name, labels, _format_value(total))
+        yield '{}_count{} {}'.format(self.name, labels, count)
+
+
+class Registry(object):
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'netherappbot_scrape_stage_seconds',
+    'Latency of booking system requests by scrape stage.', ('stage',))
+STAGE_RESPONSES = REGISTRY.counter(
+    'netherappbot_scrape_stage_responses_total',
+    'Booking system responses by scrape stage and HTTP status.',
+    ('stage', 'status'))
+HTTP_ATTEMPTS = REGISTRY.counter(
+    'netherappbot_http_attempts_total',
+    'HTTP attempts by scrape stage and HTTP status or error.',
+    ('stage', 'outcome'))
+HTTP_ATTEMPT_SECONDS = REGISTRY.histogram(
+    'netherappbot_http_attempt_seconds',
+    'Duration of single HTTP attempts, including the body.', ('stage',))
+PARSE_SECONDS = REGISTRY.histogram(
+    'netherappbot_parse_seconds',
+    'Time spent extracting data from booking system pages.', ('stage',))
+SCRAPE_RESULTS = REGISTRY.counter(
+    'netherappbot_scrape_results_total',
+    'Scrape results by outcome of merging: changed, same or stale.',
+    ('outcome',))
+LOOP_SECONDS = REGISTRY.histogram(
+    'netherappbot_loop_iteration_seconds',
+    'Duration of loop iterations, without the sleep.', ('loop',))
+COMMAND_SECONDS = REGISTRY.histogram(
+    'netherappbot_command_seconds',
+    'Time from receiving a batch of updates to handling a message of it.')
+POLLING_INTERVAL = REGISTRY.gauge(
+    'netherappbot_polling_interval_seconds',
+    'Current interval of the watching loop.')
+FANOUT_SECONDS = REGISTRY.histogram(
+    'netherappbot_fanout_seconds',
+    'Time from detecting an event to the last delivery of its '
+    'notification.',
+    buckets=DEFAULT_BUCKETS + (120.0, 300.0, 600.0, 1800.0))
+MESSAGES = REGISTRY.counter(
+    'netherappbot_messages_total',
+    'Messages sent to Telegram by result.', ('status',))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'netherappbot_queue_depth', 'Number of items waiting in a queue.',
+    ('queue',))
+LOG_DROPPED = REGISTRY.counter(
+    'netherappbot_log_records_dropped_total',
+    'Log records dropped because the log queue was full.')
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'netherappbot_db_query_seconds', 'Latency of database statements.',
+    ('statement',))
+
+
+def instrument_engine(engine):
+    '''Records latency of every statement executed by the engine.
+
+    The start time is kept on the execution context, which is dropped
+    along with it when the statement fails.
+    '''
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        if context is not None:
+            context.metrics_query_started = time.monotonic()
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context,
+                      executemany):
+        started = getattr(context, 'metrics_query_started', None)
+        if started is None:
+            return
+        kind = statement.lstrip().split(None, 1)[0].upper()
+        DB_QUERY_SECONDS.labels(kind).observe(time.monotonic() - started)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(object):
+    '''Serves the registry at /metrics.'''
+
+    def __init__(self, address, registry=REGISTRY):
+        super(MetricsServer, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.httpd = http.server.ThreadingHTTPServer(address, _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name='Metrics', daemon=True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        self.logger.info('Serving metrics on %s:%d', *self.address[:2])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
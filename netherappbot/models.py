@@ -0,0 +1,267 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Database models of the bot.
+'''
+
+import datetime
+
+import sqlalchemy
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import (
+    Column, Integer, Date, DateTime, Boolean, String, Float, Index, Text,
+    UniqueConstraint)
+
+from .scraper import DEFAULT_TARGET
+
+Base = declarative_base()
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+
+
+class LastUpdate(Base):
+    __tablename__ = 'last_update'
+    id = Column(Integer, primary_key=True)
+    update_id = Column(Integer)
+
+
+class User(Base):
+    __tablename__ = 'users'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, unique=True)
+    subscribed = Column(Boolean, index=True)
+    # Reads notifications in the channel instead of direct messages.
+    channel = Column(Boolean)
+
+    __table_args__ = (
+        # Keyset pagination over subscribers.
+        Index('ix_users_subscribed_chat_id', 'subscribed', 'chat_id'),
+    )
+
+
+class Subscription(Base):
+    '''Notifications about one visa category and number of applicants.
+
+    Missing dates leave the range open.
+    '''
+    __tablename__ = 'subscriptions'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, index=True)
+    visa_category = Column(Integer)
+    applicants = Column(Integer)
+    date_from = Column(Date)
+    date_to = Column(Date)
+
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'visa_category', 'applicants'),
+        Index('ix_subscriptions_key', 'visa_category', 'applicants'),
+    )
+
+
+class AppointmentEvent(Base):
+    __tablename__ = 'events'
+
+    id = Column(Integer, primary_key=True)
+    target = Column(String, default=DEFAULT_TARGET.key)
+    timestamp = Column(DateTime)
+    have_appointments = Column(Boolean)
+    # New available dates, see slots.encode_dates.
+    slots = Column(String)
+    notification_sent = Column(Boolean, index=True)
+
+    __table_args__ = (
+        Index('ix_events_target_timestamp', 'target', 'timestamp'),
+        Index('ix_events_timestamp', 'timestamp'),
+    )
+
+
+class DeliveryMarker(Base):
+    '''Delivery of an event to one shard of subscribers.'''
+    __tablename__ = 'delivery_markers'
+
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+
+    id = Column(Integer, primary_key=True)
+    event_id = Column(Integer, index=True)
+    shard = Column(Integer)
+    text = Column(Text)
+    status = Column(String, default=PENDING)
+    claimed_at = Column(DateTime)
+    # Lease holder of the replica whose shard claimed the marker.
+    claimed_by = Column(String)
+    finished_at = Column(DateTime)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('event_id', 'shard'),
+        Index('ix_delivery_markers_shard_status', 'shard', 'status'),
+    )
+
+
+class OutboxMessage(Base):
+    '''Notification about an event to one chat, see outbox.Outbox.'''
+    __tablename__ = 'outbox'
+
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    id = Column(Integer, primary_key=True)
+    event_id = Column(Integer)
+    chat_id = Column(Integer)
+    status = Column(String, default=PENDING)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime)
+    claimed_at = Column(DateTime)
+    # Lease holder of the replica which claimed the message.
+    claimed_by = Column(String)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint('event_id', 'chat_id'),
+        Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+
+class EventRollup(Base):
+    '''Events of a target aggregated over an hour or a day.
+
+    Rows with `ALL_TARGETS` aggregate the time when any target had
+    appointments, like `Statistics` does.
+    '''
+    __tablename__ = 'event_rollups'
+
+    HOUR = 'hour'
+    DAY = 'day'
+    ALL_TARGETS = '*'
+
+    id = Column(Integer, primary_key=True)
+    target = Column(String)
+    period = Column(String)
+    start = Column(DateTime)
+    availability_seconds = Column(Float, default=0.0)
+    openings = Column(Integer, default=0)
+    closings = Column(Integer, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('target', 'period', 'start'),
+    )
+
+
+class Lease(Base):
+    '''Named lease held by one process until `expires_at`.'''
+    __tablename__ = 'leases'
+
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires_at = Column(DateTime)
+
+
+class Compaction(Base):
+    '''Progress of the event history compaction.
+
+    Events before `compacted_until` live in rollups. Only the last one of
+    every target is kept, it holds the target state.
+    '''
+    __tablename__ = 'compaction'
+
+    id = Column(Integer, primary_key=True)
+    first_seen = Column(DateTime)
+    compacted_until = Column(DateTime)
+
+    @classmethod
+    def get(cls, session):
+        return session.query(cls).get(1)
+
+
+class Statistics(Base):
+    '''Materialized statistics, kept up to date by the writers.
+
+    `availability_seconds` counts closed intervals when at least one target
+    had appointments. The currently open interval starts at `open_since`.
+    '''
+    __tablename__ = 'statistics'
+
+    id = Column(Integer, primary_key=True)
+    first_seen = Column(DateTime)
+    availability_seconds = Column(Float, default=0.0)
+    open_since = Column(DateTime)
+    open_targets = Column(Integer, default=0)
+    subscribers = Column(Integer, default=0)
+
+    @classmethod
+    def get(cls, session):
+        return session.query(cls).get(1)
+
+    @classmethod
+    def rebuild(cls, session):
+        '''Computes the record from rollups and the raw events after them.'''
+        stats = cls.get(session)
+        if stats is None:
+            stats = cls(id=1)
+            session.add(stats)
+        stats.first_seen = None
+        stats.availability_seconds = 0.0
+        stats.open_since = None
+        stats.open_targets = 0
+        stats.subscribers = session.query(User).filter(
+            User.subscribed == True).count()  # noqa: E712
+
+        previous = {}
+        events = session.query(AppointmentEvent).order_by(
+            AppointmentEvent.timestamp, AppointmentEvent.id)
+        compaction = Compaction.get(session)
+        if compaction is not None and compaction.compacted_until is not None:
+            since = compaction.compacted_until
+            stats.first_seen = compaction.first_seen
+            stats.availability_seconds = session.query(sqlalchemy.func.sum(
+                EventRollup.availability_seconds)).filter(
+                    EventRollup.target == EventRollup.ALL_TARGETS,
+                    EventRollup.period == EventRollup.HOUR).scalar() or 0.0
+            # Only the last compacted event of every target is left.
+            for event in events.filter(AppointmentEvent.timestamp < since):
+                previous[event.target] = event.have_appointments
+            stats.open_targets = sum(previous.values())
+            if stats.open_targets:
+                stats.open_since = since
+            events = events.filter(AppointmentEvent.timestamp >= since)
+
+        for event in events:
+            stats.record_event(
+                event.timestamp, event.have_appointments,
+                previous.get(event.target, False))
+            previous[event.target] = event.have_appointments
+        return stats
+
+    def record_event(self, timestamp, have_appointments, previous_result):
+        if self.first_seen is None:
+            self.first_seen = timestamp
+
+        if have_appointments and not previous_result:
+            self.open_targets += 1
+            if self.open_targets == 1:
+                self.open_since = timestamp
+        elif previous_result and not have_appointments:
+            self.open_targets -= 1
+            if self.open_targets == 0:
+                self.availability_seconds += (
+                    timestamp - self.open_since) / datetime.timedelta(
+                        seconds=1)
+                self.open_since = None
+
+    @classmethod
+    def add_subscribers(cls, session, delta):
+        # Atomic in the database, so concurrent sessions don't lose updates.
+        session.query(cls).filter(cls.id == 1).update(
+            {cls.subscribers: cls.subscribers + delta},
+            synchronize_session=False)
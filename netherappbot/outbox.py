@@ -0,0 +1,198 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Durable outbox of notifications.
+
+A pending event is expanded into one `OutboxMessage` per recipient in a
+single transaction. Messages are then claimed, sent and marked in batches,
+so after a crash only the undelivered messages are sent, and a failed send
+is retried with backoff on its own instead of repeating the broadcast.
+'''
+
+import collections
+import datetime
+
+import sqlalchemy
+
+from .metrics import FANOUT_SECONDS
+from .models import AppointmentEvent, OutboxMessage
+
+# Keeps the number of bound parameters below SQLite's limit.
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+BACKOFF = datetime.timedelta(seconds=30)
+# Messages claimed longer ago than this belong to a crashed process.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+# Stands for the notification channel, Telegram never uses it for a chat.
+CHANNEL_CHAT_ID = 0
+
+Message = collections.namedtuple(
+    'Message', ('id', 'event_id', 'chat_id', 'attempts'))
+Completion = collections.namedtuple(
+    'Completion', ('event', 'sent', 'failed', 'elapsed'))
+
+
+class Outbox(object):
+    def __init__(self, batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS,
+                 backoff=BACKOFF):
+        super(Outbox, self).__init__()
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def enqueued(self, session, event_id):
+        return session.query(sqlalchemy.exists().where(
+            OutboxMessage.event_id == event_id)).scalar()
+
+    def enqueue(self, session, event_id, chat_ids):
+        '''Adds a message per chat of the iterable. Returns their number.'''
+        insert = OutboxMessage.__table__.insert()
+        count = 0
+        chunk = []
+        for chat_id in chat_ids:
+            chunk.append({
+                'event_id': event_id,
+                'chat_id': chat_id,
+                'status': OutboxMessage.PENDING,
+                'attempts': 0,
+            })
+            if len(chunk) == BATCH_SIZE:
+                session.execute(insert, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            session.execute(insert, chunk)
+            count += len(chunk)
+        return count
+
+    def release_claims(self, session, holder=None, before=None):
+        '''Returns messages claimed by other processes to the queue.
+
+        Without a `holder` every claim is released, which is only safe when
+        no other process sends. Otherwise only claims of other holders made
+        before `before` are, as a deposed leader may still be sending the
+        younger ones.
+        '''
+        query = session.query(OutboxMessage).filter(
+            OutboxMessage.status == OutboxMessage.CLAIMED)
+        if holder is not None:
+            query = query.filter(
+                sqlalchemy.or_(
+                    OutboxMessage.claimed_by == None,  # noqa: E711
+                    OutboxMessage.claimed_by != holder),
+                OutboxMessage.claimed_at < before)
+        query.update({
+            OutboxMessage.status: OutboxMessage.PENDING,
+            OutboxMessage.claimed_at: None,
+            OutboxMessage.claimed_by: None,
+        }, synchronize_session=False)
+
+    def _due(self, now):
+        return sqlalchemy.or_(
+            sqlalchemy.and_(
+                OutboxMessage.status == OutboxMessage.PENDING,
+                sqlalchemy.or_(
+                    OutboxMessage.next_attempt_at == None,  # noqa: E711
+                    OutboxMessage.next_attempt_at <= now)),
+            sqlalchemy.and_(
+                OutboxMessage.status == OutboxMessage.CLAIMED,
+                OutboxMessage.claimed_at < now - CLAIM_TIMEOUT))
+
+    def claim(self, session, now, holder=None):
+        '''Claims a batch of due messages, oldest first, for `holder`.
+
+        Returns a list of `Message`, their `attempts` include this one.
+        '''
+        rows = session.query(
+            OutboxMessage.id, OutboxMessage.event_id, OutboxMessage.chat_id,
+            OutboxMessage.attempts,
+        ).filter(self._due(now)).order_by(
+            OutboxMessage.id).limit(self.batch_size).all()
+        if not rows:
+            return []
+        session.query(OutboxMessage).filter(
+            OutboxMessage.id.in_([row.id for row in rows])).update({
+                OutboxMessage.status: OutboxMessage.CLAIMED,
+                OutboxMessage.claimed_at: now,
+                OutboxMessage.claimed_by: holder,
+                OutboxMessage.attempts: OutboxMessage.attempts + 1,
+            }, synchronize_session=False)
+        return [
+            Message(row.id, row.event_id, row.chat_id, row.attempts + 1)
+            for row in rows
+        ]
+
+    def finish(self, session, messages, report, now):
+        '''Marks claimed messages according to the `DeliveryReport`.
+
+        Failed sends go back to the queue with exponential backoff until
+        they run out of attempts. Chats which blocked the bot aren't
+        retried.
+        '''
+        unauthorized = set(report.unauthorized)
+        undelivered = set(report.undelivered)
+        sent = []
+        failed = []
+        for message in messages:
+            if message.chat_id in unauthorized:
+                failed.append(message.id)
+            elif message.chat_id not in undelivered:
+                sent.append(message.id)
+            elif message.attempts >= self.max_attempts:
+                failed.append(message.id)
+            else:
+                session.query(OutboxMessage).filter(
+                    OutboxMessage.id == message.id).update({
+                        OutboxMessage.status: OutboxMessage.PENDING,
+                        OutboxMessage.claimed_at: None,
+                        OutboxMessage.claimed_by: None,
+                        OutboxMessage.next_attempt_at: (
+                            now + self.backoff * 2 ** (message.attempts - 1)),
+                    }, synchronize_session=False)
+        for ids, values in (
+                (sent, {OutboxMessage.status: OutboxMessage.SENT,
+                        OutboxMessage.sent_at: now}),
+                (failed, {OutboxMessage.status: OutboxMessage.FAILED})):
+            if ids:
+                session.query(OutboxMessage).filter(
+                    OutboxMessage.id.in_(ids)).update(
+                        values, synchronize_session=False)
+
+    def complete(self, session):
+        '''Marks events with no messages left to send as notified.
+
+        Their messages are deleted. Returns a list of `Completion`, its
+        `elapsed` are seconds from the event to the last delivery, or None
+        if nothing was sent.
+        '''
+        completions = []
+        for event in session.query(AppointmentEvent).filter(
+                AppointmentEvent.notification_sent == False  # noqa: E712
+        ).order_by(AppointmentEvent.id):
+            counts = dict(session.query(
+                OutboxMessage.status, sqlalchemy.func.count()).filter(
+                    OutboxMessage.event_id == event.id).group_by(
+                        OutboxMessage.status))
+            if not counts or counts.get(OutboxMessage.PENDING) or \
+                    counts.get(OutboxMessage.CLAIMED):
+                continue
+            last_sent = session.query(sqlalchemy.func.max(
+                OutboxMessage.sent_at)).filter(
+                    OutboxMessage.event_id == event.id).scalar()
+            elapsed = None
+            if last_sent is not None:
+                elapsed = (last_sent - event.timestamp).total_seconds()
+                FANOUT_SECONDS.observe(elapsed)
+            session.query(OutboxMessage).filter(
+                OutboxMessage.event_id == event.id).delete(
+                    synchronize_session=False)
+            event.notification_sent = True
+            completions.append(Completion(
+                event, counts.get(OutboxMessage.SENT, 0),
+                counts.get(OutboxMessage.FAILED, 0), elapsed))
+        return completions
+
+    def next_attempt(self, session):
+        '''Returns the earliest time a queued message is due, or None.'''
+        return session.query(sqlalchemy.func.min(
+            OutboxMessage.next_attempt_at)).filter(
+                OutboxMessage.status == OutboxMessage.PENDING).scalar()
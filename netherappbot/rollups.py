@@ -0,0 +1,198 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Compaction of the event history.
+
+Polling records an event on every change of availability, so the events
+table grows without bound. Events older than the retention window are rolled
+up into hourly and daily `EventRollup` rows and deleted. Statistics and the
+scheduler read the rollups plus the recent raw events.
+'''
+
+import collections
+import datetime
+
+import sqlalchemy
+
+from .models import AppointmentEvent, Compaction, DeliveryMarker, EventRollup
+
+RETENTION = datetime.timedelta(days=30)
+HOUR = datetime.timedelta(hours=1)
+
+ALL_TARGETS = EventRollup.ALL_TARGETS
+
+
+def floor_hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def split_hours(start, end):
+    '''Yields (hour, seconds) covering the [start, end) interval.'''
+    while start < end:
+        hour = floor_hour(start)
+        stop = min(end, hour + HOUR)
+        yield hour, (stop - start).total_seconds()
+        start = stop
+
+
+class _Rollups(object):
+    '''Accumulates hourly buckets while events are replayed in order.'''
+
+    def __init__(self, since, previous):
+        self.buckets = collections.defaultdict(lambda: [0.0, 0, 0])
+        self.previous = dict(previous)
+        self.open_since = {
+            target: since for target, have in self.previous.items() if have}
+        self.any_open_since = since if self.open_since else None
+
+    def add_availability(self, target, start, end):
+        for hour, seconds in split_hours(start, end):
+            self.buckets[target, hour][0] += seconds
+
+    def record(self, target, timestamp, have_appointments):
+        was = self.previous.get(target, False)
+        self.previous[target] = have_appointments
+        if have_appointments == was:
+            return
+        hour = floor_hour(timestamp)
+        if have_appointments:
+            self.buckets[target, hour][1] += 1
+            if not self.open_since:
+                self.buckets[ALL_TARGETS, hour][1] += 1
+                self.any_open_since = timestamp
+            self.open_since[target] = timestamp
+        else:
+            self.buckets[target, hour][2] += 1
+            self.add_availability(
+                target, self.open_since.pop(target), timestamp)
+            if not self.open_since:
+                self.buckets[ALL_TARGETS, hour][2] += 1
+                self.add_availability(
+                    ALL_TARGETS, self.any_open_since, timestamp)
+                self.any_open_since = None
+
+    def finish(self, until):
+        '''Counts intervals still open at `until`.'''
+        for target, start in self.open_since.items():
+            self.add_availability(target, start, until)
+        if self.any_open_since is not None:
+            self.add_availability(ALL_TARGETS, self.any_open_since, until)
+
+    def rows(self):
+        '''Yields ((target, period, start), values) of hours and days.'''
+        days = collections.defaultdict(lambda: [0.0, 0, 0])
+        for (target, hour), values in self.buckets.items():
+            yield (target, EventRollup.HOUR, hour), values
+            day = days[target, floor_day(hour)]
+            for index, value in enumerate(values):
+                day[index] += value
+        for (target, day), values in days.items():
+            yield (target, EventRollup.DAY, day), values
+
+
+def _save(session, since, rollups):
+    existing = {}
+    if since is not None:
+        # A day may be split between compactions, hours never are.
+        for rollup in session.query(EventRollup).filter(
+                EventRollup.start >= floor_day(since)):
+            existing[rollup.target, rollup.period, rollup.start] = rollup
+    for key, (seconds, openings, closings) in rollups.rows():
+        rollup = existing.get(key)
+        if rollup is None:
+            target, period, start = key
+            session.add(EventRollup(
+                target=target, period=period, start=start,
+                availability_seconds=seconds, openings=openings,
+                closings=closings))
+        else:
+            rollup.availability_seconds += seconds
+            rollup.openings += openings
+            rollup.closings += closings
+
+
+def compact(session, now=None, retention=RETENTION):
+    '''Rolls up events older than `retention` and deletes them.
+
+    The last event of every target and events waiting for a notification
+    are kept. Returns the number of deleted events.
+    '''
+    now = now or datetime.datetime.utcnow()
+    cutoff = floor_hour(now - retention)
+    compaction = Compaction.get(session)
+    if compaction is None:
+        compaction = Compaction(id=1)
+        session.add(compaction)
+    since = compaction.compacted_until
+    if since is not None and cutoff <= since:
+        return 0
+
+    previous = {}
+    kept = {}
+    if since is not None:
+        for event in session.query(AppointmentEvent).filter(
+                AppointmentEvent.timestamp < since).order_by(
+                    AppointmentEvent.timestamp, AppointmentEvent.id):
+            previous[event.target] = event.have_appointments
+            kept[event.target] = event.id
+    rollups = _Rollups(since, previous)
+
+    events = session.query(
+        AppointmentEvent.id, AppointmentEvent.target,
+        AppointmentEvent.timestamp, AppointmentEvent.have_appointments,
+    ).filter(AppointmentEvent.timestamp < cutoff)
+    if since is not None:
+        events = events.filter(AppointmentEvent.timestamp >= since)
+    for event_id, target, timestamp, have_appointments in events.order_by(
+            AppointmentEvent.timestamp, AppointmentEvent.id).yield_per(1000):
+        if compaction.first_seen is None:
+            compaction.first_seen = timestamp
+        kept[target] = event_id
+        rollups.record(target, timestamp, have_appointments)
+    rollups.finish(cutoff)
+    _save(session, since, rollups)
+
+    delete = session.query(AppointmentEvent).filter(
+        AppointmentEvent.timestamp < cutoff,
+        AppointmentEvent.notification_sent == True)  # noqa: E712
+    if kept:
+        delete = delete.filter(~AppointmentEvent.id.in_(list(kept.values())))
+    deleted = delete.delete(synchronize_session=False)
+    session.query(DeliveryMarker).filter(~DeliveryMarker.event_id.in_(
+        sqlalchemy.select([AppointmentEvent.id]))).delete(
+            synchronize_session=False)
+    compaction.compacted_until = cutoff
+    return deleted
+
+
+def opening_counts(session):
+    '''Yields (timestamp, count) of every time a target got appointments.
+
+    Compacted history is reported at the start of the hour. New dates of
+    a target which already had appointments don't count.
+    '''
+    events = session.query(
+        AppointmentEvent.target, AppointmentEvent.timestamp,
+        AppointmentEvent.have_appointments).order_by(
+            AppointmentEvent.timestamp, AppointmentEvent.id)
+    previous = {}
+    compaction = Compaction.get(session)
+    if compaction is not None and compaction.compacted_until is not None:
+        for start, openings in session.query(
+                EventRollup.start, EventRollup.openings).filter(
+                    EventRollup.period == EventRollup.HOUR,
+                    EventRollup.target != ALL_TARGETS,
+                    EventRollup.openings > 0):
+            yield start, openings
+        since = compaction.compacted_until
+        for target, _, have_appointments in events.filter(
+                AppointmentEvent.timestamp < since):
+            previous[target] = have_appointments
+        events = events.filter(AppointmentEvent.timestamp >= since)
+    for target, timestamp, have_appointments in events:
+        if have_appointments and not previous.get(target, False):
+            yield timestamp, 1
+        previous[target] = have_appointments
@@ -0,0 +1,127 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Adaptive polling schedule of the watching loop.
+'''
+
+import datetime
+import logging
+import math
+import random
+import threading
+
+from .rollups import opening_counts
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class AdaptiveScheduler(object):
+    '''Picks the polling interval for the current time of day.
+
+    Days are split into buckets. A bucket in which appointments appeared
+    more often in the past is polled faster, the rest slower. Rates are
+    proportional to the square root of the bucket probability, which
+    minimizes the expected detection delay, and are normalized so the daily
+    number of requests is the same as with a fixed `base_interval`.
+
+    Failures back off exponentially until the next success.
+    '''
+
+    def __init__(self, base_interval, min_interval=None, max_interval=None,
+                 bucket_minutes=60, jitter=0.1, max_backoff=300,
+                 adaptive=True, relearn_every=datetime.timedelta(hours=1),
+                 random=random.random):
+        super(AdaptiveScheduler, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.base_interval = base_interval
+        self.min_interval = min_interval or base_interval / 5
+        self.max_interval = max_interval or base_interval * 5
+        self.bucket_seconds = bucket_minutes * 60
+        self.buckets = SECONDS_PER_DAY // self.bucket_seconds
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.adaptive = adaptive
+        self.relearn_every = relearn_every
+        self.random = random
+        self.lock = threading.Lock()
+        self.intervals = [base_interval] * self.buckets
+        self.learned_at = None
+        self.failures = 0
+        self.current_interval = base_interval
+
+    def bucket(self, timestamp):
+        seconds = (timestamp.hour * 60 + timestamp.minute) * 60
+        return seconds // self.bucket_seconds
+
+    def learn_counts(self, counts):
+        '''Sets intervals from the number of events in every bucket.
+
+        Rates clamped to the interval limits are fixed and the rest of the
+        budget is spread over the other buckets again until none of them
+        crosses a limit, so the limits never add requests.
+        '''
+        # Laplace smoothing, so quiet buckets are still polled.
+        weights = [math.sqrt(count + 1) for count in counts]
+        budget = len(weights) / self.base_interval
+        low, high = 1 / self.max_interval, 1 / self.min_interval
+        rates = [None] * len(weights)
+        while True:
+            free = [i for i, rate in enumerate(rates) if rate is None]
+            if not free:
+                break
+            scale = (budget - sum(
+                rate for rate in rates if rate is not None)) / sum(
+                    weights[i] for i in free)
+            above = [i for i in free if scale * weights[i] > high]
+            below = [i for i in free if scale * weights[i] < low]
+            if not above and not below:
+                for i in free:
+                    rates[i] = scale * weights[i]
+                break
+            # Only the larger side is sure to stay clamped once the rest
+            # is renormalized.
+            excess = sum(scale * weights[i] - high for i in above)
+            shortfall = sum(low - scale * weights[i] for i in below)
+            if excess >= shortfall:
+                for i in above:
+                    rates[i] = high
+            else:
+                for i in below:
+                    rates[i] = low
+        intervals = [1 / rate for rate in rates]
+        with self.lock:
+            self.intervals = intervals
+
+    def learn(self, session, now=None):
+        '''Relearns from the event history if it's time to.'''
+        now = now or datetime.datetime.utcnow()
+        if not self.adaptive or (
+                self.learned_at is not None and
+                now - self.learned_at < self.relearn_every):
+            return
+        counts = [0] * self.buckets
+        for timestamp, count in opening_counts(session):
+            counts[self.bucket(timestamp)] += count
+        self.learn_counts(counts)
+        self.learned_at = now
+        self.logger.info('Polling intervals: %s', ', '.join(
+            '{:.1f}'.format(interval) for interval in self.intervals))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def next_interval(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        with self.lock:
+            interval = self.intervals[self.bucket(now)]
+            if self.failures:
+                interval = min(
+                    self.max_backoff,
+                    interval * 2 ** min(self.failures, 32))
+            interval *= 1 + self.jitter * (2 * self.random() - 1)
+            self.current_interval = interval
+        return interval
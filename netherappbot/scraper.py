@@ -0,0 +1,246 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Scraping of the VFS appointment booking system.
+'''
+
+import collections
+import concurrent.futures
+import logging
+import time
+from urllib.parse import urljoin
+
+import requests
+
+from .extract import get_extractor
+from .metrics import STAGE_SECONDS, STAGE_RESPONSES, PARSE_SECONDS
+from .transport import Deadline, HttpClient
+
+BASE_URL = ('https://www.vfsvisaonline.com/'
+            'Netherlands-Global-Online-Appointment_Zone2/AppScheduling/')
+WELCOME_PAGE = (
+    BASE_URL +
+    'AppWelcome.aspx?P=yLSZQO8Ad673EXhKOPALC%2Fa6TdN5o6wQfJGZex2bh88%3D')
+NO_APPOINTMENTS = 'No date(s) available for appointment.'
+
+# Errors which only mean that this particular check failed.
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError, TimeoutError)
+# Seconds a whole welcome -> application cycle may take, retries included.
+CYCLE_DEADLINE = 30
+
+
+class Target(collections.namedtuple(
+        'Target', ('visa_category', 'applicants', 'welcome_page'))):
+    '''Combination of embassy zone, visa category and number of applicants.'''
+
+    @property
+    def key(self):
+        return '{}:{}:{}'.format(
+            self.visa_category, self.applicants, self.welcome_page)
+
+    @classmethod
+    def parse(cls, value):
+        '''Parses `CATEGORY:APPLICANTS[:WELCOME_PAGE]`.'''
+        parts = value.split(':', 2)
+        if len(parts) < 2:
+            raise ValueError('Invalid target: {}'.format(value))
+        welcome_page = parts[2] if len(parts) > 2 else WELCOME_PAGE
+        return cls(int(parts[0]), int(parts[1]), welcome_page)
+
+
+DEFAULT_TARGET = Target(898, 1, WELCOME_PAGE)
+
+
+class Result(collections.namedtuple('Result', ('message', 'dates'))):
+    '''Response message of the booking system and the available dates.'''
+
+    @property
+    def available(self):
+        return self.message != NO_APPOINTMENTS
+
+
+class Scraper(object):
+    '''Runs welcome -> appointment_type -> application flow for a target.
+
+    Every scraper owns its own HTTP session, so cookies of different targets
+    never mix. With `reuse` the application POST (its action and
+    `__VIEWSTATE`/`__EVENTVALIDATION` fields) is kept and re-issued alone
+    while the server accepts it; the full chain runs only when it doesn't.
+    '''
+
+    def __init__(self, target, extractor=None, reuse=True, http=None,
+                 deadline=CYCLE_DEADLINE):
+        super(Scraper, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.target = target
+        self.extractor = extractor or get_extractor()
+        self.reuse = reuse
+        self.application_request = None
+        self.http = http or HttpClient()
+        self.deadline = deadline
+
+    @property
+    def session(self):
+        return self.http.session
+
+    @session.setter
+    def session(self, session):
+        self.http.session = session
+
+    def load_page(self, stage, url, method='GET', data=None, deadline=None):
+        self.logger.info('%s: %s %s -> %r', stage, method, url, data)
+        started = time.monotonic()
+        try:
+            response = self.http.request(
+                stage, method, url, data=data, deadline=deadline)
+        except Exception:
+            STAGE_RESPONSES.labels(stage, 'error').inc()
+            raise
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.monotonic() - started)
+        STAGE_RESPONSES.labels(stage, response.status_code).inc()
+
+        if response.status_code >= 200 and response.status_code < 300:
+            with PARSE_SECONDS.labels(stage).time():
+                return self.extractor.extract(response.text)
+
+        self.logger.warning(
+            '%s: %s %s returned %d', stage, method, url,
+            response.status_code)
+        return None
+
+    def form_request(self, page):
+        '''Returns action URL and a copy of the form data of a page.'''
+        return urljoin(self.target.welcome_page, page.action), dict(
+            page.form_data)
+
+    def check(self):
+        '''Returns the booking system `Result` or None.
+
+        All requests share one deadline, so a check can't take much longer
+        than `self.deadline` seconds.
+        '''
+        deadline = Deadline(self.deadline)
+        if self.application_request is not None:
+            response = self.submit_application(
+                *self.application_request, deadline=deadline)
+            if response is not None:
+                return response
+            self.logger.info(
+                'Cached session state for %s is stale', self.target.key)
+            self.application_request = None
+
+        request = self.prepare_application(deadline)
+        if request is None:
+            return None
+        if self.reuse:
+            self.application_request = request
+        return self.submit_application(*request, deadline=deadline)
+
+    def warm_up(self):
+        '''Refreshes the cached application request without checking.
+
+        Keeps the session of a standby replica alive, so its first check
+        after a takeover needs a single request.
+        '''
+        if self.reuse:
+            self.application_request = self.prepare_application(
+                Deadline(self.deadline))
+
+    def prepare_application(self, deadline=None):
+        '''Runs welcome and appointment_type stages.
+
+        Returns action and form data of the application POST or None.
+        '''
+        page = self.load_page(
+            'welcome', self.target.welcome_page, deadline=deadline)
+        if page is None or page.action is None:
+            return None
+
+        action, args = self.form_request(page)
+        args['__EVENTTARGET'] = 'ctl00$plhMain$lnkSchApp'
+        args['__EVENTARGUMENT'] = ''
+
+        page = self.load_page(
+            'appointment_type', action, method='POST', data=args,
+            deadline=deadline)
+        if page is None or page.action is None:
+            return None
+        action, args = self.form_request(page)
+        args['ctl00$plhMain$tbxNumOfApplicants'] = self.target.applicants
+        args['ctl00$plhMain$cboVisaCategory'] = self.target.visa_category
+        return action, args
+
+    def submit_application(self, action, args, deadline=None):
+        page = self.load_page(
+            'application', action, method='POST', data=args,
+            deadline=deadline)
+        if page is None or page.message is None:
+            return None
+
+        self.logger.info(
+            'Response for %s: %s %s', self.target.key, page.message,
+            ', '.join(date.isoformat() for date in page.dates))
+        return Result(page.message, page.dates)
+
+
+class ScrapingPool(object):
+    '''Checks many targets at once on a bounded pool of worker threads.
+
+    A cycle takes about as long as the slowest target instead of the sum of
+    all of them.
+    '''
+
+    def __init__(self, targets, workers=None, parser=None, reuse=True,
+                 deadline=CYCLE_DEADLINE):
+        super(ScrapingPool, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        extractor = get_extractor(parser)
+        self.scrapers = [
+            Scraper(target, extractor, reuse=reuse, deadline=deadline)
+            for target in targets]
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or len(self.scrapers),
+            thread_name_prefix='Scraper')
+
+    @property
+    def targets(self):
+        return [scraper.target for scraper in self.scrapers]
+
+    def _check(self, scraper):
+        try:
+            return scraper.check()
+        except TRANSIENT_ERRORS:
+            self.logger.warning(
+                'Transient exception caught for %s', scraper.target.key,
+                exc_info=True)
+            return None
+
+    def check_all(self):
+        '''Returns a list of (target, result) pairs in targets order.'''
+        futures = [
+            self.executor.submit(self._check, scraper)
+            for scraper in self.scrapers
+        ]
+        return [
+            (scraper.target, future.result())
+            for scraper, future in zip(self.scrapers, futures)
+        ]
+
+    def _warm_up(self, scraper):
+        try:
+            scraper.warm_up()
+        except TRANSIENT_ERRORS:
+            self.logger.warning(
+                'Transient exception caught for %s', scraper.target.key,
+                exc_info=True)
+
+    def warm_up_all(self):
+        for _ in self.executor.map(self._warm_up, self.scrapers):
+            pass
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for scraper in self.scrapers:
+            scraper.http.close()
@@ -0,0 +1,257 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Notification delivery sharded across worker processes.
+
+Subscribers are split by `abs(chat_id) % shards`. For every pending event the
+coordinator in the main process creates one `DeliveryMarker` per shard. Each
+worker process claims markers of its own shard, sends to its subscribers and
+marks them done, so shards deliver in parallel and a crashed shard doesn't
+block the others.
+'''
+
+import contextlib
+import datetime
+import itertools
+import logging
+import multiprocessing
+
+import sqlalchemy
+import telegram
+
+from .database import create_engine
+from .delivery import TELEGRAM_RATE, Broadcaster
+from .logs import LogPipeline
+from .models import (
+    AppointmentEvent, DeliveryMarker, Statistics, Subscription, User)
+from .scraper import Target
+from .slots import decode_dates
+from .subscribers import audience, iter_subscriber_chunks
+
+# Markers claimed longer ago than this belong to a crashed worker.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+# Safety net in case a wakeup is missed.
+POLL_INTERVAL = 5
+SQL_CHUNK_SIZE = 500
+# Marker of the channel post, which the coordinator makes itself.
+CHANNEL_SHARD = -1
+
+
+def shard_filter(shard, shards):
+    return sqlalchemy.func.abs(User.chat_id) % shards == shard
+
+
+class ShardWorker(object):
+    def __init__(self, Session, client, shard, shards, delivery_workers=8,
+                 delivery_rate=TELEGRAM_RATE, channel=False, holder=None,
+                 stale_after=None):
+        super(ShardWorker, self).__init__()
+        self.logger = logging.getLogger(
+            '{}[{}]'.format(self.__class__.__name__, shard))
+        self.Session = Session
+        self.shard = shard
+        self.shards = shards
+        # The coordinator posts to the channel, its readers are skipped.
+        self.channel = channel
+        # Lease holder of the replica and the age after which claims of
+        # other replicas are abandoned, None without a lease.
+        self.holder = holder
+        self.stale_after = stale_after
+        # Telegram limits the bot as a whole, shards split the budget.
+        self.broadcaster = Broadcaster(
+            client, workers=delivery_workers, rate=delivery_rate / shards)
+
+    def claim(self, session):
+        '''Claims the oldest pending or abandoned marker of the shard.'''
+        now = datetime.datetime.utcnow()
+        candidates = session.query(DeliveryMarker.id).filter(
+            DeliveryMarker.shard == self.shard,
+            sqlalchemy.or_(
+                DeliveryMarker.status == DeliveryMarker.PENDING,
+                sqlalchemy.and_(
+                    DeliveryMarker.status == DeliveryMarker.CLAIMED,
+                    DeliveryMarker.claimed_at < now - CLAIM_TIMEOUT)),
+        ).order_by(DeliveryMarker.event_id).limit(10).all()
+        for marker_id, in candidates:
+            # Compare-and-set, so only one process wins the marker.
+            claimed = session.query(DeliveryMarker).filter(
+                DeliveryMarker.id == marker_id,
+                DeliveryMarker.status != DeliveryMarker.DONE,
+                sqlalchemy.or_(
+                    DeliveryMarker.claimed_at == None,  # noqa: E711
+                    DeliveryMarker.claimed_at < now - CLAIM_TIMEOUT),
+            ).update({
+                DeliveryMarker.status: DeliveryMarker.CLAIMED,
+                DeliveryMarker.claimed_at: now,
+                DeliveryMarker.claimed_by: self.holder,
+            }, synchronize_session=False)
+            session.commit()
+            if claimed:
+                return session.query(DeliveryMarker).get(marker_id)
+        return None
+
+    def release_claims(self):
+        '''Returns markers claimed by a previous process of the shard.
+
+        With a lease, markers of other replicas are released only once
+        they are `stale_after` old, a deposed leader may still be sending
+        the younger ones.
+        '''
+        with contextlib.closing(self.Session()) as session:
+            query = session.query(DeliveryMarker).filter(
+                DeliveryMarker.shard == self.shard,
+                DeliveryMarker.status == DeliveryMarker.CLAIMED)
+            if self.holder is not None:
+                query = query.filter(sqlalchemy.or_(
+                    DeliveryMarker.claimed_by == self.holder,
+                    DeliveryMarker.claimed_at <
+                    datetime.datetime.utcnow() - self.stale_after))
+            query.update({
+                DeliveryMarker.status: DeliveryMarker.PENDING,
+                DeliveryMarker.claimed_at: None,
+                DeliveryMarker.claimed_by: None,
+            }, synchronize_session=False)
+            session.commit()
+
+    def audience(self, session, marker):
+        event = session.query(AppointmentEvent).get(marker.event_id)
+        if event is None:
+            return None
+        target = Target.parse(event.target)
+        return audience(
+            target.visa_category, target.applicants,
+            decode_dates(event.slots), channel=self.channel)
+
+    def run_once(self):
+        '''Delivers one marker. Returns False if there was nothing to do.'''
+        with contextlib.closing(self.Session()) as session:
+            marker = self.claim(session)
+            if marker is None:
+                return False
+
+            report = self.broadcaster.broadcast(
+                itertools.chain.from_iterable(iter_subscriber_chunks(
+                    session, [shard_filter(self.shard, self.shards)],
+                    condition=self.audience(session, marker))),
+                marker.text)
+            self.logger.info(
+                'Event %d delivered to %d of %d users in %.3f s',
+                marker.event_id, report.sent, report.total, report.elapsed)
+
+            unauthorized = report.unauthorized
+            unsubscribed = 0
+            for start in range(0, len(unauthorized), SQL_CHUNK_SIZE):
+                chunk = unauthorized[start:start + SQL_CHUNK_SIZE]
+                unsubscribed += session.query(User).filter(
+                    User.chat_id.in_(chunk),
+                    User.subscribed == True).delete(  # noqa: E712
+                        synchronize_session=False)
+                session.query(User).filter(User.chat_id.in_(chunk)).delete(
+                    synchronize_session=False)
+                session.query(Subscription).filter(
+                    Subscription.chat_id.in_(chunk)).delete(
+                        synchronize_session=False)
+            if unsubscribed:
+                Statistics.add_subscribers(session, -unsubscribed)
+
+            marker.status = DeliveryMarker.DONE
+            marker.finished_at = datetime.datetime.utcnow()
+            marker.sent = report.sent
+            marker.failed = report.failed
+            session.commit()
+            return True
+
+    def close(self):
+        self.broadcaster.close()
+
+
+def run_shard(database, token, shard, shards, wakeup, shutdown,
+              delivery_workers, delivery_rate, channel, holder, stale_after):
+    '''Entry point of a worker process.'''
+    logs = LogPipeline()
+    logs.start()
+    engine = create_engine(database)
+    worker = ShardWorker(
+        sqlalchemy.orm.sessionmaker(bind=engine), telegram.Bot(token),
+        shard, shards, delivery_workers=delivery_workers,
+        delivery_rate=delivery_rate, channel=channel, holder=holder,
+        stale_after=stale_after)
+    try:
+        worker.release_claims()
+        while not shutdown.is_set():
+            if not worker.run_once():
+                wakeup.wait(POLL_INTERVAL)
+                wakeup.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+        engine.dispose()
+        logs.stop()
+
+
+class ShardPool(object):
+    '''Starts, wakes up and restarts the worker processes.
+
+    The pool may be started again after it's stopped, e.g. when the replica
+    regains the lease.
+    '''
+
+    def __init__(self, database, token, shards, delivery_workers=8,
+                 delivery_rate=TELEGRAM_RATE, channel=False, holder=None,
+                 stale_after=None):
+        super(ShardPool, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # Don't fork threads and open database connections.
+        self.context = multiprocessing.get_context('spawn')
+        self.args = (database, token)
+        self.shards = shards
+        self.delivery_workers = delivery_workers
+        self.delivery_rate = delivery_rate
+        self.channel = channel
+        self.holder = holder
+        self.stale_after = stale_after
+        self.shutdown = self.context.Event()
+        self.wakeups = [self.context.Event() for _ in range(shards)]
+        self.processes = [None] * shards
+
+    def _start(self, shard):
+        process = self.context.Process(
+            target=run_shard, name='DeliveryShard-{}'.format(shard),
+            args=self.args + (
+                shard, self.shards, self.wakeups[shard], self.shutdown,
+                self.delivery_workers, self.delivery_rate, self.channel,
+                self.holder, self.stale_after))
+        process.start()
+        self.processes[shard] = process
+
+    @property
+    def running(self):
+        return any(process is not None for process in self.processes)
+
+    def start(self):
+        self.shutdown.clear()
+        for shard in range(self.shards):
+            if self.processes[shard] is None:
+                self._start(shard)
+
+    def ensure_alive(self):
+        for shard, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                self.logger.error(
+                    'Delivery shard %d exited with %s, restarting',
+                    shard, process.exitcode)
+                self._start(shard)
+                self.wakeups[shard].set()
+
+    def wake(self):
+        for wakeup in self.wakeups:
+            wakeup.set()
+
+    def stop(self):
+        '''Waits for the workers to finish their markers and exit.'''
+        self.shutdown.set()
+        self.wake()
+        for shard, process in enumerate(self.processes):
+            if process is not None:
+                process.join()
+                self.processes[shard] = None
@@ -0,0 +1,91 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Available dates of targets: compact storage and diffing with debounce.
+'''
+
+import datetime
+
+DEBOUNCE = datetime.timedelta(minutes=5)
+# Slot of a page which offers appointments without dates we can read.
+ANY = 'any'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def encode_dates(dates):
+    '''Packs dates as the first date and a hex bitmask of day offsets.'''
+    dates = sorted(set(dates))
+    if not dates:
+        return None
+    mask = 0
+    for date in dates:
+        mask |= 1 << (date - dates[0]).days
+    return '{}:{:x}'.format(dates[0].strftime(DATE_FORMAT), mask)
+
+
+def decode_dates(value):
+    if not value:
+        return ()
+    first, mask = value.split(':')
+    first = datetime.datetime.strptime(first, DATE_FORMAT).date()
+    mask = int(mask, 16)
+    return tuple(
+        first + datetime.timedelta(days=offset)
+        for offset in range(mask.bit_length()) if mask >> offset & 1)
+
+
+class SlotTracker(object):
+    '''Decides which results of a target deserve an event.
+
+    The state of a target maps every slot seen available to the last time
+    it was seen. A slot which isn't there any more is forgotten only after
+    it has been missing for `debounce`, so a slot blinking in and out
+    raises nothing. Events are raised for slots which aren't in the state
+    and once the state becomes empty.
+    '''
+
+    def __init__(self, debounce=DEBOUNCE):
+        super(SlotTracker, self).__init__()
+        self.debounce = debounce
+        self.states = {}
+
+    def reset(self):
+        '''Forgets all targets, they are seeded from the database again.'''
+        self.states = {}
+
+    def known(self, key):
+        return key in self.states
+
+    def seed(self, key, available, now):
+        '''Starts tracking from the last stored state of the target.'''
+        self.states[key] = {ANY: now} if available else {}
+
+    def diff(self, key, available, dates, now):
+        '''Returns (change, state) without changing the tracker.
+
+        `change` is None, (True, new dates) or (False, ()) when everything
+        is gone. Store `state` with `commit` once the change is recorded.
+        '''
+        previous = self.states.get(key, {})
+        present = set(dates) or ({ANY} if available else set())
+        if ANY in present and previous:
+            # Dates can't be read this time, it's the same availability.
+            return None, {slot: now for slot in previous}
+        if ANY in previous and present:
+            # Dates became readable, adopt them silently.
+            return None, {slot: now for slot in present}
+
+        state = {
+            slot: seen for slot, seen in previous.items()
+            if slot in present or now - seen < self.debounce
+        }
+        new = present - set(state)
+        for slot in present:
+            state[slot] = now
+        if new:
+            return (True, tuple(sorted(new - {ANY}))), state
+        if previous and not state:
+            return (False, ()), state
+        return None, state
+
+    def commit(self, key, state):
+        self.states[key] = state
@@ -0,0 +1,325 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Process-local indexes of known chats, their subscription status and
+filters.
+'''
+
+import array
+import bisect
+import collections
+import heapq
+import threading
+
+import sqlalchemy
+
+from .models import Subscription, User
+
+# Subscription status of chats which read notifications in the channel.
+CHANNEL = 'channel'
+PENDING_KEY = 'subscriber_changes'
+FILTERS_PENDING_KEY = 'filter_changes'
+CHUNK_SIZE = 1000
+
+
+def _contains(values, value):
+    index = bisect.bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+
+def _add(values, value):
+    index = bisect.bisect_left(values, value)
+    if index == len(values) or values[index] != value:
+        values.insert(index, value)
+
+
+def _discard(values, value):
+    index = bisect.bisect_left(values, value)
+    if index < len(values) and values[index] == value:
+        del values[index]
+
+
+def merge_unique(*iterables):
+    '''Merges sorted iterables of chat ids, dropping duplicates.'''
+    last = None
+    for chat_id in heapq.merge(*iterables):
+        if chat_id != last:
+            yield chat_id
+            last = chat_id
+
+
+def audience(visa_category, applicants, dates=None, channel=False):
+    '''SQL condition of users notified about a target.
+
+    Subscribers get everything, the rest only what their filters match.
+    With `channel` the notification is posted to the channel, so users who
+    read it there are left out.
+    '''
+    criteria = [
+        Subscription.visa_category == visa_category,
+        Subscription.applicants == applicants,
+    ]
+    if dates:
+        criteria.append(sqlalchemy.or_(*[
+            sqlalchemy.and_(
+                sqlalchemy.or_(
+                    Subscription.date_from == None,  # noqa: E711
+                    Subscription.date_from <= date),
+                sqlalchemy.or_(
+                    Subscription.date_to == None,  # noqa: E711
+                    Subscription.date_to >= date))
+            for date in dates
+        ]))
+    condition = sqlalchemy.or_(
+        User.subscribed == True,  # noqa: E712
+        User.chat_id.in_(sqlalchemy.select([Subscription.chat_id]).where(
+            sqlalchemy.and_(*criteria))))
+    if channel:
+        condition = sqlalchemy.and_(condition, sqlalchemy.or_(
+            User.channel == None, User.channel == False))  # noqa: E711,E712
+    return condition
+
+
+def iter_subscriber_chunks(session, criteria=(), chunk_size=CHUNK_SIZE,
+                           condition=None):
+    '''Yields lists of subscribed chat ids using keyset pagination.
+
+    `condition` replaces "subscribed" as the test for a recipient. Only
+    `chat_id` is selected and only one chunk is held at a time, so memory
+    doesn't depend on the number of subscribers.
+    '''
+    if condition is None:
+        condition = User.subscribed == True  # noqa: E712
+    last = None
+    while True:
+        query = session.query(User.chat_id).filter(condition, *criteria)
+        if last is not None:
+            query = query.filter(User.chat_id > last)
+        chunk = [
+            chat_id for chat_id, in query.order_by(
+                User.chat_id).limit(chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+
+
+class _StagedIndex(object):
+    '''Base of indexes which follow committed database changes.
+
+    Changes are staged on the session which makes them and applied when it
+    commits, so the index never gets ahead of the database. A session sees
+    its own staged changes.
+    '''
+    pending_key = None
+
+    def __init__(self):
+        super(_StagedIndex, self).__init__()
+        self.lock = threading.Lock()
+
+    def attach(self, session_factory):
+        sqlalchemy.event.listen(session_factory, 'after_commit', self._apply)
+        sqlalchemy.event.listen(
+            session_factory, 'after_rollback', self._discard)
+
+    def _apply(self, session):
+        pending = session.info.pop(self.pending_key, None)
+        if not pending:
+            return
+        with self.lock:
+            self._apply_pending(pending)
+
+    def _discard(self, session):
+        session.info.pop(self.pending_key, None)
+
+
+class SubscriberIndex(_StagedIndex):
+    '''chat_id -> subscription status, kept as sorted arrays of 64-bit ints.
+
+    The status is False, True or `CHANNEL` for subscribers who read
+    notifications in the channel.
+    '''
+    pending_key = PENDING_KEY
+
+    def __init__(self):
+        super(SubscriberIndex, self).__init__()
+        self.known = array.array('q')
+        self.subscribed = array.array('q')
+        self.channel = array.array('q')
+
+    def load(self, session):
+        known = array.array('q')
+        subscribed = array.array('q')
+        channel = array.array('q')
+        for chat_id, is_subscribed, in_channel in session.query(
+                User.chat_id, User.subscribed, User.channel).order_by(
+                    User.chat_id):
+            known.append(chat_id)
+            if is_subscribed:
+                subscribed.append(chat_id)
+                if in_channel:
+                    channel.append(chat_id)
+        with self.lock:
+            self.known = known
+            self.subscribed = subscribed
+            self.channel = channel
+
+    def get(self, session, chat_id):
+        '''Returns None for unknown chats, otherwise subscription status.'''
+        pending = session.info.get(PENDING_KEY)
+        if pending and chat_id in pending:
+            return pending[chat_id]
+        with self.lock:
+            if not _contains(self.known, chat_id):
+                return None
+            if _contains(self.channel, chat_id):
+                return CHANNEL
+            return _contains(self.subscribed, chat_id)
+
+    def set(self, session, chat_id, subscribed):
+        '''Stages a change. None means that the chat was deleted.'''
+        session.info.setdefault(PENDING_KEY, {})[chat_id] = subscribed
+
+    def in_channel(self, chat_id):
+        with self.lock:
+            return _contains(self.channel, chat_id)
+
+    def subscribed_chat_ids(self):
+        with self.lock:
+            return self.subscribed.tolist()
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE, direct=False):
+        '''Yields subscribed chat ids in order, a chunk at a time.
+
+        Keyset pagination over the array, so concurrent changes never make it
+        skip or repeat a chat. With `direct` subscribers of the channel are
+        skipped.
+        '''
+        last = None
+        while True:
+            with self.lock:
+                start = (0 if last is None else
+                         bisect.bisect_right(self.subscribed, last))
+                chunk = self.subscribed[start:start + chunk_size].tolist()
+                if chunk and direct and self.channel:
+                    last = chunk[-1]
+                    chunk = [
+                        chat_id for chat_id in chunk
+                        if not _contains(self.channel, chat_id)]
+                    if not chunk:
+                        continue
+            if not chunk:
+                return
+            yield chunk
+            last = chunk[-1]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.subscribed)
+
+    def _apply_pending(self, pending):
+        for chat_id, subscribed in pending.items():
+            if subscribed is None:
+                _discard(self.known, chat_id)
+                _discard(self.subscribed, chat_id)
+                _discard(self.channel, chat_id)
+                continue
+            _add(self.known, chat_id)
+            if subscribed:
+                _add(self.subscribed, chat_id)
+            else:
+                _discard(self.subscribed, chat_id)
+            if subscribed == CHANNEL:
+                _add(self.channel, chat_id)
+            else:
+                _discard(self.channel, chat_id)
+
+
+def _overlaps(date_range, dates):
+    date_from, date_to = date_range
+    return any(
+        (date_from is None or date_from <= date) and
+        (date_to is None or date <= date_to)
+        for date in dates)
+
+
+class FilterIndex(_StagedIndex):
+    '''Inverted index (visa_category, applicants) -> {chat_id: dates}.
+
+    `dates` is a (date_from, date_to) pair, either may be None. A scrape
+    result is routed by its key without looking at other chats.
+    '''
+    pending_key = FILTERS_PENDING_KEY
+
+    def __init__(self):
+        super(FilterIndex, self).__init__()
+        self.keys = collections.defaultdict(dict)
+        self.chats = collections.defaultdict(dict)
+
+    def load(self, session):
+        keys = collections.defaultdict(dict)
+        chats = collections.defaultdict(dict)
+        for subscription in session.query(Subscription):
+            key = (subscription.visa_category, subscription.applicants)
+            dates = (subscription.date_from, subscription.date_to)
+            keys[key][subscription.chat_id] = dates
+            chats[subscription.chat_id][key] = dates
+        with self.lock:
+            self.keys = keys
+            self.chats = chats
+
+    def get(self, session, chat_id):
+        '''Returns {key: dates} of the chat.'''
+        with self.lock:
+            filters = dict(self.chats.get(chat_id, {}))
+        for changed_chat_id, key, dates in session.info.get(
+                self.pending_key, ()):
+            if changed_chat_id != chat_id:
+                continue
+            if key is None:
+                filters.clear()
+            elif dates is None:
+                filters.pop(key, None)
+            else:
+                filters[key] = dates
+        return filters
+
+    def set(self, session, chat_id, key, dates):
+        '''Stages a change. None `dates` removes the filter.'''
+        session.info.setdefault(self.pending_key, []).append(
+            (chat_id, key, dates))
+
+    def remove(self, session, chat_id):
+        '''Stages removal of every filter of the chat.'''
+        session.info.setdefault(self.pending_key, []).append(
+            (chat_id, None, None))
+
+    def match(self, key, dates=None):
+        '''Returns sorted chat ids with a filter matching the result.
+
+        Without `dates` every filter of the key matches.
+        '''
+        with self.lock:
+            chats = self.keys.get(key, {})
+            return sorted(
+                chat_id for chat_id, date_range in chats.items()
+                if dates is None or _overlaps(date_range, dates))
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(chats) for chats in self.keys.values())
+
+    def _apply_pending(self, pending):
+        for chat_id, key, dates in pending:
+            keys = [key] if key is not None else list(
+                self.chats.get(chat_id, ()))
+            for key in keys:
+                if dates is not None:
+                    self.keys[key][chat_id] = dates
+                    self.chats[chat_id][key] = dates
+                    continue
+                self.keys.get(key, {}).pop(chat_id, None)
+                self.chats.get(chat_id, {}).pop(key, None)
+                if not self.keys.get(key, True):
+                    del self.keys[key]
+            if not self.chats.get(chat_id, True):
+                del self.chats[chat_id]
@@ -8,6 +8,7 @@ import datetime
 import time
 
 from ..bot import Bot, TEXTS
+from ..models import LastUpdate, User
 
 
 class MockBot(Bot):
@@ -137,6 +138,28 @@ def test_subscribe():
     bot.interactive_loop()
 
 
+def test_subscribe_channel():
+    fixture = (
+        TelegramBotFixture()
+        .input_message(1, '/subscribe')
+        .expect_message(1, TEXTS.SUBSCRIBED_CHANNEL.format(
+            channel='https://t.me/alerts'))
+        .input_message(1, '/subscribe direct')
+        .expect_message(1, TEXTS.SUBSCRIBED)
+        .input_message(1, '/stats')
+        .expect_message(1, TEXTS.STATISTICS.format(
+            users_plural='is 1 person',
+            watching_for=datetime.timedelta(0),
+            seen_appointments=datetime.timedelta(0)))
+    )
+    bot = MockBot(fixture.client, 'sqlite:///:memory:', channel='@alerts',
+                  channel_link='https://t.me/alerts')
+    bot.interactive_loop()
+    session = bot.Session()
+    assert [(user.subscribed, user.channel)
+            for user in session.query(User)] == [(True, False)]
+
+
 def test_unsubscribe():
     fixture = (
         TelegramBotFixture()
@@ -178,3 +201,70 @@ def test_message():
     )
     bot = MockBot(fixture.client, 'sqlite:///:memory:')
     bot.interactive_loop()
+
+
+def test_stats_after_subscribe():
+    fixture = (
+        TelegramBotFixture()
+        .input_message(1, '/subscribe')
+        .expect_message(1, TEXTS.SUBSCRIBED)
+        .input_message(2, '/subscribe')
+        .expect_message(2, TEXTS.SUBSCRIBED)
+        .input_message(1, '/unsubscribe')
+        .expect_message(1, TEXTS.UNSUBSCRIBED)
+        .input_message(1, '/stats')
+        .expect_message(1, TEXTS.STATISTICS.format(
+            users_plural='is 1 person',
+            watching_for=datetime.timedelta(0),
+            seen_appointments=datetime.timedelta(0)))
+    )
+    bot = MockBot(fixture.client, 'sqlite:///:memory:')
+    bot.interactive_loop()
+
+
+def test_batch():
+    fixture = (
+        TelegramBotFixture()
+        .input_message(1, '/subscribe')
+        .input_message(2, '/start')
+        .input_message(1, 'Hello!')
+        .expect_message(1, TEXTS.SUBSCRIBED)
+        .expect_message(2, TEXTS.GREETINGS)
+        .expect_message(1, TEXTS.DONT_UNDERSTAND)
+    )
+    bot = MockBot(fixture.client, 'sqlite:///:memory:')
+    bot.interactive_loop()
+
+    assert bot.offset == 3
+    session = bot.Session()
+    assert session.query(LastUpdate).one().update_id == 2
+    assert sorted(
+        (user.chat_id, user.subscribed)
+        for user in session.query(User)) == [(1, True), (2, False)]
+
+
+def test_watch():
+    fixture = (
+        TelegramBotFixture()
+        .input_message(1, '/watch 898 1 2019-11-01 2019-12-15')
+        .expect_message(1, TEXTS.WATCHING.format(
+            visa_category=898, applicants_plural='1 applicant',
+            dates=' from 2019-11-01 to 2019-12-15'))
+        .input_message(1, '/watch 900 2')
+        .expect_message(1, TEXTS.UNKNOWN_TARGET.format(
+            visa_category=900, applicants_plural='2 applicants',
+            targets='898 for 1 applicant'))
+        .input_message(1, '/watch 898')
+        .expect_message(1, TEXTS.WATCH_USAGE)
+        .input_message(1, '/filters')
+        .expect_message(1, TEXTS.FILTERS.format(filters=TEXTS.FILTER.format(
+            visa_category=898, applicants_plural='1 applicant',
+            dates=' from 2019-11-01 to 2019-12-15')))
+        .input_message(1, '/unwatch')
+        .expect_message(1, TEXTS.UNWATCHED.format(count_plural='1 filter'))
+        .input_message(1, '/filters')
+        .expect_message(1, TEXTS.NO_FILTERS)
+    )
+    bot = MockBot(fixture.client, 'sqlite:///:memory:')
+    bot.interactive_loop()
+    assert bot.filters.match((898, 1)) == []
@@ -0,0 +1,54 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the engine setup and schema migrations.
+'''
+
+import sqlalchemy
+
+from ..database import MIGRATIONS, create_engine, migrate
+from ..scraper import DEFAULT_TARGET
+
+LEGACY_SCHEMA = (
+    'CREATE TABLE last_update (id INTEGER PRIMARY KEY, update_id INTEGER)',
+    'CREATE TABLE users (id INTEGER PRIMARY KEY, chat_id INTEGER UNIQUE, '
+    'subscribed BOOLEAN)',
+    'CREATE TABLE events (id INTEGER PRIMARY KEY, timestamp DATETIME, '
+    'have_appointments BOOLEAN, notification_sent BOOLEAN)',
+    "INSERT INTO events VALUES (1, '2019-10-01 12:00:00.000000', 1, 1)",
+)
+
+
+def schema_version(engine):
+    return engine.execute('SELECT version FROM schema_version').scalar()
+
+
+def test_fresh_database(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'bot.db'))
+    migrate(engine)
+    assert schema_version(engine) == len(MIGRATIONS)
+    assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+    index_names = {
+        index['name']
+        for index in sqlalchemy.inspect(engine).get_indexes('events')}
+    assert 'ix_events_target_timestamp' in index_names
+
+
+def test_legacy_database(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'bot.db'))
+    for statement in LEGACY_SCHEMA:
+        engine.execute(statement)
+
+    migrate(engine)
+    assert schema_version(engine) == len(MIGRATIONS)
+    assert engine.execute('SELECT target FROM events').scalar() == (
+        DEFAULT_TARGET.key)
+    assert engine.execute('SELECT slots FROM events').scalar() is None
+    assert engine.execute('SELECT channel FROM users').scalar() is None
+    index_names = {
+        index['name']
+        for index in sqlalchemy.inspect(engine).get_indexes('users')}
+    assert 'ix_users_subscribed' in index_names
+
+    # Running it again is a no-op.
+    migrate(engine)
+    assert schema_version(engine) == len(MIGRATIONS)
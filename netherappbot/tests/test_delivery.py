@@ -0,0 +1,97 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for notification delivery.
+'''
+
+import threading
+
+import telegram
+
+from ..delivery import TokenBucket, Broadcaster
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeTelegram(object):
+    def __init__(self, unauthorized=(), flood=(), failing=()):
+        self.unauthorized = set(unauthorized)
+        self.flood = set(flood)
+        # Chats whose next send fails.
+        self.failing = set(failing)
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        with self.lock:
+            if chat_id in self.flood:
+                self.flood.remove(chat_id)
+                raise telegram.error.RetryAfter(0)
+            if chat_id in self.unauthorized:
+                raise telegram.error.Unauthorized('Forbidden')
+            if chat_id in self.failing:
+                self.failing.remove(chat_id)
+                raise telegram.error.NetworkError('Bad Gateway')
+            self.sent.append((chat_id, text))
+
+
+def test_token_bucket_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+    for _ in range(40):
+        bucket.acquire()
+    # First 10 come from the initial burst, the rest at 10 per second.
+    assert abs(clock.now - 3.0) < 1e-6
+
+
+def test_token_bucket_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+    bucket.pause(5)
+    bucket.acquire()
+    assert clock.now >= 5
+
+
+def test_broadcast():
+    client = FakeTelegram(unauthorized={3, 7}, flood={5})
+    broadcaster = Broadcaster(client, workers=4, rate=1000)
+    try:
+        report = broadcaster.broadcast(range(10), 'Hi')
+    finally:
+        broadcaster.close()
+
+    assert report.sent == 8
+    assert report.failed == 0
+    assert sorted(report.unauthorized) == [3, 7]
+    assert sorted(chat_id for chat_id, _ in client.sent) == [
+        0, 1, 2, 4, 5, 6, 8, 9]
+
+
+def test_broadcast_streams_lazily():
+    client = FakeTelegram()
+    broadcaster = Broadcaster(client, workers=2, rate=100000)
+    consumed = []
+
+    def chat_ids():
+        for chat_id in range(1000):
+            # Never more than the window is queued ahead of the sends.
+            with client.lock:
+                assert chat_id - len(client.sent) <= broadcaster.window
+            consumed.append(chat_id)
+            yield chat_id
+
+    try:
+        report = broadcaster.broadcast(chat_ids(), 'Hi')
+    finally:
+        broadcaster.close()
+
+    assert report.total == report.sent == 1000
+    assert len(consumed) == 1000
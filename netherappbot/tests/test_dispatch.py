@@ -0,0 +1,102 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for concurrent handling of incoming messages.
+'''
+
+import contextlib
+import threading
+
+import pytest
+
+from ..bot import Bot, TEXTS
+from ..dispatch import ChatDispatcher
+from ..models import LastUpdate
+from .test_commands import TelegramBotFixture
+
+Chat = TelegramBotFixture.Chat
+Message = TelegramBotFixture.Message
+Update = TelegramBotFixture.Update
+
+
+def test_chats_run_in_parallel_in_order():
+    dispatcher = ChatDispatcher(workers=2)
+    second_chat_done = threading.Event()
+    handled = []
+
+    def handle(message):
+        if message.text == 'slow':
+            # Would time out if chat 2 waited behind chat 1.
+            assert second_chat_done.wait(5)
+        handled.append((message.chat.id, message.text))
+        if message.chat.id == 2:
+            second_chat_done.set()
+
+    try:
+        dispatcher.dispatch([
+            Message(Chat(1), 'slow'), Message(Chat(2), 'fast'),
+            Message(Chat(1), 'after slow')], handle)
+    finally:
+        dispatcher.close()
+    assert handled == [(2, 'fast'), (1, 'slow'), (1, 'after slow')]
+
+
+def test_failure_stops_its_chat():
+    dispatcher = ChatDispatcher(workers=2)
+    handled = []
+
+    def handle(message):
+        if message.text == 'bad':
+            raise ValueError(message.text)
+        handled.append((message.chat.id, message.text))
+
+    try:
+        with pytest.raises(ValueError):
+            dispatcher.dispatch([
+                Message(Chat(1), 'bad'), Message(Chat(2), 'ok'),
+                Message(Chat(1), 'skipped')], handle)
+    finally:
+        dispatcher.close()
+    assert handled == [(2, 'ok')]
+
+
+class SlowClient(object):
+    '''Blocks replies to chat 1 until chat 2 got its reply.'''
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+        self.replied = threading.Event()
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if chat_id == 1:
+            assert self.replied.wait(5)
+        with self.lock:
+            self.sent.append((chat_id, text))
+        if chat_id == 2:
+            self.replied.set()
+
+
+def test_batch_is_acknowledged_after_all_chats(tmp_path):
+    client = SlowClient()
+    bot = Bot(client, 'sqlite:///{}'.format(tmp_path / 'bot.db'),
+              command_workers=4)
+    try:
+        with contextlib.closing(bot.Session()) as session:
+            bot.process_updates(session, [
+                Update(10, Message(Chat(1), '/subscribe')),
+                Update(11, Message(Chat(2), '/start')),
+                Update(12, Message(Chat(1), '/unsubscribe')),
+            ])
+            assert session.query(LastUpdate).one().update_id == 12
+    finally:
+        bot.dispatcher.close()
+        bot.broadcaster.close()
+        bot.scrapers.close()
+
+    assert bot.offset == 13
+    assert client.sent == [
+        (2, TEXTS.GREETINGS), (1, TEXTS.SUBSCRIBED),
+        (1, TEXTS.UNSUBSCRIBED)]
+    with contextlib.closing(bot.Session()) as session:
+        assert bot.subscribers.get(session, 1) is False
+        assert bot.subscribers.get(session, 2) is False
@@ -0,0 +1,69 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for HTML extraction backends.
+'''
+
+import datetime
+import os
+
+import pytest
+
+from ..extract import BACKENDS, Page, get_extractor, parse_dates
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+PAGES = ('welcome', 'appointment_type', 'application', 'available')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'), encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('page', PAGES)
+def test_backends_agree(page):
+    html = load_fixture(page)
+    expected = BACKENDS['soup']().extract(html)
+    assert expected.action is not None
+    assert '__VIEWSTATE' in expected.form_data
+    for name, extractor in BACKENDS.items():
+        assert extractor().extract(html) == expected, name
+
+
+def test_application():
+    page = get_extractor('stream').extract(load_fixture('application'))
+    assert page.message == 'No date(s) available for appointment.'
+    assert 'ctl00$plhMain$btnCancel' not in page.form_data
+    assert page.form_data['ctl00$plhMain$tbxNumOfApplicants'] == '1'
+    assert page.dates == ()
+
+
+def test_available_dates():
+    page = get_extractor('stream').extract(load_fixture('available'))
+    assert page.message == 'Please select a date for your appointment.'
+    assert page.dates == (
+        datetime.date(2019, 11, 5), datetime.date(2019, 11, 7),
+        datetime.date(2019, 11, 21))
+    # Month switching links aren't dates.
+    href = "javascript:__doPostBack('ctl00$plhMain$cldAppointment','V7244')"
+    assert parse_dates([href]) == ()
+
+
+@pytest.mark.parametrize('html', [
+    '<html><body><p>Service unavailable</p></body></html>',
+    '',
+    ' \r\n',
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<html><body><p>Service unavailable</p></body></html>',
+])
+@pytest.mark.parametrize('name', list(BACKENDS))
+def test_no_form(name, html):
+    page = BACKENDS[name]().extract(html)
+    assert page == Page(None, {}, None, ())
+
+
+@pytest.mark.parametrize('name', list(BACKENDS))
+def test_xml_declaration(name):
+    page = BACKENDS[name]().extract(
+        '<?xml version="1.0" encoding="utf-8"?>\n' +
+        load_fixture('available'))
+    assert page == get_extractor('stream').extract(load_fixture('available'))
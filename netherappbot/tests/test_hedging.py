@@ -0,0 +1,79 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for hedged scraping.
+'''
+
+import contextlib
+import threading
+
+import pytest
+
+from ..bot import Bot
+from ..hedging import CHANGED, SAME, STALE, ResultMerger
+from ..models import AppointmentEvent
+from ..scraper import DEFAULT_TARGET, NO_APPOINTMENTS, Result
+from .test_delivery import FakeTelegram
+
+
+def test_merger():
+    merger = ResultMerger()
+    recorded = []
+
+    def record(value, changed=True):
+        def record():
+            recorded.append(value)
+            return changed
+        return record
+
+    assert merger.merge('a', 1.0, record(1)) == CHANGED
+    assert merger.merge('a', 2.0, record(2, changed=False)) == SAME
+    assert merger.merge('a', 3.0, record(3)) == CHANGED
+    # A check which started earlier can't flip the state back.
+    assert merger.merge('a', 2.5, record(4)) == STALE
+    assert merger.merge('b', 2.5, record(5)) == CHANGED
+    assert recorded == [1, 2, 3, 5]
+
+
+def test_merger_keeps_state_on_failure():
+    merger = ResultMerger()
+
+    def fail():
+        raise RuntimeError('database is gone')
+
+    with pytest.raises(RuntimeError):
+        merger.merge('a', 1.0, fail)
+    # The failed result didn't count, so an older one isn't stale.
+    assert merger.merge('a', 0.5, lambda: True) == CHANGED
+
+
+def test_hedged_lanes(tmp_path):
+    bot = Bot(FakeTelegram(), 'sqlite:///{}'.format(tmp_path / 'bot.db'),
+              hedge=2)
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+
+    def slow_check():
+        slow_started.set()
+        release_slow.wait(5)
+        return [(DEFAULT_TARGET, Result(NO_APPOINTMENTS, ()))]
+
+    bot.lanes[0].check_all = slow_check
+    bot.lanes[1].check_all = lambda: [
+        (DEFAULT_TARGET, Result('Pick a date', ()))]
+    try:
+        with contextlib.closing(bot.Session()) as session:
+            Bot.watching_loop.__wrapped__(bot, session)
+            assert slow_started.wait(5)
+            Bot.watching_loop.__wrapped__(bot, session)
+            # The first lane is still busy, its turn is skipped.
+            Bot.watching_loop.__wrapped__(bot, session)
+            release_slow.set()
+    finally:
+        bot.close_scrapers()
+        bot.broadcaster.close()
+
+    assert bot.new_events.is_set()
+    with contextlib.closing(bot.Session()) as session:
+        assert [
+            (event.have_appointments, event.notification_sent)
+            for event in session.query(AppointmentEvent)] == [(True, False)]
@@ -0,0 +1,207 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the leader lease of bot replicas.
+'''
+
+import contextlib
+import datetime
+
+from ..bot import Bot
+from ..lease import LeaderLease
+from ..models import AppointmentEvent, OutboxMessage, User
+from ..scraper import DEFAULT_TARGET, Result
+from .test_delivery import FakeClock, FakeTelegram
+
+NOW = datetime.datetime(2019, 11, 1, 12, 0)
+TTL = datetime.timedelta(seconds=15)
+
+
+class Clocks(object):
+    '''Wall and monotonic clocks moving together.'''
+
+    def __init__(self, start=NOW):
+        self.start = start
+        self.monotonic = FakeClock()
+
+    def utcnow(self):
+        return self.start + datetime.timedelta(seconds=self.monotonic.now)
+
+    def advance(self, seconds):
+        self.monotonic.sleep(seconds)
+
+
+def make_lease(clocks, holder):
+    return LeaderLease(holder=holder, ttl=TTL, clock=clocks.utcnow,
+                       monotonic=clocks.monotonic)
+
+
+def test_lease(tmp_path):
+    clocks = Clocks()
+    bot = Bot(FakeTelegram(), 'sqlite:///{}'.format(tmp_path / 'bot.db'))
+    bot.broadcaster.close()
+    bot.scrapers.close()
+    first = make_lease(clocks, 'first')
+    second = make_lease(clocks, 'second')
+    with contextlib.closing(bot.Session()) as session:
+        assert first.acquire(session)
+        assert not second.acquire(session)
+        clocks.advance(5)
+        assert first.acquire(session)
+        assert first.held() and not second.held()
+
+        # The first replica hangs. It stops leading before the lease
+        # expires for the others.
+        clocks.advance(11)
+        assert not first.held()
+        assert not second.acquire(session)
+        clocks.advance(5)
+        assert second.acquire(session)
+        assert not first.acquire(session)
+
+        second.release(session)
+        assert not second.held()
+        assert first.acquire(session)
+
+
+def test_standby_takes_over(tmp_path):
+    database = 'sqlite:///{}'.format(tmp_path / 'bot.db')
+    clocks = Clocks()
+    bots = []
+    for holder in ('active', 'standby'):
+        bots.append(Bot(FakeTelegram(), database,
+                        lease=make_lease(clocks, holder)))
+    active, standby = bots
+    warmed_up = []
+    standby.scrapers.warm_up_all = lambda: warmed_up.append(True)
+    standby.scrapers.check_all = None
+    try:
+        with contextlib.closing(active.Session()) as session:
+            Bot.lease_loop.__wrapped__(active, session)
+            Bot.lease_loop.__wrapped__(standby, session)
+            assert active.leader() and not standby.leader()
+
+            # Changes made by the leader while the standby waits.
+            session.add(User(chat_id=1, subscribed=True))
+            session.add(AppointmentEvent(
+                target=DEFAULT_TARGET.key, timestamp=NOW,
+                have_appointments=True, notification_sent=False))
+            session.commit()
+            Bot.watching_loop.__wrapped__(standby, session)
+            Bot.notification_loop.__wrapped__(standby, session)
+            assert warmed_up == [True]
+            assert standby.bot.sent == []
+
+            # The leader dies.
+            clocks.advance(16)
+            Bot.lease_loop.__wrapped__(standby, session)
+            assert standby.leader() and not active.leader()
+            assert standby.new_events.is_set()
+            Bot.notification_loop.__wrapped__(standby, session)
+            Bot.notification_loop.__wrapped__(standby, session)
+            assert [chat_id for chat_id, _ in standby.bot.sent] == [1]
+    finally:
+        for bot in bots:
+            bot.broadcaster.close()
+            bot.scrapers.close()
+
+
+class FakeShardPool(object):
+    shards = 1
+
+    def __init__(self):
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+def test_deposed_leader_keeps_its_claims(tmp_path):
+    database = 'sqlite:///{}'.format(tmp_path / 'bot.db')
+    # The outbox compares claims with the real time.
+    clocks = Clocks(datetime.datetime.utcnow())
+    bots = []
+    for holder in ('active', 'standby'):
+        bots.append(Bot(FakeTelegram(), database,
+                        lease=make_lease(clocks, holder)))
+    active, standby = bots
+    standby.scrapers.warm_up_all = lambda: None
+    try:
+        with contextlib.closing(active.Session()) as session:
+            Bot.lease_loop.__wrapped__(active, session)
+            session.add(User(chat_id=1, subscribed=True))
+            session.add(AppointmentEvent(
+                id=1, target=DEFAULT_TARGET.key, timestamp=NOW,
+                have_appointments=True, notification_sent=False))
+            active.outbox.enqueue(session, 1, [1, 2])
+            session.commit()
+            clocks.advance(5)
+            active.outbox.claim(session, clocks.utcnow(), holder='active')
+            session.commit()
+
+            # The leader hangs while sending, but isn't dead.
+            clocks.advance(11)
+            Bot.lease_loop.__wrapped__(standby, session)
+            assert standby.leader()
+            assert {message.status for message in session.query(
+                OutboxMessage)} == {OutboxMessage.CLAIMED}
+            Bot.notification_loop.__wrapped__(standby, session)
+            assert standby.bot.sent == []
+
+            # Claims older than the lease belong to a crashed leader.
+            standby.leading.clear()
+            clocks.advance(5)
+            Bot.lease_loop.__wrapped__(standby, session)
+            Bot.notification_loop.__wrapped__(standby, session)
+            assert sorted(
+                chat_id for chat_id, _ in standby.bot.sent) == [1, 2]
+    finally:
+        for bot in bots:
+            bot.broadcaster.close()
+            bot.scrapers.close()
+
+
+def test_lost_lease_stops_shards(tmp_path):
+    database = 'sqlite:///{}'.format(tmp_path / 'bot.db')
+    clocks = Clocks()
+    active = Bot(FakeTelegram(), database, shard_pool=FakeShardPool(),
+                 lease=make_lease(clocks, 'active'))
+    standby = make_lease(clocks, 'standby')
+    try:
+        with contextlib.closing(active.Session()) as session:
+            Bot.lease_loop.__wrapped__(active, session)
+            assert active.shard_pool.running
+
+            clocks.advance(16)
+            assert standby.acquire(session)
+            assert not active.leader()
+            Bot.lease_loop.__wrapped__(active, session)
+            assert not active.shard_pool.running
+    finally:
+        active.broadcaster.close()
+        active.scrapers.close()
+
+
+def test_result_after_lease_lapse_is_dropped(tmp_path):
+    clocks = Clocks()
+    bot = Bot(FakeTelegram(), 'sqlite:///{}'.format(tmp_path / 'bot.db'),
+              lease=make_lease(clocks, 'active'))
+
+    def slow_check():
+        # The check outlasts the lease.
+        clocks.advance(16)
+        return [(DEFAULT_TARGET, Result('Pick a date', ()))]
+
+    bot.scrapers.check_all = slow_check
+    try:
+        with contextlib.closing(bot.Session()) as session:
+            Bot.lease_loop.__wrapped__(bot, session)
+            bot.new_events.clear()
+            Bot.watching_loop.__wrapped__(bot, session)
+            assert session.query(AppointmentEvent).count() == 0
+            assert not bot.new_events.is_set()
+    finally:
+        bot.broadcaster.close()
+        bot.scrapers.close()
@@ -0,0 +1,87 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the logging pipeline.
+'''
+
+import io
+import logging
+import queue
+import sys
+
+from ..logs import CompactFormatter, LogPipeline, QueueHandler, SiteFilter
+from ..metrics import LOG_DROPPED
+from .test_delivery import FakeClock
+
+
+def make_record(line=1, level=logging.INFO, name='Broadcaster', msg='x',
+                args=(), exc_info=None):
+    return logging.LogRecord(
+        name, level, 'delivery.py', line, msg, args, exc_info)
+
+
+def passed(site_filter, records):
+    return [record for record in records if site_filter.filter(record)]
+
+
+def test_sampling_per_call_site():
+    site_filter = SiteFilter({'Broadcaster': 0.25}, rate=0)
+    records = [make_record(line=line % 2) for line in range(16)]
+    kept = passed(site_filter, records)
+    assert [record.lineno for record in kept] == [0, 1, 0, 1]
+    assert [record.suppressed for record in kept] == [0, 0, 3, 3]
+    # Other loggers and warnings aren't sampled.
+    assert len(passed(site_filter, [
+        make_record(name='Bot') for _ in range(4)])) == 4
+    assert len(passed(site_filter, [
+        make_record(level=logging.WARNING) for _ in range(4)])) == 4
+
+
+def test_rate_limit():
+    clock = FakeClock()
+    site_filter = SiteFilter(rate=2, clock=clock)
+    assert len(passed(site_filter, [make_record() for _ in range(5)])) == 2
+    clock.now = 1.0
+    [record] = passed(site_filter, [make_record()])
+    assert record.suppressed == 3
+    assert len(passed(site_filter, [make_record(line=2)])) == 1
+
+
+def test_compact_format():
+    try:
+        raise ValueError('bad\tvalue')
+    except ValueError:
+        record = make_record(
+            msg='==> %d: %s', args=(5, 'two\nlines'), exc_info=sys.exc_info())
+    record.suppressed = 7
+    line = CompactFormatter().format(record)
+    assert '\n' not in line
+    fields = line.split('\t')
+    assert fields[1:4] == ['I', 'Broadcaster', record.threadName]
+    assert fields[4].startswith('==> 5: two\\nlines\\nTraceback')
+    assert fields[4].endswith('ValueError: bad\\tvalue')
+    assert fields[5] == 'suppressed=7'
+
+
+def test_full_queue_drops():
+    handler = QueueHandler(queue.Queue(1))
+    dropped = LOG_DROPPED.labels().value
+    handler.handle(make_record())
+    handler.handle(make_record())
+    assert handler.queue.qsize() == 1
+    assert LOG_DROPPED.labels().value == dropped + 1
+
+
+def test_pipeline():
+    stream = io.StringIO()
+    logs = LogPipeline(level=logging.DEBUG, stream=stream, rate=0)
+    logs.start()
+    try:
+        for number in range(300):
+            logging.getLogger('Broadcaster').info('==> %d: %s', number, 'Hi')
+        logging.getLogger('Bot').debug('<== %d: %s', 1, '/start')
+    finally:
+        logs.stop()
+    lines = stream.getvalue().splitlines()
+    assert [line.split('\t')[4] for line in lines] == [
+        '==> 0: Hi', '==> 100: Hi', '==> 200: Hi', '<== 1: /start']
+    assert lines[1].endswith('suppressed=99')
@@ -0,0 +1,67 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the metrics endpoint.
+'''
+
+import urllib.request
+
+import pytest
+import sqlalchemy
+
+from ..metrics import (
+    DB_QUERY_SECONDS, Registry, MetricsServer, instrument_engine)
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter(
+        'requests_total', 'Requests.', ('stage', 'status'))
+    latency = registry.histogram(
+        'latency_seconds', 'Latency.', ('stage',), buckets=(0.1, 1.0))
+    depth = registry.gauge('depth', 'Depth.')
+
+    requests.labels('welcome', 200).inc()
+    requests.labels('welcome', 200).inc()
+    latency.labels('welcome').observe(0.05)
+    latency.labels('welcome').observe(0.5)
+    latency.labels('welcome').observe(5)
+    depth.set_function(lambda: 3)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{stage="welcome",status="200"} 2.0' in lines
+    assert 'latency_seconds_bucket{stage="welcome",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{stage="welcome",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{stage="welcome",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{stage="welcome"} 5.55' in lines
+    assert 'latency_seconds_count{stage="welcome"} 3' in lines
+    assert 'depth 3.0' in lines
+
+
+def test_server():
+    registry = Registry()
+    registry.counter('up', 'Up.').inc()
+    server = MetricsServer(('127.0.0.1', 0), registry=registry)
+    server.start()
+    try:
+        url = 'http://{}:{}/metrics'.format(*server.address[:2])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            body = response.read().decode('utf-8')
+    finally:
+        server.stop()
+    assert 'up 1.0' in body.splitlines()
+
+
+def test_instrument_engine():
+    engine = sqlalchemy.create_engine('sqlite:///:memory:')
+    instrument_engine(engine)
+    selects = DB_QUERY_SECONDS.labels('SELECT')
+    count = selects.count
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                connection.execute('SELECT * FROM missing')
+        assert connection.execute('SELECT 1').scalar() == 1
+        # Failed statements leave nothing behind on the connection.
+        assert connection.info == {}
+    assert selects.count == count + 1
@@ -0,0 +1,54 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the database models.
+'''
+
+import contextlib
+import datetime
+
+import sqlalchemy
+
+from ..models import Base, AppointmentEvent, Statistics
+
+
+def make_session():
+    engine = sqlalchemy.create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(engine)
+    return sqlalchemy.orm.sessionmaker(bind=engine)()
+
+
+def test_statistics_incremental_matches_rebuild():
+    start = datetime.datetime(2019, 10, 1)
+    history = [
+        ('a', 0, False),
+        ('a', 10, True),
+        ('b', 15, True),
+        ('a', 20, False),
+        ('b', 30, False),
+        ('a', 100, True),
+        ('a', 145, False),
+        ('a', 200, True),
+    ]
+
+    with contextlib.closing(make_session()) as session:
+        stats = Statistics(id=1, availability_seconds=0.0, open_targets=0)
+        session.add(stats)
+        previous = {}
+        for target, offset, have_appointments in history:
+            timestamp = start + datetime.timedelta(seconds=offset)
+            session.add(AppointmentEvent(
+                target=target, timestamp=timestamp,
+                have_appointments=have_appointments))
+            stats.record_event(
+                timestamp, have_appointments, previous.get(target, False))
+            previous[target] = have_appointments
+        session.commit()
+        incremental = (stats.first_seen, stats.availability_seconds,
+                       stats.open_since, stats.open_targets)
+
+        stats = Statistics.rebuild(session)
+        assert incremental == (
+            stats.first_seen, stats.availability_seconds,
+            stats.open_since, stats.open_targets)
+        assert stats.availability_seconds == 65.0
+        assert stats.open_since == start + datetime.timedelta(seconds=200)
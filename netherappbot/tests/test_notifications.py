@@ -0,0 +1,145 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the path from a detected appointment to notifications.
+'''
+
+import contextlib
+import datetime
+import threading
+import time
+
+from ..bot import Bot
+from ..models import AppointmentEvent, OutboxMessage, User
+from ..scraper import DEFAULT_TARGET, Result, Target
+from ..subscribers import CHANNEL
+from .test_delivery import FakeTelegram
+
+
+def make_bot(tmp_path, subscribers):
+    bot = Bot(FakeTelegram(), 'sqlite:///{}'.format(tmp_path / 'bot.db'))
+    with contextlib.closing(bot.Session()) as session:
+        session.add_all([
+            User(chat_id=chat_id, subscribed=True)
+            for chat_id in subscribers
+        ])
+        session.commit()
+        bot.subscribers.load(session)
+    return bot
+
+
+def test_watching_loop_wakes_notifier(tmp_path):
+    bot = make_bot(tmp_path, [1, 2])
+    bot.scrapers.check_all = lambda: [
+        (DEFAULT_TARGET, Result('Pick a date', ()))]
+    notifier = threading.Thread(target=bot.notification_loop)
+    notifier.start()
+    try:
+        # Let the notifier go to sleep first.
+        time.sleep(0.2)
+        started = time.monotonic()
+        with contextlib.closing(bot.Session()) as session:
+            Bot.watching_loop.__wrapped__(bot, session)
+            session.commit()
+
+        while len(bot.bot.sent) < 2 and time.monotonic() - started < 5:
+            time.sleep(0.01)
+        assert time.monotonic() - started < 1
+        assert sorted(chat_id for chat_id, _ in bot.bot.sent) == [1, 2]
+    finally:
+        bot.shutdown = True
+        bot.new_events.set()
+        notifier.join()
+        bot.broadcaster.close()
+        bot.scrapers.close()
+
+
+def test_channel_notifications(tmp_path):
+    bot = make_bot(tmp_path, [2])
+    bot.channel = '@alerts'
+    with contextlib.closing(bot.Session()) as session:
+        for chat_id in (1, 4):
+            session.add(User(chat_id=chat_id, subscribed=True, channel=True))
+            bot.subscribers.set(session, chat_id, CHANNEL)
+        session.add(User(chat_id=3, subscribed=False))
+        for chat_id in (3, 4):
+            bot.filters.set(session, chat_id, (898, 1), (None, None))
+        session.add(AppointmentEvent(
+            target=DEFAULT_TARGET.key, timestamp=datetime.datetime.utcnow(),
+            have_appointments=True, notification_sent=False))
+        session.commit()
+
+        try:
+            Bot.notification_loop.__wrapped__(bot, session)
+        finally:
+            bot.broadcaster.close()
+            bot.scrapers.close()
+    assert [chat_id for chat_id, _ in bot.bot.sent[:1]] == ['@alerts']
+    assert sorted(chat_id for chat_id, _ in bot.bot.sent[1:]) == [2, 3]
+
+
+def test_failed_channel_post_doesnt_block_direct(tmp_path):
+    bot = make_bot(tmp_path, [2, 3])
+    bot.channel = '@alerts'
+    bot.bot.unauthorized.add('@alerts')
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            target=DEFAULT_TARGET.key, timestamp=datetime.datetime.utcnow(),
+            have_appointments=True, notification_sent=False))
+        session.commit()
+
+        try:
+            Bot.notification_loop.__wrapped__(bot, session)
+            Bot.notification_loop.__wrapped__(bot, session)
+        finally:
+            bot.broadcaster.close()
+            bot.scrapers.close()
+        # The bot isn't in the channel, the post isn't retried.
+        assert session.query(AppointmentEvent).one().notification_sent
+    assert sorted(chat_id for chat_id, _ in bot.bot.sent) == [2, 3]
+
+
+def test_channel_post_is_retried(tmp_path):
+    bot = make_bot(tmp_path, [2])
+    bot.channel = '@alerts'
+    bot.bot.failing.add('@alerts')
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            target=DEFAULT_TARGET.key, timestamp=datetime.datetime.utcnow(),
+            have_appointments=True, notification_sent=False))
+        session.commit()
+
+        try:
+            Bot.notification_loop.__wrapped__(bot, session)
+            assert [chat_id for chat_id, _ in bot.bot.sent] == [2]
+            assert not session.query(AppointmentEvent).one().notification_sent
+
+            session.query(OutboxMessage).update(
+                {OutboxMessage.next_attempt_at: None},
+                synchronize_session=False)
+            session.commit()
+            Bot.notification_loop.__wrapped__(bot, session)
+        finally:
+            bot.broadcaster.close()
+            bot.scrapers.close()
+        assert session.query(AppointmentEvent).one().notification_sent
+    assert [chat_id for chat_id, _ in bot.bot.sent] == [2, '@alerts']
+
+
+def test_filters_route_notifications(tmp_path):
+    bot = make_bot(tmp_path, [1, 5])
+    other = Target(898, 2, DEFAULT_TARGET.welcome_page)
+    bot.targets[other.key] = other
+    with contextlib.closing(bot.Session()) as session:
+        session.add(User(chat_id=3, subscribed=False))
+        bot.filters.set(session, 3, (898, 2), (None, None))
+        bot.filters.set(session, 5, (898, 2), (None, None))
+        session.commit()
+
+    try:
+        assert list(bot.recipients(
+            AppointmentEvent(target=DEFAULT_TARGET.key))) == [1, 5]
+        assert list(bot.recipients(
+            AppointmentEvent(target=other.key))) == [1, 3, 5]
+    finally:
+        bot.broadcaster.close()
+        bot.scrapers.close()
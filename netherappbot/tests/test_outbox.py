@@ -0,0 +1,140 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the notification outbox.
+'''
+
+import contextlib
+import datetime
+
+from ..bot import Bot
+from ..models import AppointmentEvent, OutboxMessage, User
+from ..outbox import Outbox
+from ..scraper import DEFAULT_TARGET
+from .test_delivery import FakeTelegram
+
+NOW = datetime.datetime(2019, 11, 1, 12, 0)
+SECOND = datetime.timedelta(seconds=1)
+
+
+def make_bot(database, client, subscribers=(), **kwargs):
+    bot = Bot(client, database, **kwargs)
+    with contextlib.closing(bot.Session()) as session:
+        for chat_id in subscribers:
+            bot.subscribers.set(session, chat_id, True)
+            session.add(User(chat_id=chat_id, subscribed=True))
+        session.commit()
+    return bot
+
+
+def add_event(bot):
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            target=DEFAULT_TARGET.key, timestamp=NOW,
+            have_appointments=True, notification_sent=False))
+        session.commit()
+
+
+def notify(bot):
+    with contextlib.closing(bot.Session()) as session:
+        Bot.notification_loop.__wrapped__(bot, session)
+        session.commit()
+
+
+def test_restart_sends_only_undelivered(tmp_path):
+    database = 'sqlite:///{}'.format(tmp_path / 'bot.db')
+    client = FakeTelegram()
+    bot = make_bot(database, client, [1, 2, 3, 4, 5],
+                   outbox=Outbox(batch_size=2))
+    add_event(bot)
+    notify(bot)
+    bot.broadcaster.close()
+    bot.scrapers.close()
+    assert sorted(chat_id for chat_id, _ in client.sent) == [1, 2]
+
+    # The process dies with a claimed batch.
+    with contextlib.closing(bot.Session()) as session:
+        Outbox(batch_size=2).claim(session, datetime.datetime.utcnow())
+        session.commit()
+
+    bot = make_bot(database, client, outbox=Outbox(batch_size=2))
+    try:
+        for _ in range(3):
+            notify(bot)
+    finally:
+        bot.broadcaster.close()
+        bot.scrapers.close()
+    assert sorted(chat_id for chat_id, _ in client.sent) == [1, 2, 3, 4, 5]
+    with contextlib.closing(bot.Session()) as session:
+        assert session.query(AppointmentEvent).one().notification_sent
+        assert session.query(OutboxMessage).count() == 0
+
+
+class Report(object):
+    def __init__(self, unauthorized=(), undelivered=()):
+        self.unauthorized = unauthorized
+        self.undelivered = undelivered
+
+
+def test_retries_with_backoff(tmp_path):
+    bot = make_bot('sqlite:///{}'.format(tmp_path / 'bot.db'), FakeTelegram())
+    bot.broadcaster.close()
+    bot.scrapers.close()
+    outbox = Outbox(max_attempts=2, backoff=10 * SECOND)
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            id=1, timestamp=NOW, notification_sent=False))
+        assert outbox.enqueue(session, 1, [1, 2, 3]) == 3
+        assert outbox.enqueued(session, 1)
+
+        messages = outbox.claim(session, NOW)
+        assert [message.chat_id for message in messages] == [1, 2, 3]
+        assert outbox.claim(session, NOW) == []
+        outbox.finish(session, messages, Report(
+            unauthorized=[1], undelivered=[2]), NOW)
+        assert outbox.next_attempt(session) == NOW + 10 * SECOND
+        assert outbox.claim(session, NOW + 9 * SECOND) == []
+        assert outbox.complete(session) == []
+
+        messages = outbox.claim(session, NOW + 10 * SECOND)
+        assert [(message.chat_id, message.attempts)
+                for message in messages] == [(2, 2)]
+        # Out of attempts.
+        outbox.finish(session, messages, Report(undelivered=[2]), NOW)
+        [completion] = outbox.complete(session)
+        assert (completion.event.id, completion.sent, completion.failed) == (
+            1, 1, 2)
+        assert session.query(OutboxMessage).count() == 0
+
+
+def test_completion_time(tmp_path):
+    bot = make_bot('sqlite:///{}'.format(tmp_path / 'bot.db'), FakeTelegram())
+    bot.broadcaster.close()
+    bot.scrapers.close()
+    outbox = Outbox(batch_size=1)
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            id=1, timestamp=NOW, notification_sent=False))
+        outbox.enqueue(session, 1, [1, 2])
+        for seconds in (3, 7):
+            messages = outbox.claim(session, NOW + seconds * SECOND)
+            outbox.finish(
+                session, messages, Report(), NOW + seconds * SECOND)
+        [completion] = outbox.complete(session)
+        # From the event to the last delivery, not of the last batch.
+        assert completion.elapsed == 7
+
+
+def test_failed_send_is_retried(tmp_path):
+    client = FakeTelegram(failing={2})
+    bot = make_bot('sqlite:///{}'.format(tmp_path / 'bot.db'), client,
+                   [1, 2, 3], outbox=Outbox(backoff=datetime.timedelta(0)))
+    add_event(bot)
+    try:
+        notify(bot)
+        assert sorted(chat_id for chat_id, _ in client.sent) == [1, 3]
+        assert bot.notification_delay == 0
+        notify(bot)
+    finally:
+        bot.broadcaster.close()
+        bot.scrapers.close()
+    assert sorted(chat_id for chat_id, _ in client.sent) == [1, 2, 3]
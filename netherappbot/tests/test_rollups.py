@@ -0,0 +1,133 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the event history compaction.
+'''
+
+import contextlib
+import datetime
+
+import sqlalchemy
+
+from ..models import (
+    Base, AppointmentEvent, DeliveryMarker, EventRollup, Statistics)
+from ..rollups import compact, opening_counts, split_hours
+
+START = datetime.datetime(2019, 10, 1)
+HISTORY = [
+    # target, minutes since START, have_appointments
+    ('a', 0, False),
+    ('a', 50, True),
+    ('b', 55, True),
+    ('a', 70, False),
+    ('b', 100, False),
+    ('a', 60 * 24 + 10, True),
+    ('a', 60 * 24 + 40, False),
+    ('b', 60 * 47, True),
+    ('a', 60 * 60, True),
+    ('a', 60 * 60 + 30, False),
+]
+
+
+def make_session():
+    engine = sqlalchemy.create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(engine)
+    return sqlalchemy.orm.sessionmaker(bind=engine)()
+
+
+def populate(session):
+    for target, minutes, have_appointments in HISTORY:
+        session.add(AppointmentEvent(
+            target=target, have_appointments=have_appointments,
+            notification_sent=True,
+            timestamp=START + datetime.timedelta(minutes=minutes)))
+    session.commit()
+
+
+def summary(stats, now=START + datetime.timedelta(days=90)):
+    seconds = stats.availability_seconds
+    if stats.open_since is not None:
+        # Rollups also hold the part of the open interval before compaction.
+        seconds += (now - stats.open_since).total_seconds()
+    return stats.first_seen, seconds, stats.open_targets
+
+
+def test_split_hours():
+    assert list(split_hours(
+        START + datetime.timedelta(minutes=50),
+        START + datetime.timedelta(minutes=130))) == [
+            (START, 600.0),
+            (START + datetime.timedelta(hours=1), 3600.0),
+            (START + datetime.timedelta(hours=2), 600.0)]
+
+
+def test_compact():
+    with contextlib.closing(make_session()) as session:
+        populate(session)
+        session.add(DeliveryMarker(event_id=1, shard=0))
+        expected = summary(Statistics.rebuild(session))
+
+        # Everything before 2019-10-02 05:00 goes to rollups.
+        now = START + datetime.timedelta(days=31, hours=5, minutes=20)
+        assert compact(session, now=now) == 5
+        session.commit()
+        # The last event of every target is kept.
+        assert [
+            (event.target, event.timestamp) for event in session.query(
+                AppointmentEvent).order_by(AppointmentEvent.timestamp)
+        ][:2] == [
+            ('b', START + datetime.timedelta(minutes=100)),
+            ('a', START + datetime.timedelta(minutes=60 * 24 + 40))]
+        assert session.query(DeliveryMarker).count() == 0
+
+        hours = {
+            (rollup.target, rollup.start.hour): (
+                rollup.availability_seconds, rollup.openings,
+                rollup.closings)
+            for rollup in session.query(EventRollup).filter(
+                EventRollup.period == EventRollup.HOUR,
+                EventRollup.start < START + datetime.timedelta(days=1))
+        }
+        assert hours == {
+            ('a', 0): (600.0, 1, 0),
+            ('a', 1): (600.0, 0, 1),
+            ('b', 0): (300.0, 1, 0),
+            ('b', 1): (2400.0, 0, 1),
+            ('*', 0): (600.0, 1, 0),
+            ('*', 1): (2400.0, 0, 1),
+        }
+        days = session.query(EventRollup).filter(
+            EventRollup.period == EventRollup.DAY,
+            EventRollup.target == EventRollup.ALL_TARGETS).order_by(
+                EventRollup.start).all()
+        assert [day.availability_seconds for day in days] == [3000.0, 1800.0]
+
+        # Nothing new to compact within the same hour.
+        assert compact(session, now=now) == 0
+        assert summary(Statistics.rebuild(session)) == expected
+
+        # The open interval of `b` is split between compactions.
+        assert compact(
+            session, now=now + datetime.timedelta(days=1)) == 1
+        session.commit()
+        stats = Statistics.rebuild(session)
+        assert summary(stats) == expected
+        assert stats.open_since == START + datetime.timedelta(days=2, hours=5)
+
+        assert sorted(opening_counts(session)) == [
+            (START, 1),
+            (START, 1),
+            (START + datetime.timedelta(hours=24), 1),
+            (START + datetime.timedelta(hours=47), 1),
+            (START + datetime.timedelta(hours=60), 1),
+        ]
+
+
+def test_compact_keeps_pending_events():
+    with contextlib.closing(make_session()) as session:
+        populate(session)
+        session.query(AppointmentEvent).filter(
+            AppointmentEvent.id == 2).update({'notification_sent': False})
+        compact(session, now=START + datetime.timedelta(days=40))
+        session.commit()
+        assert session.query(AppointmentEvent).get(2) is not None
+        assert session.query(AppointmentEvent).count() == 3
@@ -0,0 +1,68 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the adaptive polling schedule.
+'''
+
+import datetime
+
+from ..schedule import AdaptiveScheduler
+
+NOON = datetime.datetime(2019, 10, 1, 12, 30)
+NIGHT = datetime.datetime(2019, 10, 1, 3, 0)
+
+
+def test_busy_hours_are_polled_faster():
+    scheduler = AdaptiveScheduler(5, jitter=0)
+    counts = [0] * 24
+    counts[12] = 8
+    scheduler.learn_counts(counts)
+
+    assert scheduler.next_interval(NOON) < 5
+    assert scheduler.next_interval(NIGHT) > 5
+    # Same number of requests per day as with a fixed interval.
+    requests = sum(3600 / interval for interval in scheduler.intervals)
+    assert abs(requests - 24 * 3600 / 5) < 1
+
+
+def test_limits_never_raise_budget():
+    scheduler = AdaptiveScheduler(5, jitter=0)
+    counts = [0] * 24
+    counts[12] = 10000
+    scheduler.learn_counts(counts)
+
+    assert scheduler.next_interval(NOON) == 1
+    requests = sum(3600 / interval for interval in scheduler.intervals)
+    assert requests <= 24 * 3600 / 5
+
+
+def test_max_interval_never_raises_budget():
+    scheduler = AdaptiveScheduler(5, jitter=0)
+    counts = [0] * 17 + [1] + [2000] * 6
+    scheduler.learn_counts(counts)
+
+    # Quiet hours hit the limit and the busy ones give up the difference.
+    assert scheduler.intervals[0] == 25
+    assert scheduler.intervals[-1] < 5
+    requests = sum(3600 / interval for interval in scheduler.intervals)
+    assert abs(requests - 24 * 3600 / 5) < 1e-6
+
+
+def test_backoff():
+    scheduler = AdaptiveScheduler(5, jitter=0, max_backoff=60)
+    scheduler.record_failure()
+    assert scheduler.next_interval(NOON) == 10
+    scheduler.record_failure()
+    assert scheduler.next_interval(NOON) == 20
+    for _ in range(10):
+        scheduler.record_failure()
+    assert scheduler.next_interval(NOON) == 60
+    scheduler.record_success()
+    assert scheduler.next_interval(NOON) == 5
+    assert scheduler.current_interval == 5
+
+
+def test_jitter():
+    scheduler = AdaptiveScheduler(5, jitter=0.2, random=lambda: 1.0)
+    assert scheduler.next_interval(NOON) == 6
+    scheduler = AdaptiveScheduler(5, jitter=0.2, random=lambda: 0.0)
+    assert scheduler.next_interval(NOON) == 4
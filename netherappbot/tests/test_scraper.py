@@ -0,0 +1,120 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the scraping engine.
+'''
+
+import time
+
+from ..scraper import (
+    DEFAULT_TARGET, WELCOME_PAGE, Target, Scraper, ScrapingPool)
+from .test_extract import load_fixture
+
+
+class Response(object):
+    '''Minimal streamed `requests.Response`.'''
+
+    def __init__(self, status_code, text, chunk_delay=0):
+        self.status_code = status_code
+        self.content = text.encode('utf-8')
+        self.encoding = 'utf-8'
+        self.chunk_delay = chunk_delay
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            time.sleep(self.chunk_delay)
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeVfsSession(object):
+    '''Serves recorded pages, the stage is picked by the request.'''
+
+    def __init__(self):
+        self.requests = []
+        self.expired = False
+
+    def request(self, method, url, data=None, **kwargs):
+        self.requests.append(method)
+        if method == 'GET':
+            page = 'welcome'
+        elif data.get('__EVENTTARGET'):
+            page = 'appointment_type'
+        elif self.expired:
+            # ASP.NET sends users back to the start on invalid state.
+            self.expired = False
+            page = 'welcome'
+        else:
+            page = 'application'
+        return Response(200, load_fixture(page))
+
+
+class SleepingPool(ScrapingPool):
+    def __init__(self, targets, delay, **kwargs):
+        super(SleepingPool, self).__init__(targets, **kwargs)
+        for scraper in self.scrapers:
+            scraper.check = self._make_check(scraper.target, delay)
+
+    @staticmethod
+    def _make_check(target, delay):
+        def check():
+            time.sleep(delay)
+            return str(target.visa_category)
+        return check
+
+
+def test_target_parse():
+    assert Target.parse('898:1') == DEFAULT_TARGET
+    assert Target.parse('900:3:https://example.com/a?b=c') == Target(
+        900, 3, 'https://example.com/a?b=c')
+    assert Target.parse('898:1').welcome_page == WELCOME_PAGE
+
+
+def test_targets_have_own_sessions():
+    pool = ScrapingPool([Target(1, 1, WELCOME_PAGE),
+                         Target(2, 1, WELCOME_PAGE)])
+    try:
+        first, second = pool.scrapers
+        assert first.session is not second.session
+    finally:
+        pool.close()
+
+
+def test_check_all_is_concurrent():
+    targets = [Target(category, 1, WELCOME_PAGE) for category in range(10)]
+    pool = SleepingPool(targets, 0.2)
+    try:
+        started = time.monotonic()
+        results = pool.check_all()
+        elapsed = time.monotonic() - started
+    finally:
+        pool.close()
+
+    assert results == [
+        (target, str(target.visa_category)) for target in targets]
+    assert elapsed < 1.0
+
+
+def test_session_reuse():
+    scraper = Scraper(DEFAULT_TARGET)
+    scraper.session = FakeVfsSession()
+
+    assert scraper.check().message == 'No date(s) available for appointment.'
+    assert len(scraper.session.requests) == 3
+    assert scraper.check().message == 'No date(s) available for appointment.'
+    assert len(scraper.session.requests) == 4
+
+    scraper.session.expired = True
+    assert scraper.check().message == 'No date(s) available for appointment.'
+    assert len(scraper.session.requests) == 8
+    assert scraper.check().message == 'No date(s) available for appointment.'
+    assert len(scraper.session.requests) == 9
+
+
+def test_no_session_reuse():
+    scraper = Scraper(DEFAULT_TARGET, reuse=False)
+    scraper.session = FakeVfsSession()
+    scraper.check()
+    scraper.check()
+    assert len(scraper.session.requests) == 6
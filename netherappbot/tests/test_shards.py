@@ -0,0 +1,196 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for sharded notification delivery.
+'''
+
+import contextlib
+import datetime
+
+from ..bot import Bot
+from ..models import (
+    AppointmentEvent, DeliveryMarker, Subscription, User)
+from ..shards import CHANNEL_SHARD, ShardWorker
+from .test_delivery import FakeTelegram
+from .test_notifications import make_bot
+
+
+class FakeShardPool(object):
+    shards = 2
+
+    def __init__(self):
+        self.woken = 0
+
+    def ensure_alive(self):
+        pass
+
+    def wake(self):
+        self.woken += 1
+
+
+def coordinate(bot):
+    with contextlib.closing(bot.Session()) as session:
+        Bot.shard_coordinator_loop.__wrapped__(bot, session)
+
+
+def test_sharded_delivery(tmp_path):
+    bot = make_bot(tmp_path, range(1, 11))
+    bot.shard_pool = FakeShardPool()
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            timestamp=datetime.datetime.utcnow(), have_appointments=True,
+            notification_sent=False))
+        session.commit()
+
+    coordinate(bot)
+    assert bot.shard_pool.woken == 1
+
+    clients = [FakeTelegram(unauthorized={4}), FakeTelegram()]
+    workers = [
+        ShardWorker(bot.Session, client, shard, 2, delivery_rate=1000)
+        for shard, client in enumerate(clients)
+    ]
+    try:
+        # The second shard finishes first, it doesn't wait for the first.
+        assert workers[1].run_once()
+        assert not workers[1].run_once()
+        coordinate(bot)
+        with contextlib.closing(bot.Session()) as session:
+            assert not session.query(AppointmentEvent).one().notification_sent
+
+        assert workers[0].run_once()
+    finally:
+        for worker in workers:
+            worker.close()
+
+    assert sorted(chat_id for chat_id, _ in clients[0].sent) == [2, 6, 8, 10]
+    assert sorted(chat_id for chat_id, _ in clients[1].sent) == [
+        1, 3, 5, 7, 9]
+
+    coordinate(bot)
+    with contextlib.closing(bot.Session()) as session:
+        assert session.query(AppointmentEvent).one().notification_sent
+        assert sorted(
+            (marker.shard, marker.status, marker.sent)
+            for marker in session.query(DeliveryMarker)) == [
+                (0, DeliveryMarker.DONE, 4), (1, DeliveryMarker.DONE, 5)]
+    assert bot.subscribers.subscribed_chat_ids() == [
+        1, 2, 3, 5, 6, 7, 8, 9, 10]
+    bot.broadcaster.close()
+    bot.scrapers.close()
+
+
+def test_channel_post_is_retried_apart(tmp_path):
+    bot = make_bot(tmp_path, [1])
+    bot.shard_pool = FakeShardPool()
+    bot.channel = '@alerts'
+    bot.bot.failing.add('@alerts')
+    with contextlib.closing(bot.Session()) as session:
+        session.add(AppointmentEvent(
+            timestamp=datetime.datetime.utcnow(), have_appointments=True,
+            notification_sent=False))
+        session.commit()
+
+    try:
+        coordinate(bot)
+        # Shards get their markers even though the post failed.
+        assert bot.shard_pool.woken == 1
+        with contextlib.closing(bot.Session()) as session:
+            assert sorted(
+                (marker.shard, marker.status, marker.failed)
+                for marker in session.query(DeliveryMarker)) == [
+                    (CHANNEL_SHARD, DeliveryMarker.PENDING, 1),
+                    (0, DeliveryMarker.PENDING, 0),
+                    (1, DeliveryMarker.PENDING, 0)]
+
+            coordinate(bot)
+            assert bot.bot.sent == []
+            # Backoff is over.
+            session.query(DeliveryMarker).update({
+                DeliveryMarker.claimed_at:
+                datetime.datetime.utcnow() - datetime.timedelta(minutes=1)})
+            session.commit()
+        coordinate(bot)
+    finally:
+        bot.broadcaster.close()
+        bot.scrapers.close()
+    assert [chat_id for chat_id, _ in bot.bot.sent] == ['@alerts']
+    with contextlib.closing(bot.Session()) as session:
+        assert session.query(DeliveryMarker).filter(
+            DeliveryMarker.shard == CHANNEL_SHARD).one().sent == 1
+
+
+def test_release_claims(tmp_path):
+    bot = make_bot(tmp_path, [1])
+    with contextlib.closing(bot.Session()) as session:
+        session.add(DeliveryMarker(
+            event_id=1, shard=0, text='Hi', status=DeliveryMarker.CLAIMED,
+            claimed_at=datetime.datetime.utcnow()))
+        session.commit()
+
+    client = FakeTelegram()
+    worker = ShardWorker(bot.Session, client, 0, 1, delivery_rate=1000)
+    try:
+        assert not worker.run_once()
+        worker.release_claims()
+        assert worker.run_once()
+    finally:
+        worker.close()
+        bot.broadcaster.close()
+        bot.scrapers.close()
+    assert client.sent == [(1, 'Hi')]
+
+
+def test_release_claims_of_other_replicas(tmp_path):
+    bot = make_bot(tmp_path, [1])
+    now = datetime.datetime.utcnow()
+    with contextlib.closing(bot.Session()) as session:
+        for event_id, holder, age in (
+                (1, 'new', 60), (2, 'old', 1), (3, 'old', 60)):
+            session.add(DeliveryMarker(
+                event_id=event_id, shard=0, text='Hi',
+                status=DeliveryMarker.CLAIMED, claimed_by=holder,
+                claimed_at=now - datetime.timedelta(seconds=age)))
+        session.commit()
+
+    worker = ShardWorker(
+        bot.Session, FakeTelegram(), 0, 1, holder='new',
+        stale_after=datetime.timedelta(seconds=15))
+    try:
+        worker.release_claims()
+    finally:
+        worker.close()
+        bot.broadcaster.close()
+        bot.scrapers.close()
+    with contextlib.closing(bot.Session()) as session:
+        # The old leader may still be sending the young marker.
+        assert [marker.event_id for marker in session.query(
+            DeliveryMarker).filter(
+                DeliveryMarker.status == DeliveryMarker.PENDING).order_by(
+                    DeliveryMarker.event_id)] == [1, 3]
+
+
+def test_filtered_delivery(tmp_path):
+    bot = make_bot(tmp_path, [1])
+    with contextlib.closing(bot.Session()) as session:
+        session.add_all([
+            User(chat_id=2, subscribed=False),
+            User(chat_id=3, subscribed=False),
+            Subscription(chat_id=2, visa_category=898, applicants=1),
+            Subscription(chat_id=3, visa_category=898, applicants=2),
+            AppointmentEvent(
+                timestamp=datetime.datetime.utcnow(), have_appointments=True,
+                notification_sent=False),
+        ])
+        session.flush()
+        session.add(DeliveryMarker(event_id=1, shard=0, text='Hi'))
+        session.commit()
+
+    client = FakeTelegram()
+    worker = ShardWorker(bot.Session, client, 0, 1, delivery_rate=1000)
+    try:
+        assert worker.run_once()
+    finally:
+        worker.close()
+        bot.broadcaster.close()
+        bot.scrapers.close()
+    assert sorted(client.sent) == [(1, 'Hi'), (2, 'Hi')]
@@ -0,0 +1,92 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for tracking of available dates.
+'''
+
+import contextlib
+import datetime
+
+from ..bot import Bot
+from ..models import AppointmentEvent
+from ..scraper import DEFAULT_TARGET, NO_APPOINTMENTS, Result
+from ..slots import ANY, SlotTracker, decode_dates, encode_dates
+from .test_delivery import FakeTelegram
+
+NOW = datetime.datetime(2019, 11, 1, 12, 0)
+MINUTE = datetime.timedelta(minutes=1)
+NOV_5 = datetime.date(2019, 11, 5)
+NOV_7 = datetime.date(2019, 11, 7)
+DEC_20 = datetime.date(2019, 12, 20)
+
+
+def test_encoding():
+    assert encode_dates(()) is None
+    assert decode_dates(None) == ()
+    value = encode_dates([NOV_7, DEC_20, NOV_5, NOV_7])
+    assert value == '2019-11-05:{:x}'.format(1 | 1 << 2 | 1 << 45)
+    assert decode_dates(value) == (NOV_5, NOV_7, DEC_20)
+
+
+def step(tracker, available, dates, now):
+    change, state = tracker.diff('a', available, dates, now)
+    tracker.commit('a', state)
+    return change
+
+
+def test_new_dates():
+    tracker = SlotTracker(debounce=5 * MINUTE)
+    tracker.seed('a', False, NOW)
+    assert step(tracker, True, [NOV_5], NOW) == (True, (NOV_5,))
+    assert step(tracker, True, [NOV_5], NOW + MINUTE) is None
+    assert step(tracker, True, [NOV_5, NOV_7], NOW + 2 * MINUTE) == (
+        True, (NOV_7,))
+
+
+def test_blinking_slot():
+    tracker = SlotTracker(debounce=5 * MINUTE)
+    tracker.seed('a', False, NOW)
+    assert step(tracker, True, [NOV_5], NOW) == (True, (NOV_5,))
+    assert step(tracker, False, [], NOW + MINUTE) is None
+    assert step(tracker, True, [NOV_5], NOW + 2 * MINUTE) is None
+    assert step(tracker, False, [], NOW + 3 * MINUTE) is None
+    # Gone for longer than the debounce.
+    assert step(tracker, False, [], NOW + 8 * MINUTE) == (False, ())
+    assert step(tracker, False, [], NOW + 9 * MINUTE) is None
+    assert step(tracker, True, [NOV_5], NOW + 10 * MINUTE) == (
+        True, (NOV_5,))
+
+
+def test_unreadable_dates():
+    tracker = SlotTracker(debounce=MINUTE)
+    # Restarted while appointments were available.
+    tracker.seed('a', True, NOW)
+    assert tracker.states['a'] == {ANY: NOW}
+    assert step(tracker, True, [NOV_5], NOW) is None
+    assert step(tracker, True, [], NOW + MINUTE) is None
+    assert step(tracker, True, [NOV_5, NOV_7], NOW + MINUTE) == (
+        True, (NOV_7,))
+
+    tracker.seed('a', False, NOW)
+    assert step(tracker, True, [], NOW) == (True, ())
+
+
+def test_bot_notifies_once_per_slot(tmp_path):
+    bot = Bot(FakeTelegram(), 'sqlite:///{}'.format(tmp_path / 'bot.db'))
+    results = [
+        Result(NO_APPOINTMENTS, ()),
+        Result('Pick a date', (NOV_5,)),
+        Result(NO_APPOINTMENTS, ()),
+        Result('Pick a date', (NOV_5,)),
+        Result('Pick a date', (NOV_5, NOV_7)),
+    ]
+    with contextlib.closing(bot.Session()) as session:
+        for result in results:
+            bot.scrapers.check_all = lambda: [(DEFAULT_TARGET, result)]
+            Bot.watching_loop.__wrapped__(bot, session)
+        events = [
+            (event.have_appointments, decode_dates(event.slots))
+            for event in session.query(AppointmentEvent).order_by(
+                AppointmentEvent.id)]
+    bot.close_scrapers()
+    bot.broadcaster.close()
+    assert events == [(False, ()), (True, (NOV_5,)), (True, (NOV_7,))]
@@ -0,0 +1,153 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the subscriber index.
+'''
+
+import contextlib
+import datetime
+
+import sqlalchemy
+
+from ..models import Base, User
+from ..subscribers import (
+    CHANNEL, FilterIndex, SubscriberIndex, audience, iter_subscriber_chunks,
+    merge_unique)
+
+
+def make_session_factory():
+    engine = sqlalchemy.create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(engine)
+    return sqlalchemy.orm.sessionmaker(bind=engine)
+
+
+def test_load():
+    Session = make_session_factory()
+    index = SubscriberIndex()
+    with contextlib.closing(Session()) as session:
+        session.add_all([
+            User(chat_id=1, subscribed=True),
+            User(chat_id=2, subscribed=False),
+            User(chat_id=3, subscribed=True),
+        ])
+        session.commit()
+        index.load(session)
+        assert index.get(session, 1) is True
+        assert index.get(session, 2) is False
+        assert index.get(session, 4) is None
+    assert index.subscribed_chat_ids() == [1, 3]
+
+
+def test_changes_applied_on_commit():
+    Session = make_session_factory()
+    index = SubscriberIndex()
+    index.attach(Session)
+    with contextlib.closing(Session()) as session:
+        index.set(session, 1, True)
+        assert index.get(session, 1) is True
+        assert index.subscribed_chat_ids() == []
+        session.commit()
+    assert index.subscribed_chat_ids() == [1]
+
+    with contextlib.closing(Session()) as session:
+        index.set(session, 1, None)
+        session.rollback()
+        assert index.get(session, 1) is True
+
+        index.set(session, 1, None)
+        session.commit()
+        assert index.get(session, 1) is None
+    assert len(index) == 0
+
+
+def test_iter_chunks():
+    Session = make_session_factory()
+    index = SubscriberIndex()
+    index.attach(Session)
+    with contextlib.closing(Session()) as session:
+        for chat_id in (5, -3, 9, 1, 7):
+            index.set(session, chat_id, True)
+        session.commit()
+
+    chunks = index.iter_chunks(2)
+    assert next(chunks) == [-3, 1]
+    with contextlib.closing(Session()) as session:
+        # Changes between chunks neither repeat nor skip chats.
+        index.set(session, -3, None)
+        index.set(session, 8, True)
+        session.commit()
+    assert list(chunks) == [[5, 7], [8, 9]]
+
+
+def test_channel_subscribers():
+    Session = make_session_factory()
+    index = SubscriberIndex()
+    index.attach(Session)
+    with contextlib.closing(Session()) as session:
+        for chat_id in range(1, 8):
+            subscribed = CHANNEL if chat_id in (2, 3, 4, 6) else True
+            session.add(User(chat_id=chat_id, subscribed=True,
+                             channel=subscribed == CHANNEL))
+            index.set(session, chat_id, subscribed)
+        session.commit()
+        assert index.get(session, 2) == CHANNEL
+        assert index.in_channel(3) and not index.in_channel(5)
+        assert list(index.iter_chunks(2)) == [[1, 2], [3, 4], [5, 6], [7]]
+        assert list(index.iter_chunks(2, direct=True)) == [[1], [5], [7]]
+
+        index.set(session, 2, True)
+        session.commit()
+        assert index.get(session, 2) is True
+        index.load(session)
+        assert list(index.iter_chunks(direct=True)) == [[1, 5, 7]]
+
+        assert [
+            chat_id for chat_id, in session.query(User.chat_id).filter(
+                audience(898, 1, channel=True)).order_by(User.chat_id)
+        ] == [1, 5, 7]
+
+
+def test_iter_subscriber_chunks():
+    Session = make_session_factory()
+    with contextlib.closing(Session()) as session:
+        session.add_all([
+            User(chat_id=chat_id, subscribed=chat_id != 4)
+            for chat_id in range(1, 8)
+        ])
+        session.commit()
+        assert list(iter_subscriber_chunks(session, chunk_size=3)) == [
+            [1, 2, 3], [5, 6, 7]]
+        assert list(iter_subscriber_chunks(
+            session, [User.chat_id % 2 == 0], chunk_size=3)) == [[2, 6]]
+
+
+def test_filter_index():
+    Session = make_session_factory()
+    index = FilterIndex()
+    index.attach(Session)
+    november = (datetime.date(2019, 11, 1), datetime.date(2019, 11, 30))
+    with contextlib.closing(Session()) as session:
+        index.set(session, 3, (898, 1), (None, None))
+        index.set(session, 1, (898, 1), november)
+        index.set(session, 2, (898, 2), (None, None))
+        assert index.match((898, 1)) == []
+        session.commit()
+
+    assert index.match((898, 1)) == [1, 3]
+    assert index.match((898, 1), [datetime.date(2019, 12, 1)]) == [3]
+    assert index.match((898, 2)) == [2]
+    assert index.match((900, 1)) == []
+
+    with contextlib.closing(Session()) as session:
+        index.set(session, 2, (898, 1), (None, None))
+        index.remove(session, 3)
+        assert index.get(session, 3) == {}
+        assert index.get(session, 2) == {
+            (898, 1): (None, None), (898, 2): (None, None)}
+        session.commit()
+    assert index.match((898, 1)) == [1, 2]
+    assert len(index) == 3
+
+
+def test_merge_unique():
+    assert list(merge_unique(iter([1, 3, 5]), [2, 3, 6])) == [
+        1, 2, 3, 5, 6]
@@ -0,0 +1,140 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the HTTP layer of the scraper.
+'''
+
+import http.server
+import threading
+import time
+
+import pytest
+import requests
+
+from ..scraper import DEFAULT_TARGET, Scraper
+from ..transport import Deadline, DeadlineExceeded, HttpClient
+from .test_delivery import FakeClock
+from .test_scraper import Response
+
+
+class ScriptedSession(object):
+    '''Returns or raises the scripted results one by one.'''
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.timeouts = []
+
+    def request(self, method, url, data=None, stream=False, timeout=None):
+        self.timeouts.append(timeout)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        pass
+
+
+def make_client(session, **kwargs):
+    clock = FakeClock()
+    return HttpClient(
+        session, clock=clock, sleep=clock.sleep, **kwargs), clock
+
+
+def test_retries_with_backoff():
+    session = ScriptedSession(
+        requests.exceptions.ConnectionError('reset'),
+        Response(503, 'Busy'),
+        Response(200, 'OK'))
+    client, clock = make_client(session, backoff=1)
+    response = client.request('welcome', 'GET', 'http://vfs/')
+    assert (response.status_code, response.text) == (200, 'OK')
+    assert clock.now == 3
+    assert [(attempt.status, attempt.error) for attempt in client.attempts] == [
+        (None, 'ConnectionError'), (503, None), (200, None)]
+
+
+def test_retries_run_out():
+    session = ScriptedSession(Response(502, 'Bad'), Response(502, 'Bad'))
+    client, _ = make_client(session, retries=1)
+    assert client.request('welcome', 'GET', 'http://vfs/').status_code == 502
+
+    session = ScriptedSession(*[requests.exceptions.ReadTimeout()] * 2)
+    client, _ = make_client(session, retries=1)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.request('welcome', 'GET', 'http://vfs/')
+
+
+def test_deadline_caps_timeouts_and_retries():
+    session = ScriptedSession(
+        requests.exceptions.ConnectTimeout(), Response(200, 'OK'))
+    client, clock = make_client(
+        session, connect_timeout=5, read_timeout=15, backoff=3)
+    deadline = Deadline(10, clock=clock)
+    clock.now = 8
+    # The backoff doesn't fit into the 2 seconds left.
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+        client.request('welcome', 'GET', 'http://vfs/', deadline=deadline)
+    assert session.timeouts == [(2, 2)]
+
+    clock.now = 10
+    with pytest.raises(DeadlineExceeded):
+        client.request('welcome', 'GET', 'http://vfs/', deadline=deadline)
+
+
+def test_check_has_an_upper_bound():
+    class SlowSession(object):
+        def request(self, method, url, data=None, **kwargs):
+            return Response(200, 'x' * 10 ** 6, chunk_delay=0.05)
+
+    scraper = Scraper(DEFAULT_TARGET, deadline=0.2)
+    scraper.session = SlowSession()
+    with pytest.raises(DeadlineExceeded):
+        scraper.check()
+
+
+class DrippingHandler(http.server.BaseHTTPRequestHandler):
+    '''Sends a 12 byte body a byte every half a second.'''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '12')
+        self.end_headers()
+        try:
+            for _ in range(12):
+                self.wfile.write(b'x')
+                self.wfile.flush()
+                time.sleep(0.5)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_deadline_cuts_off_a_dripping_body():
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), DrippingHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = HttpClient(read_timeout=1, retries=0)
+    try:
+        started = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            client.request(
+                'welcome', 'GET',
+                'http://127.0.0.1:{}/'.format(server.server_address[1]),
+                deadline=Deadline(2))
+        # Every byte arrives well within the read timeout.
+        assert time.monotonic() - started < 3
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_non_2xx_is_no_result():
+    scraper = Scraper(DEFAULT_TARGET)
+    scraper.http.retries = 0
+    scraper.session = ScriptedSession(Response(404, 'Not found'))
+    assert scraper.check() is None
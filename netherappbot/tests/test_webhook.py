@@ -0,0 +1,121 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Tests for the webhook mode against a local fake sender.
+'''
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+import telegram
+
+from ..bot import TEXTS
+from ..webhook import WebhookServer, secret_path
+from .test_commands import MockBot, TelegramBotFixture
+
+
+def post(server, data, path='/webhook'):
+    url = 'http://{}:{}{}'.format(*server.address[:2], path)
+    request = urllib.request.Request(
+        url, data=json.dumps(data).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1570000000,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+        },
+    }
+
+
+@pytest.fixture
+def server():
+    server = WebhookServer(('127.0.0.1', 0))
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_webhook(server):
+    fixture = (
+        TelegramBotFixture()
+        .expect_message(1, TEXTS.GREETINGS)
+        .expect_message(2, TEXTS.HELP)
+    )
+    bot = MockBot(fixture.client, 'sqlite:///:memory:', webhook=server)
+
+    assert post(server, make_update(10, 1, '/start')) == 200
+    # Redelivery of the same update must be ignored.
+    assert post(server, make_update(10, 1, '/start')) == 200
+    assert post(server, make_update(11, 2, '/help')) == 200
+    bot.webhook_loop()
+
+    assert bot.offset == 12
+
+
+def test_wrong_path(server):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(server, make_update(1, 1, '/start'), path='/other')
+    assert e.value.code == 404
+    assert server.queue.empty()
+
+
+@pytest.mark.parametrize('data', [{}, [], {'update_id': '1'}, None])
+def test_not_an_update(server, data):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(server, data)
+    assert e.value.code == 400
+    assert server.queue.empty()
+
+
+def test_loop_survives_malformed_updates(server):
+    fixture = TelegramBotFixture().expect_message(1, TEXTS.GREETINGS)
+    bot = MockBot(fixture.client, 'sqlite:///:memory:', webhook=server)
+
+    server.queue.put({})
+    server.queue.put({'update_id': 5, 'message': 'garbage'})
+    assert post(server, make_update(10, 1, '/start')) == 200
+    bot.webhook_loop()
+
+    assert bot.offset == 11
+
+
+def test_secret_path():
+    assert secret_path('123:abc') == secret_path('123:abc')
+    assert secret_path('123:abc') != secret_path('123:abd')
+    assert '123:abc' not in secret_path('123:abc')
+
+
+def test_loop_survives_network_errors(server):
+    fixture = (
+        TelegramBotFixture()
+        .expect_message(1, TEXTS.GREETINGS)
+        .expect_message(2, TEXTS.HELP)
+    )
+    client = fixture.client
+    send_message = client.send_message
+    failures = [telegram.error.TimedOut()]
+
+    def flaky_send_message(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return send_message(*args, **kwargs)
+
+    client.send_message = flaky_send_message
+    bot = MockBot(client, 'sqlite:///:memory:', webhook=server)
+
+    assert post(server, make_update(10, 1, '/start')) == 200
+    assert post(server, make_update(11, 2, '/help')) == 200
+    bot.webhook_loop()
+
+    # The batch taken off the queue is processed again after the error.
+    assert failures == []
+    assert bot.offset == 12
@@ -0,0 +1,202 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+HTTP layer of the scraper: deadlines, timeouts, retries and pooling.
+'''
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+import requests
+
+from .metrics import HTTP_ATTEMPTS, HTTP_ATTEMPT_SECONDS
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15
+RETRIES = 2
+BACKOFF = 0.5
+# Statuses which mean "try again later" rather than "your request is wrong".
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+RETRY_ERRORS = (
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError)
+CHUNK_SIZE = 64 * 1024
+ATTEMPT_HISTORY = 100
+
+Attempt = collections.namedtuple('Attempt', (
+    'stage', 'number', 'status', 'error', 'headers_seconds', 'seconds',
+    'size'))
+Response = collections.namedtuple('Response', ('status_code', 'text'))
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline(object):
+    '''Time budget shared by all requests of a scrape cycle.
+
+    None means no limit.
+    '''
+
+    def __init__(self, seconds, clock=time.monotonic):
+        super(Deadline, self).__init__()
+        self.clock = clock
+        self.expires = None if seconds is None else clock() + seconds
+
+    def remaining(self):
+        if self.expires is None:
+            return float('inf')
+        return self.expires - self.clock()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def abort(response):
+    '''Makes reads of the response, blocked ones included, end at once.'''
+    raw = getattr(response, 'raw', None)
+    if hasattr(raw, 'shutdown'):
+        # urllib3 2.3 and later.
+        raw.shutdown()
+        return
+    # Older urllib3: the socket under http.client's buffered reader.
+    sock = getattr(getattr(getattr(getattr(
+        raw, '_fp', None), 'fp', None), 'raw', None), '_sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class HttpClient(object):
+    '''Sends requests of one scraper session.
+
+    Every attempt gets connect and read timeouts capped by the remaining
+    deadline. The read timeout applies to every socket read rather than the
+    whole body, so a watchdog cuts the connection off when the deadline
+    passes while the body is read. Connection errors, timeouts and
+    `RETRY_STATUSES` are retried with exponential backoff while attempts
+    and time are left. The booking system POSTs only read state, so they
+    are retried too.
+    '''
+
+    def __init__(self, session=None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 pool_maxsize=2, clock=time.monotonic, sleep=time.sleep):
+        super(HttpClient, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if session is None:
+            session = requests.Session()
+            # A scraper talks to a single host one request at a time.
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive',
+            })
+        self.session = session
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.attempts = collections.deque(maxlen=ATTEMPT_HISTORY)
+
+    def request(self, stage, method, url, data=None, deadline=None):
+        '''Returns the `Response` of the last attempt.
+
+        Raises `DeadlineExceeded` when the deadline passes and the last
+        error when attempts run out.
+        '''
+        deadline = deadline or Deadline(None, clock=self.clock)
+        number = 0
+        while True:
+            number += 1
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                raise DeadlineExceeded(
+                    '{} {} is out of time'.format(method, url))
+            try:
+                response = self._attempt(
+                    stage, number, method, url, data, remaining, deadline)
+                error = None
+            except RETRY_ERRORS as e:
+                response, error = None, e
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                return response
+            delay = self.backoff * 2 ** (number - 1)
+            if number > self.retries or delay >= deadline.remaining():
+                if error is not None:
+                    raise error
+                return response
+            self.logger.info(
+                '%s: retrying %s %s in %.1f s after %s', stage, method, url,
+                delay, error or response.status_code)
+            self.sleep(delay)
+
+    def _attempt(self, stage, number, method, url, data, remaining,
+                 deadline):
+        started = self.clock()
+        headers_seconds = None
+        status = None
+        size = 0
+        try:
+            response = self.session.request(
+                method, url, data=data, stream=True, timeout=(
+                    min(self.connect_timeout, remaining),
+                    min(self.read_timeout, remaining)))
+            headers_seconds = self.clock() - started
+            status = response.status_code
+            watchdog = None
+            if deadline.expires is not None:
+                watchdog = threading.Timer(
+                    max(0, deadline.remaining()), abort, (response,))
+                watchdog.daemon = True
+                watchdog.start()
+            try:
+                chunks = []
+                try:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if deadline.expired():
+                            break
+                except Exception:
+                    if not deadline.expired():
+                        raise
+                # Also covers a body cut short by the watchdog.
+                if deadline.expired():
+                    raise DeadlineExceeded(
+                        '{} {} is out of time'.format(method, url))
+            finally:
+                if watchdog is not None:
+                    watchdog.cancel()
+                response.close()
+        except Exception as e:
+            self._record(Attempt(
+                stage, number, status, e.__class__.__name__,
+                headers_seconds, self.clock() - started, size))
+            raise
+        self._record(Attempt(
+            stage, number, status, None, headers_seconds,
+            self.clock() - started, size))
+        return Response(status, b''.join(chunks).decode(
+            response.encoding or 'utf-8', errors='replace'))
+
+    def _record(self, attempt):
+        self.attempts.append(attempt)
+        HTTP_ATTEMPTS.labels(
+            attempt.stage, attempt.error or attempt.status).inc()
+        HTTP_ATTEMPT_SECONDS.labels(attempt.stage).observe(attempt.seconds)
+        self.logger.debug('%s', attempt)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,95 @@
+'''Copyright (c) 2019 Aleksandr Derbenev. All rights reserved.
+
+Embedded HTTP server which receives Telegram updates via webhook.
+'''
+
+import hashlib
+import http.server
+import json
+import logging
+import queue
+import threading
+
+
+def secret_path(token):
+    '''Returns a webhook path which only Telegram and the bot know.
+
+    It is derived from the bot token, so it is stable across restarts and
+    nobody else can forge updates by guessing it.
+    '''
+    return '/webhook/' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            update = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(update, dict) or \
+                type(update.get('update_id')) is not int:
+            self.send_error(400)
+            return
+
+        try:
+            webhook.queue.put(update, timeout=webhook.put_timeout)
+        except queue.Full:
+            # Telegram will deliver it again later.
+            webhook.logger.warning('Update queue is full')
+            self.send_error(503)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.webhook.logger.debug(format, *args)
+
+
+class WebhookServer(object):
+    '''Puts JSON updates POSTed to `path` into a bounded queue.'''
+
+    def __init__(self, address, path='/webhook', queue_size=1000,
+                 put_timeout=1):
+        super(WebhookServer, self).__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(queue_size)
+        self.httpd = http.server.ThreadingHTTPServer(address, _Handler)
+        self.httpd.webhook = self
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name='Webhook', daemon=True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        self.logger.info('Listening on %s:%d', *self.address[:2])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_batch(self, max_size=100, timeout=1):
+        '''Waits for an update and returns it with the queued ones.'''
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < max_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
@@ -39,6 +39,9 @@ setup(
         'requests==2.22.0',
         'sentry-sdk==0.13.1',
     ],
+    extras_require={
+        'lxml': ['lxml==4.4.1'],
+    },
     setup_requires=[
         'pytest-runner==5.1',
     ],